@@ -0,0 +1,73 @@
+"""!
+@file bench_motor.py
+@brief Counts hardware writes per control tick made by @c Motor.set_duty
+       and @c Motor.set_duty_fast.
+
+@detail Both motors are driven through duty sequences like those in
+        @c main.py: timed maneuvers which hold the same duty for many ticks,
+        a stop, and closed loop control whose output changes every tick.
+
+        Run on the host computer:
+        @code
+        python bench_motor.py
+        @endcode
+"""
+
+import contextlib
+import io
+import math
+
+import upy_host
+
+
+def duty_sequences():
+    """!
+    @brief Makes (name, list of (left, right) duties) pairs, one per tick.
+    """
+    maneuver = [(-23, -20)] * 75 + [(23, -20)] * 58 + [(0, 0)] * 100
+    control = [(30 + 5 * math.sin(tick / 20), 30 + 5 * math.cos(tick / 20))
+               for tick in range(500)]
+    saturated = [(120, -130)] * 50
+    return [("Timed maneuvers", maneuver), ("Closed loop", control),
+            ("Saturated", saturated)]
+
+
+def count_writes(motors, duties):
+    """!
+    @brief Counts the writes to pins and timer channels while duties are set.
+
+    @param motors A (left, right) pair of @c Motor objects
+    @param duties A list of (left, right) duties, one per control tick
+
+    @return The number of hardware writes per tick and the number of error
+            messages printed per tick
+    """
+    parts = [part for motor in motors for part in (motor.DIR, motor.CH1)]
+    before = sum(part.writes for part in parts)
+    printed = io.StringIO()
+    with contextlib.redirect_stdout(printed):
+        for left, right in duties:
+            motors[0].set_duty(left)
+            motors[1].set_duty(right)
+    return ((sum(part.writes for part in parts) - before) / len(duties),
+            printed.getvalue().count('\n') / len(duties))
+
+
+if __name__ == "__main__":
+    upy_host.install()
+    from pyb import Timer, Pin
+    from motor import Motor
+
+    def make_motors(fast):
+        return (Motor(Timer(1, freq=20000), Pin.cpu.A8, Pin.cpu.B10,
+                      Pin.cpu.B4, fast=fast),
+                Motor(Timer(4, freq=20000), Pin.cpu.B6, Pin.cpu.C7,
+                      Pin.cpu.A9, fast=fast))
+
+    print("                    WRITES PER TICK     PRINTS PER TICK")
+    print("SEQUENCE          set_duty      fast  set_duty      fast")
+    for name, duties in duty_sequences():
+        plain = count_writes(make_motors(False), duties)
+        fast = count_writes(make_motors(True), duties)
+        print(f"{name:<16s}{plain[0]: 10.2f}{fast[0]: 10.2f}"
+              f"{plain[1]: 10.2f}{fast[1]: 10.2f}")
@@ -0,0 +1,80 @@
+"""!
+@file bench_queues.py
+@brief Compares the throughput of @c task_share queues on the host computer.
+
+@detail Each queue type is filled and emptied in bursts, the way a task
+        drains data put in by an interrupt. Times are host CPU times, so only
+        the ratios between the queue types mean much for the board.
+
+        Run on the host computer:
+        @code
+        python bench_queues.py [items]
+        @endcode
+"""
+
+import array
+import sys
+import time
+
+import upy_host
+
+
+def bench(put, get, items, burst=32):
+    """!
+    @brief Times moving items through a queue in bursts.
+
+    @param put The function which puts one item into the queue
+    @param get The function which gets one item from the queue
+    @param items The total number of items to move
+    @param burst The number of items put in before they are all taken out
+
+    @return The number of items moved per second of host time
+    """
+    start = time.perf_counter()
+    for _ in range(items // burst):
+        for item in range(burst):
+            put(item)
+        for _ in range(burst):
+            get()
+    return items / (time.perf_counter() - start)
+
+
+def bench_bulk(queue, items, burst=32):
+    """!
+    @brief Times moving items through a queue in bursts with
+           @c put_many() and @c get_many().
+
+    @param queue The @c task_share.Queue to use
+    @param items The total number of items to move
+    @param burst The number of items put in before they are all taken out
+
+    @return The number of items moved per second of host time
+    """
+    source = array.array(queue._type_code, range(burst))
+    dest = array.array(queue._type_code, range(burst))
+    start = time.perf_counter()
+    for _ in range(items // burst):
+        queue.put_many(source)
+        queue.get_many(dest)
+    return items / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    num_items = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    upy_host.install()
+    import task_share
+
+    plain = task_share.Queue('h', 64, name='Plain')
+    protected = task_share.Queue('h', 64, thread_protect=True,
+                                 name='Protected')
+    spsc = task_share.SPSCQueue('h', 64, name='SPSC')
+
+    results = [("Queue", bench(plain.put, plain.get, num_items)),
+               ("Queue, thread_protect", bench(protected.put, protected.get,
+                                               num_items)),
+               ("SPSCQueue", bench(spsc.try_put, spsc.try_get, num_items)),
+               ("Queue, put/get_many", bench_bulk(protected, num_items))]
+
+    base = results[0][1]
+    for name, rate in results:
+        print(f"{name:<24s}{rate / 1000: 10.0f} k items/s{rate / base: 8.2f}x")
@@ -0,0 +1,226 @@
+"""!
+@file check_cotask.py
+@brief Checks the scheduler in @c cotask.py against a virtual clock.
+
+@detail Each check puts tasks on the virtual clock of @c upy_host, forces
+        the situation it is about, and compares what the scheduler did with
+        what it should have done. For each overrun policy a 10 ms task is
+        held up for two and a half periods, then its next run times, runs
+        and @c get_misses() counts are checked. Garbage collection in slack
+        time is checked with the heap stand-in of @c upy_host, whose free
+        memory is set by hand, and a @c gc.collect() which frees it and takes
+        @c GC_PAUSE_US of virtual time: a collection with slack to spare, one
+        put off because a task or an added deadline is due too soon, and
+        one forced when the heap is nearly full. Trace buffers too big for
+        the dump's header are checked to be turned down.
+
+        Run on the host computer:
+        @code
+        python check_cotask.py
+        @endcode
+        The exit status is 1 if any check fails.
+"""
+
+import sys
+
+import upy_host
+
+## The period of the task held up by the overrun checks, ms.
+PERIOD_MS = 10
+
+## How long a simulated garbage collection takes, us.
+GC_PAUSE_US = 1500
+
+## The heap threshold and the least slack for collections, bytes and us.
+GC_THRESHOLD = 16000
+GC_MIN_SLACK_US = 2000
+
+
+def idle_task():
+    """!
+    @brief A task which does nothing, one run at a time.
+    """
+    while True:
+        yield 0
+
+
+def run_ready(task):
+    """!
+    @brief Runs a task for as long as it is ready without the clock moving.
+
+    @param task The @c cotask.Task to run
+    @return The number of times it ran
+    """
+    runs = 0
+    while task.schedule():
+        runs += 1
+    return runs
+
+
+def check_overrun(cotask, clock, policy):
+    """!
+    @brief Holds up a task for 2.5 periods under an overrun policy.
+
+    @detail The task runs on time once, at 10 ms, and is next due at 20 ms.
+            It then isn't run again until 45 ms, two and a half periods
+            late.
+
+    @param cotask The imported @c cotask module
+    @param clock The @c upy_host.VirtualClock which drives it
+    @param policy One of the @c cotask.OVERRUN_ policies
+    @return A list of (what, result, expected) tuples
+    """
+    period = PERIOD_MS * 1000
+    missed = []
+    clock.us = 0
+    task = cotask.Task(idle_task, name='Held', period=PERIOD_MS,
+                       overrun=policy,
+                       on_miss=lambda task, num: missed.append(num))
+
+    clock.us = period + 1
+    on_time = run_ready(task)
+    next_on_time = task._next_run
+
+    clock.us = 4 * period + period // 2
+    late_runs = run_ready(task)
+
+    # Catch up with a run for each missed period, skip to the next whole
+    # period of the old schedule, or start a new schedule from now
+    if policy == cotask.OVERRUN_CATCH_UP:
+        expected_next = 5 * period
+        expected_runs = 3
+        expected_misses = (2, 3)
+        expected_missed = [2, 1]
+    elif policy == cotask.OVERRUN_SKIP:
+        expected_next = 5 * period
+        expected_runs = 1
+        expected_misses = (1, 2)
+        expected_missed = [2]
+    else:
+        expected_next = 5 * period + period // 2
+        expected_runs = 1
+        expected_misses = (1, 2)
+        expected_missed = [2]
+
+    return [("runs on time", on_time, 1),
+            ("next run after an on time run", next_on_time, 2 * period),
+            ("runs when 2.5 periods late", late_runs, expected_runs),
+            ("next run after the overrun", task._next_run, expected_next),
+            ("get_misses()", task.get_misses(), expected_misses),
+            ("periods passed to on_miss", missed, expected_missed)]
+
+
+def check_gc(cotask, clock):
+    """!
+    @brief Runs a 10 ms task with the heap set low at chosen times.
+
+    @param cotask The imported @c cotask module
+    @param clock The @c upy_host.VirtualClock which drives it
+    @return A list of (what, result, expected) tuples
+    """
+    import gc
+    heap = gc.heap
+    collect = gc.collect
+
+    def collect_on_heap():
+        clock.advance(GC_PAUSE_US)
+        heap.allocated = 0
+
+    deadline = [None]
+    checks = []
+    clock.us = 0
+    heap.allocated = 0
+    gc.collect = collect_on_heap
+    try:
+        tasks = cotask.TaskList()
+        tasks.append(cotask.Task(idle_task, name='Timed', period=PERIOD_MS))
+        tasks.add_deadline(lambda: deadline[0])
+        tasks.schedule_gc(GC_THRESHOLD, GC_MIN_SLACK_US)
+        checks.append(("automatic collection off", gc.isenabled(), False))
+
+        # Low heap just after the task ran, with 9 ms to spare
+        clock.us = PERIOD_MS * 1000 + 1
+        tasks.pri_sched()
+        heap.allocated = heap.size - GC_THRESHOLD + 1
+        clock.advance(cotask.GC_CHECK_US)
+        tasks.pri_sched()
+        tasks.pri_sched()
+        checks.append(("collected in slack time", tasks.gc_count, 1))
+        checks.append(("pause recorded", tasks.gc_slowest, GC_PAUSE_US))
+
+        # Low heap 1 ms before the task is due
+        heap.allocated = heap.size - GC_THRESHOLD + 1
+        clock.us = 2 * PERIOD_MS * 1000 - 1000
+        tasks.pri_sched()
+        tasks.pri_sched()
+        checks.append(("put off near a task", (tasks.gc_count,
+                                               tasks.gc_deferred), (1, 1)))
+
+        # The task runs and leaves plenty of time, but an interrupt's work
+        # is due in 0.5 ms
+        clock.us = 2 * PERIOD_MS * 1000 + 1
+        tasks.pri_sched()
+        deadline[0] = 500
+        tasks.pri_sched()
+        checks.append(("put off near a deadline", (tasks.gc_count,
+                                                   tasks.gc_deferred), (1, 2)))
+        deadline[0] = None
+        tasks.pri_sched()
+        checks.append(("collected once it's clear", tasks.gc_count, 2))
+
+        # Nearly full heap when the task runs, with no slack looked for
+        heap.allocated = heap.size - tasks.gc_emergency + 1
+        clock.us = 3 * PERIOD_MS * 1000 + 1
+        tasks.pri_sched()
+        checks.append(("forced when nearly full", (tasks.gc_count,
+                                                   tasks.gc_forced), (2, 1)))
+        checks.append(("heap freed", heap.mem_free(), heap.size))
+
+        tasks.schedule_gc(None)
+        checks.append(("automatic collection back on", gc.isenabled(),
+                       True))
+    finally:
+        gc.collect = collect
+        gc.enable()
+    return checks
+
+
+def check_trace_size(cotask):
+    """!
+    @brief Makes tasks with the largest trace buffer and one more.
+
+    @param cotask The imported @c cotask module
+    @return A list of (what, result, expected) tuples
+    """
+    def made(size):
+        try:
+            cotask.Task(idle_task, name='Traced', trace=size)
+        except ValueError:
+            return False
+        return True
+
+    return [("TRACE_MAX_SIZE accepted", made(cotask.TRACE_MAX_SIZE), True),
+            ("one more turned down", made(cotask.TRACE_MAX_SIZE + 1), False)]
+
+
+if __name__ == "__main__":
+    clock = upy_host.install()
+    import cotask
+
+    checks = []
+    for name, policy in (("OVERRUN_CATCH_UP", cotask.OVERRUN_CATCH_UP),
+                         ("OVERRUN_SKIP", cotask.OVERRUN_SKIP),
+                         ("OVERRUN_REALIGN", cotask.OVERRUN_REALIGN)):
+        checks += [(name, *check)
+                   for check in check_overrun(cotask, clock, policy)]
+    checks += [("Slack time GC", *check) for check in check_gc(cotask, clock)]
+    checks += [("Trace size", *check) for check in check_trace_size(cotask)]
+
+    failed = 0
+    for group, what, result, expected in checks:
+        ok = result == expected
+        failed += not ok
+        print(f"{group:<18s}{what:<32s}{str(result):<12s}"
+              f"{'ok' if ok else 'FAILED, expected ' + str(expected)}")
+    print(f"{len(checks) - failed} of {len(checks)} checks passed")
+    sys.exit(1 if failed else 0)
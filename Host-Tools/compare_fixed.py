@@ -0,0 +1,363 @@
+"""!
+@file compare_fixed.py
+@brief Compares the fixed point control path of @c fixedpoint.py with the
+       float path of @c main.py, and counts what each allocates per tick.
+
+@detail Each fixed point function is given the same inputs as the float
+        function it replaces, and the largest difference is checked against
+        a tolerance. Then both wheel speed loops of @c main.inner_loop_task
+        drive a simulated motor through the same setpoint steps, each in its
+        own closed loop, and the wheel speeds they reach are compared.
+
+        MicroPython allocates every float on the heap, and every int of
+        2**30 or more. CPython reuses float objects, so allocations can't be
+        seen on the host; instead the numbers in the objects and in the
+        functions' constants are replaced with subclasses of @c float and
+        @c int which count the results the board would allocate.
+
+        Run on the host computer:
+        @code
+        python compare_fixed.py
+        @endcode
+"""
+
+import math
+import sys
+import types
+
+import upy_host
+
+## The inner loop period, s.
+DT = 0.01
+
+## A simulated motor: rad/s per percent of duty above the offset, the
+#  offset in percent and the time constant in s.
+MOTOR_GAIN = 0.2
+MOTOR_OFFSET = 4.0
+MOTOR_TAU = 0.1
+
+## Encoder counts per wheel revolution.
+COUNTS_PER_REV = 12 * 120
+
+## Largest differences allowed from the float path, in the units of each
+#  function's output: percent duty for the PID and feedforward and rad/s
+#  for speeds. Most come from rounding the gains and constants to 1/256.
+TOLERANCE = {"PID": 0.1, "Feedforward": 0.05, "Encoder speed": 0.05,
+             "Closed loop speed": 0.1}
+
+## Largest int MicroPython keeps without allocating, on a 32 bit port.
+SMALL_INT_LIMIT = 1 << 30
+
+
+class Counter:
+    """!
+    @brief Counts the results which would be allocated on the board.
+    """
+    floats = 0
+    big_ints = 0
+
+
+class CFloat(float):
+    """!
+    @brief A float which counts the floats made from it.
+    """
+
+
+class CInt(int):
+    """!
+    @brief An int which counts floats and big ints made from it.
+    """
+
+
+def _wrap(result):
+    # Count a result the board would allocate, and keep counting from it
+    if type(result) is float:
+        Counter.floats += 1
+        return CFloat(result)
+    if type(result) is int:
+        if abs(result) >= SMALL_INT_LIMIT:
+            Counter.big_ints += 1
+        return CInt(result)
+    return result
+
+
+def _float_op(name):
+    def op(self, *args):
+        return _wrap(getattr(float, name)(self, *args))
+    return op
+
+
+def _int_op(name):
+    def op(self, *args):
+        if args and isinstance(args[0], float):
+            return _wrap(getattr(float, name)(float(self), *args))
+        return _wrap(getattr(int, name)(self, *args))
+    return op
+
+
+for _name in ("__add__", "__radd__", "__sub__", "__rsub__", "__mul__",
+              "__rmul__", "__truediv__", "__rtruediv__", "__floordiv__",
+              "__rfloordiv__", "__mod__", "__rmod__", "__pow__", "__rpow__",
+              "__neg__", "__pos__", "__abs__"):
+    setattr(CFloat, _name, _float_op(_name))
+for _name in ("__add__", "__radd__", "__sub__", "__rsub__", "__mul__",
+              "__rmul__", "__truediv__", "__rtruediv__", "__floordiv__",
+              "__rfloordiv__", "__mod__", "__rmod__", "__neg__", "__abs__",
+              "__lshift__", "__rshift__", "__and__", "__or__"):
+    setattr(CInt, _name, _int_op(_name))
+
+
+def _counting(value):
+    # The counting version of a number, or the value itself
+    if type(value) is float:
+        return CFloat(value)
+    if type(value) is int:
+        return CInt(value)
+    return value
+
+
+def count_in(*objects):
+    """!
+    @brief Makes the numbers in objects count what is made from them.
+    """
+    for obj in objects:
+        for name, value in vars(obj).items():
+            setattr(obj, name, _counting(value))
+
+
+def count_in_code(*functions):
+    """!
+    @brief Makes the number constants in functions count what is made from
+           them.
+    """
+    for fun in functions:
+        fun = getattr(fun, "__func__", fun)
+        code = fun.__code__
+        fun.__code__ = code.replace(
+            co_consts=tuple(_counting(c) for c in code.co_consts))
+
+
+def allocations(tick, runs=100):
+    """!
+    @brief Counts the floats and big ints a function makes per run.
+
+    @return A tuple of floats and big ints per run
+    """
+    Counter.floats = Counter.big_ints = 0
+    for _ in range(runs):
+        tick()
+    return Counter.floats / runs, Counter.big_ints / runs
+
+
+class Wheel:
+    """!
+    @brief A wheel driven by a motor with an offset and a lag, turning an
+           encoder timer's counter.
+    """
+
+    def __init__(self, timer):
+        self.timer = timer
+        self.speed = 0.0
+        self.angle = 0.0
+
+    def step(self, duty, dt):
+        drive = max(0.0, abs(duty) - MOTOR_OFFSET) * math.copysign(1, duty)
+        self.speed += (MOTOR_GAIN * drive - self.speed) * dt / MOTOR_TAU
+        self.angle += self.speed * dt
+        # Encoder.get_speed gives minus the counter's rate
+        counts = int(self.angle * COUNTS_PER_REV / (2 * math.pi))
+        self.timer.counter(-counts & 0xFFFF)
+
+
+def setpoints(ticks):
+    """!
+    @brief Makes a wheel speed setpoint for each tick, in rad/s.
+    """
+    steps = [(0.0, 0.0), (0.2, 5.0), (1.0, 12.0), (1.8, -6.0), (2.6, 0.0)]
+    values = []
+    for tick in range(ticks):
+        t = tick * DT
+        values.append([v for start, v in steps if t >= start][-1])
+    return values
+
+
+def compare_functions(main, fixedpoint):
+    """!
+    @brief Gives each fixed point function the same inputs as the float
+           function it replaces.
+
+    @return A dictionary from function name to largest difference
+    """
+    to_fixed, to_float = fixedpoint.to_fixed, fixedpoint.to_float
+    worst = {}
+
+    # PID, fed the same measurements
+    pid = main.PIDController(0.3, 0.9, 0.02, 100, integral_limit=100)
+    fixed_pid = fixedpoint.FixedPID(0.3, 0.9, 0.02, DT, 100, 100)
+    diff = 0.0
+    for tick in range(300):
+        setpoint = 10.0 if tick < 150 else -4.0
+        measurement = 8 * math.sin(tick / 17)
+        out = pid.update(setpoint, measurement, DT)
+        fixed = fixed_pid.update(to_fixed(setpoint), to_fixed(measurement))
+        diff = max(diff, abs(out - to_float(fixed)))
+    worst["PID"] = diff
+
+    # Feedforward over the speed range
+    ff = main.MotorFeedforward(MOTOR_GAIN, MOTOR_OFFSET)
+    fixed_ff = fixedpoint.FixedFeedforward(MOTOR_GAIN, MOTOR_OFFSET)
+    worst["Feedforward"] = max(
+        abs(ff.duty(s / 10) - to_float(fixed_ff.duty(to_fixed(s / 10))))
+        for s in range(-200, 201))
+
+    # Encoder speed from the same counts
+    from pyb import Timer
+    from encoder import Encoder
+    clock = upy_host.Pin.clock
+    timer = Timer(2, prescaler=0, period=65535)
+    float_encoder = Encoder(timer, None, None)
+    fixed_encoder = fixedpoint.FixedEncoder(Encoder(timer, None, None))
+    wheel = Wheel(timer)
+    diff = 0.0
+    for tick in range(300):
+        clock.advance(int(DT * 1000000))
+        wheel.step(60 * math.sin(tick / 30), DT)
+        float_encoder.update()
+        fixed_encoder.update()
+        diff = max(diff, abs(float_encoder.get_speed(update=False)
+                             - to_float(fixed_encoder.speed)))
+    worst["Encoder speed"] = diff
+    return worst
+
+
+class WheelLoop:
+    """!
+    @brief The wheel speed loop of @c main.inner_loop_task for one wheel,
+           float or fixed point, driving its own simulated wheel.
+    """
+
+    def __init__(self, main, fixedpoint, fixed, timer_num):
+        from pyb import Timer, Pin
+        from encoder import Encoder
+        from motor import Motor
+        self.fixed = fixed
+        self.fp = fixedpoint
+        timer = Timer(timer_num, prescaler=0, period=65535)
+        self.encoder = Encoder(timer, None, None)
+        self.wheel = Wheel(timer)
+        self.motor = Motor(Timer(timer_num + 10, freq=20000), Pin.cpu.A8,
+                           Pin.cpu.B10, Pin.cpu.B4, fast=True)
+        if fixed:
+            self.speed = fixedpoint.FixedEncoder(self.encoder)
+            self.pid = fixedpoint.FixedPID(main.Kp_inner, main.Ki_inner,
+                                           main.Kd_inner, DT, 100, 100)
+            self.ff = fixedpoint.FixedFeedforward(MOTOR_GAIN, MOTOR_OFFSET)
+        else:
+            self.pid = main.PIDController(main.Kp_inner, main.Ki_inner,
+                                          main.Kd_inner, 100,
+                                          integral_limit=100)
+            self.ff = main.MotorFeedforward(MOTOR_GAIN, MOTOR_OFFSET)
+        self.setpoint = 0
+
+    def set(self, omega):
+        # As main.inner_loop_task does when motor_speeds changes
+        self.setpoint = self.fp.to_fixed(omega) if self.fixed else omega
+
+    def tick(self):
+        # One run of the loop, as in main.inner_loop_task
+        if self.fixed:
+            omega = self.speed.update()
+            duty = self.ff.duty(self.setpoint) + self.pid.update(
+                self.setpoint, omega)
+            self.motor.prepare_duty_q8(duty)
+        else:
+            omega = self.encoder.get_speed()
+            duty = self.ff.duty(self.setpoint) + self.pid.update(
+                self.setpoint, omega, DT)
+            self.motor.prepare_duty(duty)
+        self.motor.write_direction()
+        self.motor.write_compare()
+
+    def step(self):
+        # Drive the simulated wheel with the duty last written
+        duty = self.motor.compare / self.motor.counts_per_percent
+        if self.motor.direction:
+            duty = -duty
+        self.wheel.step(duty, DT)
+
+
+def compare_loops(main, fixedpoint, seconds=3.0):
+    """!
+    @brief Runs the float and fixed point wheel loops through the same
+           setpoints.
+
+    @return The largest difference between the wheel speeds they reach,
+            rad/s, and the loops
+    """
+    clock = upy_host.Pin.clock
+    loops = [WheelLoop(main, fixedpoint, False, 2),
+             WheelLoop(main, fixedpoint, True, 3)]
+    diff = 0.0
+    for omega in setpoints(int(seconds / DT)):
+        clock.advance(int(DT * 1000000))
+        for loop in loops:
+            loop.step()
+            loop.set(omega)
+            loop.tick()
+        diff = max(diff, abs(loops[0].wheel.speed - loops[1].wheel.speed))
+    return diff, loops
+
+
+def count_allocations(main, fixedpoint, loops):
+    """!
+    @brief Counts the floats and big ints made per tick by each path.
+
+    @return A list of (name, float path counts, fixed path counts) rows,
+            where counts are (floats, big ints) per run
+    """
+    from encoder import Encoder
+    from motor import Motor
+    import encoder as encoder_module
+
+    # Count from the numbers in the objects and in the functions' code
+    count_in_code(main.PIDController.update, main.MotorFeedforward.duty,
+                  Encoder.update, Encoder.get_speed, Motor.prepare_duty,
+                  Motor.prepare_duty_q8, Motor.write_direction,
+                  Motor.write_compare, fixedpoint.FixedPID.update,
+                  fixedpoint.FixedEncoder.update,
+                  fixedpoint.FixedFeedforward.duty, WheelLoop.tick)
+    encoder_module.math = types.SimpleNamespace(pi=CFloat(math.pi))
+    for loop in loops:
+        count_in(loop, loop.pid, loop.ff, loop.encoder, loop.motor)
+        if loop.fixed:
+            count_in(loop.speed)
+
+    return [("Wheel loop, one wheel", allocations(loops[0].tick),
+             allocations(loops[1].tick))]
+
+
+if __name__ == "__main__":
+    upy_host.install()
+    from vsim import load_main
+    main = load_main()
+    import fixedpoint
+
+    print("FUNCTION              LARGEST DIFFERENCE   TOLERANCE")
+    failed = False
+    worst = compare_functions(main, fixedpoint)
+    worst["Closed loop speed"], loops = compare_loops(main, fixedpoint)
+    for name, diff in worst.items():
+        ok = diff <= TOLERANCE[name]
+        failed = failed or not ok
+        print(f"{name:<20s}{diff: 12.4f}{TOLERANCE[name]: 16.4f}"
+              f"{'' if ok else '   FAILED'}")
+
+    print()
+    print("PER RUN               FLOAT PATH           FIXED POINT PATH")
+    print("                      floats  big ints     floats  big ints")
+    for name, float_counts, fixed_counts in count_allocations(main,
+                                                              fixedpoint,
+                                                              loops):
+        print(f"{name:<20s}{float_counts[0]: 8.1f}{float_counts[1]: 10.1f}"
+              f"{fixed_counts[0]: 11.1f}{fixed_counts[1]: 10.1f}")
+    sys.exit(1 if failed else 0)
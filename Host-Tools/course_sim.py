@@ -0,0 +1,251 @@
+"""!
+@file course_sim.py
+@brief Measures lap time on a simulated line following course, with and
+       without the speed planner and the course memory.
+
+@detail The robot follows a line made of straights and arcs. Its line sensor
+        sees the line as the eight QTRX sensors would, thresholded and turned
+        into a centroid as in @c main.outer_loop_task, and the line controller
+        has the gains of @c main.py. The velocity and yaw rate loops are taken
+        to follow their setpoints with first order lags. The speed setpoint
+        comes from @c speed_planner.SpeedPlanner, so the planner settings in a
+        calibration file can be compared with the constant setpoint before
+        they go on the board. The planner lap is learned into a
+        @c course_memory.CourseMemory and a last lap races from it.
+
+        Run on the host computer:
+        @code
+        python course_sim.py [calibration.json]
+        @endcode
+"""
+
+import json
+import math
+import os
+import sys
+
+import upy_host
+
+## The default calibration file, the one kept with the board's files.
+CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'Romi-Files', 'calibration.json')
+
+## The course, as ("straight", length in ft) and ("arc", radius in ft,
+#  angle in degrees, positive to the left) pieces.
+DEFAULT_COURSE = [("straight", 3.0), ("arc", 1.0, 90), ("straight", 2.0),
+                  ("arc", 0.5, -120), ("arc", 0.7, 150), ("straight", 4.0),
+                  ("arc", 0.4, 90), ("straight", 1.5), ("arc", 1.5, -60),
+                  ("straight", 3.0)]
+
+## Distance from the wheel axle forward to the line sensor, ft.
+SENSOR_AHEAD = 0.22
+
+## Distance between neighbouring line sensors, ft.
+SENSOR_PITCH = 0.008 / 0.3048
+
+## Width of the line, ft.
+LINE_WIDTH = 0.75 / 12
+
+## Time constants of the velocity and yaw rate loops, s. These are guesses;
+#  with a yaw rate lag of 0.3 s a constant setpoint runs off the course
+#  between 1.2 and 1.5 ft/s.
+TAU_V = 0.15
+TAU_YAW = 0.3
+
+## Fastest wheel speed at the rim, ft/s, and half the track width, ft.
+WHEEL_MAX = 1.8
+HALF_TRACK = 5.5 / 24
+
+## Inner and outer loop periods, s.
+INNER_DT = 0.01
+OUTER_DT = 0.03
+
+
+def build_course(pieces, step=0.005):
+    """!
+    @brief Turns course pieces into closely spaced points along the line.
+
+    @return A list of (x, y) points
+    """
+    x = y = heading = 0.0
+    points = [(x, y)]
+    for piece in pieces:
+        if piece[0] == "straight":
+            num = max(1, int(piece[1] / step))
+            turn = 0.0
+            length = piece[1]
+        else:
+            length = piece[1] * math.radians(abs(piece[2]))
+            num = max(1, int(length / step))
+            turn = math.radians(piece[2]) / num
+        for _ in range(num):
+            heading += turn / 2
+            x += length / num * math.cos(heading)
+            y += length / num * math.sin(heading)
+            heading += turn / 2
+            points.append((x, y))
+    return points
+
+
+class PID:
+    """!
+    @brief A PID like @c main.PIDController, so @c main.py's hardware setup
+           doesn't have to run.
+    """
+
+    def __init__(self, kp, ki, kd, out_max, integral_limit):
+        self.kp, self.ki, self.kd = kp, ki, kd
+        self.out_max = out_max
+        self.integral_limit = integral_limit
+        self.integral = 0.0
+        self.prev_error = 0.0
+
+    def update(self, setpoint, measurement, dt):
+        error = setpoint - measurement
+        self.integral = max(-self.integral_limit,
+                            min(self.integral_limit,
+                                self.integral + error * dt))
+        derivative = (error - self.prev_error) / dt
+        self.prev_error = error
+        out = self.kp * error + self.ki * self.integral + self.kd * derivative
+        return max(-self.out_max, min(self.out_max, out))
+
+
+def run_lap(points, planner, memory=None, learn=False, settings=None,
+            limit_s=120, off_course=0.5):
+    """!
+    @brief Follows the course from start to end.
+
+    @param points The course from @c build_course()
+    @param planner A @c SpeedPlanner giving the speed setpoint
+    @param memory A @c CourseMemory to learn the course into or to race
+           from, or @c None
+    @param learn @c True to record the lap into @c memory, @c False to race
+           from what it holds
+    @param settings The course memory settings from the calibration file,
+           used when racing
+    @param limit_s The longest time to allow, s
+    @param off_course Distance from the line in ft at which the robot is
+           taken to have run off the course
+
+    @return A dictionary with the lap time @c "time" in s, or @c None if
+            the robot ran off, the top speed @c "v_max" in ft/s and the
+            number of outer loop runs in which no sensor saw the line
+            @c "lost"
+    """
+    line = PID(3, 0.15, 0.1, 10, 10)
+    x, y = points[0]
+    heading = math.atan2(points[1][1] - y, points[1][0] - x)
+    v = yaw = 0.0
+    v_set = yaw_set = 0.0
+    idx = 0
+    top = 0.0
+    lost = 0
+    ticks_per_outer = round(OUTER_DT / INNER_DT)
+    tick = 0
+    odometer = 0.0
+    racing = memory is not None and not learn
+    if racing:
+        planner.v_max = settings["v_max"]
+    while tick * INNER_DT < limit_s:
+        if tick % ticks_per_outer == 0:
+            # Nearest course point to the sensor, searching forward from
+            # the last one
+            sx = x + SENSOR_AHEAD * math.cos(heading)
+            sy = y + SENSOR_AHEAD * math.sin(heading)
+            best = idx
+            best_d = math.inf
+            for j in range(max(0, idx - 20), min(len(points), idx + 200)):
+                d = (points[j][0] - sx) ** 2 + (points[j][1] - sy) ** 2
+                if d < best_d:
+                    best, best_d = j, d
+            idx = best
+            if idx >= len(points) - 1:
+                return {"time": tick * INNER_DT, "v_max": top, "lost": lost}
+            if math.sqrt(best_d) > off_course:
+                return {"time": None, "v_max": top, "lost": lost}
+
+            # Line position to the left of the sensor's center, ft
+            offset = (-(points[idx][0] - sx) * math.sin(heading)
+                      + (points[idx][1] - sy) * math.cos(heading))
+            readings = [1 if abs((3.5 - i) * SENSOR_PITCH - offset)
+                        < LINE_WIDTH / 2 else 0 for i in range(8)]
+            total = sum(readings)
+            centroid = (sum(i * r for i, r in enumerate(readings)) / total
+                        if total else 0)
+            if centroid > 0:
+                yaw_set = line.update(3.5, centroid, OUTER_DT)
+                line_error = centroid - 3.5
+            else:
+                yaw_set = 0
+                line_error = 3.5
+                lost += 1
+            v_set = planner.update(line_error, yaw, OUTER_DT)
+
+            # As main.outer_loop_task does with the course memory
+            if learn:
+                memory.record(odometer, v, yaw, 0 if total else 1)
+            elif racing:
+                ahead = odometer + settings["preview_ft"]
+                v_set = min(v_set, memory.speed_at(ahead))
+                yaw_set += (settings["yaw_feedforward"] * v
+                            * memory.curvature_at(ahead))
+
+        v += (v_set - v) * INNER_DT / TAU_V
+        yaw += (yaw_set - yaw) * INNER_DT / TAU_YAW
+
+        # Each wheel saturates on its own at its motor's top speed, so a
+        # fast turn gets less yaw rate than it asked for
+        left = max(-WHEEL_MAX, min(WHEEL_MAX, v - yaw * HALF_TRACK))
+        right = max(-WHEEL_MAX, min(WHEEL_MAX, v + yaw * HALF_TRACK))
+        v = (left + right) / 2
+        yaw = (right - left) / (2 * HALF_TRACK)
+        heading += yaw * INNER_DT
+        x += v * math.cos(heading) * INNER_DT
+        y += v * math.sin(heading) * INNER_DT
+        odometer += v * INNER_DT
+        top = max(top, v)
+        tick += 1
+    return {"time": None, "v_max": top, "lost": lost}
+
+
+if __name__ == "__main__":
+    cal_name = sys.argv[1] if len(sys.argv) > 1 else CALIBRATION_FILE
+    upy_host.install()
+    from speed_planner import SpeedPlanner
+    from course_memory import CourseMemory
+
+    with open(cal_name) as cal_file:
+        calibration = json.load(cal_file)
+    settings = calibration.get("speed_planner", {})
+    memory_settings = calibration.get("course_memory")
+    course = build_course(DEFAULT_COURSE)
+    length = sum(math.dist(a, b) for a, b in zip(course, course[1:]))
+
+    # The learning lap is the speed planner lap, then the race lap is
+    # driven from what it learned, as on the board
+    memory = CourseMemory()
+    memory.learn()
+    laps = [("Constant 0.4 ft/s", SpeedPlanner(), {}),
+            ("Speed planner", SpeedPlanner(**settings),
+             {"memory": memory, "learn": True})]
+    if memory_settings is not None:
+        laps.append(("Race from memory", SpeedPlanner(**settings),
+                     {"memory": memory, "settings": memory_settings}))
+
+    print(f"Course {length:.1f} ft")
+    print("SETPOINT              LAP TIME   TOP SPEED   LINE LOST")
+    base = None
+    for name, planner, options in laps:
+        if name == "Race from memory":
+            memory.plan(planner.v_min, memory_settings["v_max"],
+                        memory_settings["a_lat"], memory_settings["decel"])
+        lap = run_lap(course, planner, **options)
+        if lap["time"] is None:
+            print(f"{name:<20s}  ran off the course")
+            continue
+        gain = ("" if base is None else
+                f"  {100 * (1 - lap['time'] / base):.0f}% faster")
+        base = base or lap["time"]
+        print(f"{name:<20s}{lap['time']: 9.2f} s{lap['v_max']: 9.2f} ft/s"
+              f"{lap['lost']: 9d}{gain}")
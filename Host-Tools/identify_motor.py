@@ -0,0 +1,146 @@
+"""!
+@file identify_motor.py
+@brief Fits the motor feedforward model used by @c main.py to a logged run.
+
+@detail With @c LOG_MOTOR_DATA set, @c main.py saves the duty cycle which
+        the drive set, after clamping and slew, and the measured speed of
+        each wheel on every inner loop run to @c motor_log.csv. This script
+        keeps the samples in which a wheel was near steady state and fits,
+        for each wheel,
+        @code
+        |speed| = gain * (|duty| - offset)
+        @endcode
+        by least squares, then writes @c gain and @c offset into the
+        @c "motor_model" section of the calibration file, to be copied to the
+        board.
+
+        Run on the host computer:
+        @code
+        python identify_motor.py motor_log.csv [calibration.json]
+        @endcode
+"""
+
+import csv
+import json
+import os
+import sys
+
+## Samples whose speed differs from the neighbouring samples' by more than
+#  this, in rad/s, are taken to be accelerating and are left out of the fit.
+STEADY_TOLERANCE = 0.15
+
+## Samples slower than this, in rad/s, are left out; the wheel may be stuck
+#  in static friction.
+MIN_SPEED = 0.3
+
+## The default calibration file, the one kept with the board's files.
+CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'Romi-Files', 'calibration.json')
+
+
+def read_log(filename):
+    """!
+    @brief Reads a motor log saved by @c main.py.
+
+    @return Lists of (duty, speed) samples for the left and right wheels
+    """
+    left = []
+    right = []
+    with open(filename, newline='') as log_file:
+        for row in csv.DictReader(log_file):
+            left.append((float(row['duty_l']), float(row['speed_l'])))
+            right.append((float(row['duty_r']), float(row['speed_r'])))
+    return left, right
+
+
+def steady_samples(samples, tolerance=STEADY_TOLERANCE, min_speed=MIN_SPEED):
+    """!
+    @brief Picks out samples in which the wheel speed was steady.
+
+    @param samples A list of (duty, speed) samples in time order
+    @param tolerance The largest change in speed from either neighbouring
+           sample, in rad/s
+    @param min_speed The slowest speed kept, in rad/s
+
+    @return A list of (|duty|, |speed|) pairs
+    """
+    steady = []
+    for idx in range(1, len(samples) - 1):
+        duty, speed = samples[idx]
+        if (abs(speed) >= min_speed and duty * speed > 0
+                and abs(speed - samples[idx - 1][1]) <= tolerance
+                and abs(speed - samples[idx + 1][1]) <= tolerance):
+            steady.append((abs(duty), abs(speed)))
+    return steady
+
+
+def fit(samples):
+    """!
+    @brief Fits the motor model to steady state samples by least squares.
+
+    @param samples A list of (|duty|, |speed|) pairs
+
+    @return A (gain, offset) pair, with gain in rad/s per percent duty and
+            offset in percent duty, or @c None if the samples don't cover
+            at least two different duty cycles
+    """
+    num = len(samples)
+    if num < 2:
+        return None
+    mean_d = sum(d for d, s in samples) / num
+    mean_s = sum(s for d, s in samples) / num
+    var_d = sum((d - mean_d) ** 2 for d, s in samples)
+    if var_d < 1e-9:
+        return None
+    gain = sum((d - mean_d) * (s - mean_s) for d, s in samples) / var_d
+    if gain <= 0:
+        return None
+    # speed = gain * duty + intercept, and intercept = -gain * offset
+    return gain, mean_d - mean_s / gain
+
+
+def save(filename, left, right):
+    """!
+    @brief Writes fitted models into the @c "motor_model" section of a
+           calibration file, keeping its other sections and line endings.
+    """
+    newline = "\n"
+    try:
+        with open(filename, newline="") as cal_file:
+            text = cal_file.read()
+        if "\r\n" in text:
+            newline = "\r\n"
+        data = json.loads(text)
+    except (OSError, ValueError):
+        data = {}
+    data["motor_model"] = {"left_gain": round(left[0], 5),
+                           "left_offset": round(left[1], 3),
+                           "right_gain": round(right[0], 5),
+                           "right_offset": round(right[1], 3)}
+    with open(filename, "w", newline=newline) as cal_file:
+        json.dump(data, cal_file, indent=4)
+        cal_file.write("\n")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python identify_motor.py motor_log.csv "
+              "[calibration.json]")
+        sys.exit(2)
+    cal_name = sys.argv[2] if len(sys.argv) > 2 else CALIBRATION_FILE
+
+    models = []
+    for name, samples in zip(("Left", "Right"), read_log(sys.argv[1])):
+        steady = steady_samples(samples)
+        model = fit(steady)
+        if model is None:
+            print(f"{name}: only {len(steady)} usable samples; log a run "
+                  "at several different speeds")
+            sys.exit(1)
+        print(f"{name:<6s} gain {model[0]:.4f} rad/s per %, offset "
+              f"{model[1]:.2f} %, from {len(steady)} of {len(samples)} "
+              "samples")
+        models.append(model)
+
+    save(cal_name, models[0], models[1])
+    print(f"Saved to {os.path.normpath(cal_name)}")
@@ -0,0 +1,235 @@
+"""!
+@file motor_model.py
+@brief A simple model of a Romi drive motor, used to check the @c Motor
+       output stage on the host computer.
+
+@detail The model is a first order system whose steady state speed is
+        proportional to the part of the duty cycle above a static friction
+        deadband. It is meant for comparing control ideas, not for exact
+        prediction; fit its constants to logged data with
+        @c identify_motor.py where that matters.
+
+        Run on the host computer to compare drive commands with and without
+        slew limiting and deadband compensation:
+        @code
+        python motor_model.py [slew] [deadband]
+        @endcode
+        The speed tracking runs use a PI loop tuned to the model, with a
+        feedforward from its gain but not its deadband, so the loop tracks
+        without an output stage and what each stage changes shows up in the
+        error, settling time, effort and slips.
+"""
+
+import sys
+
+import upy_host
+
+## Gains of the simulated speed loop, percent duty per rad/s and per rad.
+#  The gains of @c main.py are far lower, because there the feedforward
+#  gives most of the duty, and with the model's gain they leave the loop
+#  inside the deadband.
+KP = 8.0
+KI = 40.0
+
+## Speed error within which a setpoint counts as reached, as a share of the
+#  setpoint, and at least this many rad/s.
+SETTLE_SHARE = 0.1
+SETTLE_MIN = 0.1
+
+
+class MotorModel:
+    """!
+    @brief A first order motor and wheel with a static friction deadband.
+    """
+
+    def __init__(self, gain=0.17, deadband=8.0, tau=0.08, max_accel=60.0):
+        """!
+        @brief Sets the constants of the model.
+
+        @param gain Steady state wheel speed in rad/s per percent of duty
+               above the deadband
+        @param deadband Duty in percent below which the motor doesn't turn
+        @param tau Time constant of the motor's speed response in seconds
+        @param max_accel Wheel angular acceleration in rad/s^2 above which
+               the tire is taken to slip on the floor
+        """
+        self.gain = gain
+        self.deadband = deadband
+        self.tau = tau
+        self.max_accel = max_accel
+        self.speed = 0.0
+        self.accel = 0.0
+
+    def steady_speed(self, duty):
+        """!
+        @brief Returns the speed the wheel settles at for a duty cycle.
+        """
+        if duty > self.deadband:
+            return self.gain * (duty - self.deadband)
+        if duty < -self.deadband:
+            return self.gain * (duty + self.deadband)
+        return 0.0
+
+    def step(self, duty, dt):
+        """!
+        @brief Moves the model forward in time at a constant duty cycle.
+
+        @param duty The duty cycle applied, -100 to 100
+        @param dt The time step in seconds
+
+        @return The wheel speed in rad/s at the end of the step
+        """
+        self.accel = (self.steady_speed(duty) - self.speed) / self.tau
+        self.speed += self.accel * dt
+        return self.speed
+
+    def slipping(self):
+        """!
+        @brief Returns @c True if the last step accelerated the wheel hard
+               enough to slip.
+        """
+        return abs(self.accel) > self.max_accel
+
+
+def applied_duty(motor):
+    """!
+    @brief Reads the duty cycle a @c Motor has written to its stand-in timer.
+    """
+    duty = 100 * motor.CH1.pulse_width() / (motor.CH1._timer.period() + 1)
+    return -duty if motor.DIR.value() else duty
+
+
+def run_commands(motor, model, commands, dt=0.01, ticks_per_command=None):
+    """!
+    @brief Drives the model through a @c Motor with a list of duty commands.
+
+    @param motor The @c Motor object, set up on @c upy_host stand-ins
+    @param model The @c MotorModel to drive
+    @param commands A list of (duty, number of ticks) pairs
+    @param dt The control period in seconds
+
+    @return A dictionary with the total change in applied duty @c "effort"
+            and the number of ticks in which the wheel slipped @c "slips"
+    """
+    effort = 0.0
+    slips = 0
+    last = 0.0
+    for duty, ticks in commands:
+        for _ in range(ticks):
+            motor.set_duty_fast(duty)
+            applied = applied_duty(motor)
+            effort += abs(applied - last)
+            last = applied
+            model.step(applied, dt)
+            slips += model.slipping()
+    return {"effort": effort, "slips": slips}
+
+
+def track_speed(motor, model, controller, setpoints, dt=0.01):
+    """!
+    @brief Runs a speed controller through a @c Motor against the model.
+
+    @param motor The @c Motor object, set up on @c upy_host stand-ins
+    @param model The @c MotorModel to drive
+    @param controller An object with an @c update(setpoint, measured, dt)
+           method, such as @c main.PIDController
+    @param setpoints A list of (speed in rad/s, number of ticks) pairs
+    @param dt The control period in seconds
+
+    @return A dictionary with the root mean square speed error @c "rms" in
+            rad/s, the total time taken to settle at the setpoints
+            @c "settle" in s, the total change in applied duty @c "effort"
+            and the number of ticks in which the wheel slipped @c "slips"
+    """
+    err_sq = 0.0
+    effort = 0.0
+    slips = 0
+    ticks = 0
+    settle = 0
+    last = 0.0
+    for setpoint, num in setpoints:
+        band = max(SETTLE_SHARE * abs(setpoint), SETTLE_MIN)
+        settled = 0
+        for tick in range(num):
+            motor.set_duty_fast(controller.update(setpoint, model.speed, dt))
+            applied = applied_duty(motor)
+            effort += abs(applied - last)
+            last = applied
+            model.step(applied, dt)
+            slips += model.slipping()
+            err_sq += (setpoint - model.speed) ** 2
+            ticks += 1
+            if abs(setpoint - model.speed) > band:
+                settled = tick + 1
+        settle += settled
+    return {"rms": (err_sq / ticks) ** 0.5, "settle": settle * dt,
+            "effort": effort, "slips": slips}
+
+
+def bare_command(duty, deadband):
+    """!
+    @brief Finds the command which, with deadband compensation, applies a
+           duty cycle to the motor.
+
+    @param duty The duty cycle to apply
+    @param deadband The deadband compensation set in the @c Motor
+    """
+    if abs(duty) <= deadband:
+        return 0.0
+    command = (abs(duty) - deadband) * 100 / (100 - deadband)
+    return command if duty > 0 else -command
+
+
+if __name__ == "__main__":
+    slew = float(sys.argv[1]) if len(sys.argv) > 1 else 4.0
+    deadband = float(sys.argv[2]) if len(sys.argv) > 2 else 8.0
+
+    upy_host.install()
+    from pyb import Timer, Pin
+    from motor import Motor
+
+    # Minimal PI loop like main.PIDController plus main.MotorFeedforward,
+    # so main.py's hardware setup doesn't have to run. The feedforward has
+    # the model's gain but leaves the deadband to the loop or the output
+    # stage
+    class SpeedLoop:
+        def __init__(self, kp, ki, ff_gain, limit=100):
+            self.kp, self.ki, self.ff_gain = kp, ki, ff_gain
+            self.limit = limit
+            self.integral = 0.0
+
+        def update(self, setpoint, measured, dt):
+            error = setpoint - measured
+            self.integral = max(-self.limit, min(self.limit,
+                                                 self.integral + error * dt))
+            out = (setpoint / self.ff_gain + self.kp * error
+                   + self.ki * self.integral)
+            return max(-100, min(100, out))
+
+    # The round block reverse, turn and stop durations from main.py. The
+    # duties were tuned on the bare motor, so with deadband compensation
+    # they're given as the commands which apply the same duties
+    maneuver = [(-23, 75), (23, 58), (-20, 50), (0, 50)]
+    speeds = [(3.5, 150), (-3.5, 150), (1.0, 150), (0.0, 100)]
+
+    print("STAGE                  MANEUVER             SPEED TRACKING")
+    print("                     EFFORT  SLIPS   RMS ERR  SETTLE  EFFORT  SLIPS")
+    for name, stage in (("none", (0, 0)), ("slew", (slew, 0)),
+                        ("deadband", (0, deadband)),
+                        ("slew + deadband", (slew, deadband))):
+        motor = Motor(Timer(1, freq=20000), Pin.cpu.A8, Pin.cpu.B10,
+                      Pin.cpu.B4)
+        motor.set_output_stage(*stage)
+        commands = [(bare_command(duty, stage[1]), ticks)
+                    for duty, ticks in maneuver]
+        man = run_commands(motor, MotorModel(deadband=deadband), commands)
+
+        model = MotorModel(deadband=deadband)
+        motor = Motor(Timer(1, freq=20000), Pin.cpu.A8, Pin.cpu.B10,
+                      Pin.cpu.B4)
+        motor.set_output_stage(*stage)
+        trk = track_speed(motor, model, SpeedLoop(KP, KI, model.gain),
+                          speeds)
+        print(f"{name:<17s}{man['effort']: 10.1f}{man['slips']: 7d}"
+              f"{trk['rms']: 10.3f}{trk['settle']: 7.2f} s"
+              f"{trk['effort']: 8.1f}{trk['slips']: 7d}")
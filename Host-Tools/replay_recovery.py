@@ -0,0 +1,157 @@
+"""!
+@file replay_recovery.py
+@brief Replays line sensor scans through @c line_recovery.LineRecovery.
+
+@detail With @c LOG_LINE_SCANS set, @c main.py saves the distance driven,
+        the yaw rate and which sensors saw the line on every outer loop run
+        to @c line_scans.csv. Replaying that file shows when the recovery
+        states changed and what they asked the robot to do, so the recovery
+        settings in a calibration file can be tried on the host before they
+        go on the board.
+
+        Without a file, two made up runs are replayed: a dashed line, which
+        should be bridged without leaving @c TRACKING and @c BRIDGING, and a
+        line which ends, which should be searched for and then given up.
+
+        Run on the host computer:
+        @code
+        python replay_recovery.py [line_scans.csv] [calibration.json]
+        @endcode
+"""
+
+import csv
+import json
+import os
+import sys
+
+import upy_host
+from course_sim import PID
+
+## The default calibration file, the one kept with the board's files.
+CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'Romi-Files', 'calibration.json')
+
+## The outer loop period in seconds.
+DT = 0.03
+
+
+def read_scans(filename):
+    """!
+    @brief Reads a scan log saved by @c main.py.
+
+    @return A list of (distance, yaw rate, sensor bits) rows
+    """
+    with open(filename, newline='') as log_file:
+        return [(float(row['distance']), float(row['yaw_rate']),
+                 int(row['sensors'])) for row in csv.DictReader(log_file)]
+
+
+class Replay:
+    """!
+    @brief Runs scans through line recovery as @c main.outer_loop_task does,
+           printing each change of state.
+    """
+
+    def __init__(self, recovery):
+        from line_recovery import STATE_NAMES
+        self.recovery = recovery
+        self.names = STATE_NAMES
+        self.line = PID(3, 0.15, 0.1, 10, 10)
+
+        ## The number of outer loop runs spent in each state, by state name
+        self.runs = {name: 0 for name in STATE_NAMES}
+        self.last = None
+        self.time = 0.0
+
+    def step(self, distance, yaw_rate, sensors):
+        """!
+        @brief Runs one scan through line recovery.
+
+        @param distance The distance driven, ft
+        @param yaw_rate The measured yaw rate, rad/s
+        @param sensors The sensors which see the line, as bits
+        """
+        recovery = self.recovery
+        readings = [(sensors >> i) & 1 for i in range(8)]
+        count = sum(readings)
+        if count:
+            centroid = sum(i * r for i, r in enumerate(readings)) / count
+            line_yaw = self.line.update(3.5, centroid, DT)
+            line_error = centroid - 3.5
+        else:
+            line_yaw = line_error = 0
+        state = recovery.update(count > 0, line_yaw, line_error, distance,
+                                yaw_rate, DT)
+        self.runs[self.names[state]] += 1
+        if state != self.last:
+            limit = ("none" if recovery.speed_limit >= 100
+                     else f"{recovery.speed_limit:.2f} ft/s")
+            print(f"  {self.time: 7.2f} s {distance: 7.2f} ft  "
+                  f"{self.names[state]:<10s}yaw {recovery.yaw: 6.2f} rad/s"
+                  f"  speed limit {limit}")
+            self.last = state
+        self.time += DT
+
+
+def replay_log(scans, recovery):
+    """!
+    @brief Replays a scan log.
+
+    @param scans A list of (distance, yaw rate, sensor bits) rows
+    @param recovery The @c LineRecovery to run
+
+    @return The number of outer loop runs spent in each state, by state name
+    """
+    replay = Replay(recovery)
+    for distance, yaw_rate, sensors in scans:
+        replay.step(distance, yaw_rate, sensors)
+    return replay.runs
+
+
+def replay_dashes(recovery, dash_ft, gap_ft, end_ft=None, speed=1.0,
+                  seconds=5.0):
+    """!
+    @brief Drives along a made up dashed line, moving and turning as line
+           recovery asks.
+
+    @param recovery The @c LineRecovery to run
+    @param dash_ft Length of each dash, ft
+    @param gap_ft Length of each gap, ft
+    @param end_ft Distance after which there is no more line, or @c None
+    @param speed Forward speed when recovery doesn't limit it, ft/s
+    @param seconds Time to drive, s
+
+    @return The number of outer loop runs spent in each state, by state name
+    """
+    replay = Replay(recovery)
+    distance = 0.0
+    while replay.time < seconds:
+        on_dash = distance % (dash_ft + gap_ft) < dash_ft
+        if end_ft is not None and distance >= end_ft:
+            on_dash = False
+        replay.step(distance, recovery.yaw, 0b00011000 if on_dash else 0)
+        distance += min(speed, recovery.speed_limit) * DT
+    return replay.runs
+
+
+if __name__ == "__main__":
+    log_name = sys.argv[1] if len(sys.argv) > 1 else None
+    cal_name = sys.argv[2] if len(sys.argv) > 2 else CALIBRATION_FILE
+
+    upy_host.install()
+    from line_recovery import LineRecovery
+
+    with open(cal_name) as cal_file:
+        settings = json.load(cal_file).get("line_recovery", {})
+
+    if log_name is not None:
+        runs = [(log_name, lambda rec: replay_log(read_scans(log_name), rec))]
+    else:
+        runs = [("Dashed line", lambda rec: replay_dashes(rec, 0.3, 0.15)),
+                ("Line ends", lambda rec: replay_dashes(rec, 0.3, 0.15,
+                                                        end_ft=1.0))]
+    for name, run in runs:
+        print(f"{name}:")
+        counts = run(LineRecovery(**settings))
+        print("  runs in each state: " + ", ".join(
+            f"{state} {num}" for state, num in counts.items()))
@@ -0,0 +1,171 @@
+"""!
+@file run_maneuver.py
+@brief Runs the sequences of a maneuver file on a simulated Romi.
+
+@detail Each sequence is run by @c maneuver.Maneuver every 10 ms of virtual
+        time, as the inner loop task of @c main.py runs it, with the drive,
+        encoders, IMU, @c hold_velocity() and PID controllers of @c main.py
+        on the @c upy_host stand-ins. The wheels follow
+        @c motor_model.MotorModel and turn the encoder counters, and the
+        heading and yaw rate the IMU reports come from the wheel speeds, so
+        the step timeline, time taken and where the robot ends up can be
+        checked before a maneuver file is copied to the board.
+
+        Run on the host computer:
+        @code
+        python run_maneuver.py [maneuvers.json] [line_after_ms]
+        @endcode
+        The line sensor reports the line from @c line_after_ms into each
+        sequence, 4000 ms by default. The robot starts each sequence facing
+        away from the home heading, as it does at the finish.
+"""
+
+import math
+import os
+import sys
+
+import upy_host
+from motor_model import MotorModel, applied_duty
+from vsim import load_main
+
+## The maneuver file kept with the board's files.
+MANEUVER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'Romi-Files', 'maneuvers.json')
+
+## The inner loop period in seconds.
+DT = 0.01
+
+## Encoder counts per wheel revolution.
+COUNTS_PER_REV = 12 * 120
+
+
+class SimRobot:
+    """!
+    @brief A Romi whose wheels follow a @c MotorModel each, turning the
+           encoders and the IMU of @c main.py.
+    """
+
+    def __init__(self, main, clock, line_after_ms):
+        from kinematics import Kinematics
+        # Its own kinematics, as main.hold_velocity uses main.kinematics
+        self.kinematics = Kinematics(main.kinematics.wheel_radius,
+                                     main.kinematics.track_width)
+        self.drive = main.drive
+        self.timers = (main.encoder_left.tim, main.encoder_right.tim)
+        self.imu_regs = main.imu.controller.registers(main.imu.I2C_ADDR)
+        self.gyro_z = main.imu.GYRO_Z_LSB
+        self.euler_h = main.imu.EULER_H_LSB
+        self.clock = clock
+        self.line_after_us = line_after_ms * 1000
+        self.start_us = clock.us
+        self.models = (MotorModel(), MotorModel())
+        self.angles = [0.0, 0.0]
+        self.heading = math.pi
+        self.x = 0.0
+        self.y = 0.0
+        self.sense()
+
+    def read_heading(self):
+        return math.degrees(self.heading) % 360
+
+    def is_line(self):
+        return self.clock.us - self.start_us >= self.line_after_us
+
+    def sense(self):
+        """!
+        @brief Sets the encoder counters and the IMU's registers.
+        """
+        for timer, angle in zip(self.timers, self.angles):
+            # Encoder.get_speed gives minus the counter's rate
+            counts = int(angle * COUNTS_PER_REV / (2 * math.pi))
+            timer.counter(-counts & 0xFFFF)
+        # The IMU's heading increases clockwise; both are in 1/16 degree
+        heading_cw = round((360 - self.read_heading()) % 360 * 16) % 5760
+        yaw_rate = round(math.degrees(self.kinematics.yaw_rate) * 16)
+        self.imu_regs[self.euler_h:self.euler_h + 2] = heading_cw.to_bytes(
+            2, 'little', signed=True)
+        self.imu_regs[self.gyro_z:self.gyro_z + 2] = yaw_rate.to_bytes(
+            2, 'little', signed=True)
+
+    def step(self):
+        """!
+        @brief Moves the robot on by one inner loop period.
+        """
+        left = self.models[0].step(applied_duty(self.drive.left), DT)
+        right = self.models[1].step(applied_duty(self.drive.right), DT)
+        self.angles[0] += left * DT
+        self.angles[1] += right * DT
+        self.kinematics.forward(left, right)
+        self.heading += self.kinematics.yaw_rate * DT
+        self.x += self.kinematics.v * math.cos(self.heading) * DT
+        self.y += self.kinematics.v * math.sin(self.heading) * DT
+        self.clock.advance(DT * 1000000)
+        self.sense()
+
+
+def run_sequence(clock, main, name, filename, line_after_ms, limit_s=60):
+    """!
+    @brief Runs one sequence, printing a line as each step starts.
+
+    @param clock The @c VirtualClock returned by @c upy_host.install()
+    @param main The @c main module, imported by @c vsim.load_main()
+    @param name The name of the sequence
+    @param filename The maneuver file holding the sequence
+    @param line_after_ms The time into the sequence at which the line is seen
+    @param limit_s The longest time in seconds to let the sequence run
+
+    @return The time the sequence took in seconds
+    """
+    from maneuver import Maneuver, OP_NAMES, PARAMS_PER_STEP
+
+    robot = SimRobot(main, clock, line_after_ms)
+    maneuvers = Maneuver(main.drive, main.hold_velocity, main.heading_ccw,
+                         main.odometer, robot.is_line)
+    maneuvers.load(filename, {})
+    op_names = {code: op for op, code in OP_NAMES.items()}
+
+    # Start from standing, and through main.start_maneuver() as the inner
+    # loop task does
+    main.encoder_left.update()
+    main.encoder_right.update()
+    main.encoder_left.speed = main.encoder_right.speed = 0.0
+    main.left_motor_controller.reset()
+    main.right_motor_controller.reset()
+    main.maneuvers = maneuvers
+
+    print(f"{name}:")
+    start_us = clock.us
+    def elapsed_ms():
+        return (clock.us - start_us) / 1000
+
+    main.start_maneuver(name)
+    step = None
+    while maneuvers.running and clock.us - start_us < limit_s * 1000000:
+        if maneuvers.step != step:
+            step = maneuvers.step
+            base = PARAMS_PER_STEP * step
+            params = ", ".join(f"{p:g}" for p in
+                               maneuvers.params[base:base + PARAMS_PER_STEP])
+            print(f"  {elapsed_ms(): 8.0f} ms  step {step:<3d}"
+                  f"{op_names[maneuvers.ops[step]]:<10s}{params}")
+        # As the inner loop task does while a maneuver runs
+        main.encoder_left.update()
+        main.encoder_right.update()
+        maneuvers.run()
+        robot.step()
+    print(f"  {elapsed_ms(): 8.0f} ms  done at x {robot.x:.2f} ft, "
+          f"y {robot.y:.2f} ft, heading {robot.read_heading():.0f} deg")
+    return elapsed_ms() / 1000
+
+
+if __name__ == "__main__":
+    file_name = sys.argv[1] if len(sys.argv) > 1 else MANEUVER_FILE
+    line_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 4000
+
+    sim_clock = upy_host.install()
+    romi = load_main()
+    import json
+    with open(file_name) as maneuver_file:
+        names = list(json.load(maneuver_file))
+    for seq_name in names:
+        run_sequence(sim_clock, romi, seq_name, file_name, line_ms)
@@ -0,0 +1,238 @@
+"""!
+@file schedulability.py
+@brief Checks whether a set of cotask tasks can meet their deadlines.
+
+@detail Task statistics come either from a live @c cotask.TaskList or from a
+        profile saved with @c TaskList.export_profile(), such as the
+        @c profile.csv file which @c main.py writes when it stops. Each timed
+        task's deadline is taken to be its period. Because @c cotask is a
+        cooperative scheduler, a task which is ready can't start until the
+        task currently running yields, so response times are found with
+        non-preemptive response time analysis, in which each task can be
+        blocked by the longest run of any lower priority task. Tasks at the
+        same priority share the CPU round-robin and are counted as
+        interference. The Liu and Layland rate-monotonic and hyperbolic
+        utilization bounds are also reported for comparison.
+
+        Run on the host computer:
+        @code
+        python schedulability.py profile.csv [avg|max|p99]
+        @endcode
+        The optional second argument chooses which run time estimate is used
+        as each task's execution time; the default is @c max. The exit status
+        is 1 if any task may miss its deadline.
+"""
+
+import math
+import sys
+
+
+class TaskStats:
+    """!
+    @brief Profile statistics of one task, all times in microseconds.
+    """
+
+    def __init__(self, name, priority, period, runs, avg, worst, p99=None,
+                 latest=0):
+        """!
+        @brief Saves the statistics of a task.
+
+        @param name The name of the task
+        @param priority The task's priority; higher numbers run first
+        @param period The task's period in us, or @c None if it isn't timed
+        @param runs The number of times the task ran while profiled
+        @param avg The average run time
+        @param worst The longest run time seen
+        @param p99 The 99th percentile run time, or @c None if not known
+        @param latest The greatest lateness seen on the board
+        """
+        self.name = name
+        self.priority = priority
+        self.period = period
+        self.runs = runs
+        self.avg = avg
+        self.worst = worst
+        self.p99 = worst if p99 is None else p99
+        self.latest = latest
+
+    def wcet(self, estimate="max"):
+        """!
+        @brief Returns the run time used as the task's execution time.
+
+        @param estimate @c "avg", @c "max" or @c "p99"
+        """
+        if estimate == "avg":
+            return self.avg
+        if estimate == "p99":
+            return self.p99
+        return self.worst
+
+
+def _hist_percentile(hist, fraction, largest):
+    # Same estimate as cotask.hist_percentile(), which needs the board's
+    # utime module and so can't be imported here
+    total = sum(hist)
+    if total == 0:
+        return None
+    count = 0
+    for bucket, num in enumerate(hist):
+        count += num
+        if count >= fraction * total:
+            return min((1 << bucket) - 1, largest)
+    return largest
+
+
+def _average(run_sum, runs):
+    # cotask leaves the first two runs of each task out of the run time sum
+    # because they often include setup code
+    return run_sum / (runs - 2) if runs > 2 else 0
+
+
+def tasks_from_task_list(task_list):
+    """!
+    @brief Collects statistics from the tasks in a live @c cotask.TaskList.
+
+    @param task_list A task list whose tasks have been profiled
+
+    @return A list of @c TaskStats objects
+    """
+    tasks = []
+    for pri in task_list.pri_list:
+        for task in pri[2:]:
+            p99 = None
+            if len(task._run_hist):
+                p99 = _hist_percentile(task._run_hist, 0.99, task._slowest)
+            tasks.append(TaskStats(task.name, task.priority, task.period,
+                                   task._runs,
+                                   _average(task._run_sum, task._runs),
+                                   task._slowest, p99, task._latest))
+    return tasks
+
+
+def tasks_from_profile(text):
+    """!
+    @brief Collects statistics from a profile made by
+           @c TaskList.export_profile().
+
+    @param text The contents of the exported profile
+
+    @return A list of @c TaskStats objects
+    """
+    tasks = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split(',')
+        name, priority, period, runs, run_sum, slowest = fields[:6]
+        latest = int(fields[7])
+        runs = int(runs)
+        slowest = int(slowest)
+        p99 = None
+        if len(fields) > 8 and fields[8]:
+            hist = [int(n) for n in fields[8].split()]
+            p99 = _hist_percentile(hist, 0.99, slowest)
+        tasks.append(TaskStats(name, int(priority),
+                               int(period) if period else None, runs,
+                               _average(int(run_sum), runs), slowest, p99,
+                               latest))
+    return tasks
+
+
+def analyze(tasks, estimate="max"):
+    """!
+    @brief Finds utilization, utilization bounds and response times.
+
+    @param tasks A list of @c TaskStats objects
+    @param estimate Which run time to use as the execution time: @c "avg",
+           @c "max" or @c "p99"
+
+    @return A dictionary holding total utilization @c "util", the bounds
+            @c "ll_bound" and @c "hyperbolic", flags @c "ll_ok" and
+            @c "hyperbolic_ok", @c "rm_order" which is @c True if the
+            priorities are in rate-monotonic order, @c "schedulable", and
+            @c "tasks", a list with a dictionary for each timed task holding
+            its name, period, execution time @c "c", utilization, blocking
+            time, predicted worst lateness and response time, measured worst
+            lateness and whether its deadline is met
+    """
+    timed = [t for t in tasks if t.period]
+    util = sum(t.wcet(estimate) / t.period for t in timed)
+    num = len(timed)
+    ll_bound = num * (2 ** (1 / num) - 1) if num else 1.0
+    hyperbolic = 1.0
+    for t in timed:
+        hyperbolic *= t.wcet(estimate) / t.period + 1
+
+    # In rate-monotonic order, shorter periods have higher priorities
+    rm_order = all(a.priority >= b.priority or a.period >= b.period
+                   for a in timed for b in timed)
+
+    results = []
+    for task in timed:
+        c_i = task.wcet(estimate)
+        blocking = max((t.wcet(estimate) for t in tasks
+                        if t.priority < task.priority), default=0)
+        others = [t for t in timed
+                  if t is not task and t.priority >= task.priority]
+
+        # Iterate to find the longest time from release until the task
+        # starts; stop if it can't start within its period
+        start = blocking + sum(t.wcet(estimate) for t in others)
+        while start <= task.period:
+            new_start = blocking + sum(
+                (math.floor(start / t.period) + 1) * t.wcet(estimate)
+                for t in others)
+            if new_start == start:
+                break
+            start = new_start
+        response = start + c_i
+
+        results.append({"name": task.name, "period": task.period, "c": c_i,
+                        "util": c_i / task.period, "blocking": blocking,
+                        "lateness": start, "response": response,
+                        "measured_late": task.latest,
+                        "ok": response <= task.period})
+
+    return {"util": util, "ll_bound": ll_bound, "ll_ok": util <= ll_bound,
+            "hyperbolic": hyperbolic, "hyperbolic_ok": hyperbolic <= 2.0,
+            "rm_order": rm_order,
+            "schedulable": util <= 1.0 and all(r["ok"] for r in results),
+            "tasks": results}
+
+
+def report(result):
+    """!
+    @brief Formats the result of @c analyze() as a table.
+    """
+    lines = ["TASK              PERIOD         C   UTIL%     BLOCK  "
+             "PRED LATE  MEAS LATE  RESPONSE  OK"]
+    for r in result["tasks"]:
+        lines.append(f"{r['name']:<16s}{r['period'] / 1000: 8.1f}"
+                     f"{r['c'] / 1000: 10.3f}{100 * r['util']: 8.1f}"
+                     f"{r['blocking'] / 1000: 10.3f}"
+                     f"{r['lateness'] / 1000: 11.3f}"
+                     f"{r['measured_late'] / 1000: 11.3f}"
+                     f"{r['response'] / 1000: 10.3f}"
+                     f"  {'yes' if r['ok'] else 'NO'}")
+    lines.append(f"Utilization {100 * result['util']:.1f}%, "
+                 f"Liu-Layland bound {100 * result['ll_bound']:.1f}% "
+                 f"({'met' if result['ll_ok'] else 'exceeded'}), "
+                 f"hyperbolic product {result['hyperbolic']:.3f} "
+                 f"({'met' if result['hyperbolic_ok'] else 'exceeded'})")
+    if not result["rm_order"]:
+        lines.append("Priorities are not in rate-monotonic order")
+    lines.append("Schedulable" if result["schedulable"]
+                 else "NOT SCHEDULABLE: some deadlines may be missed")
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python schedulability.py profile.csv [avg|max|p99]")
+        sys.exit(2)
+    with open(sys.argv[1]) as f:
+        stats = tasks_from_profile(f.read())
+    result = analyze(stats, sys.argv[2] if len(sys.argv) > 2 else "max")
+    print(report(result))
+    sys.exit(0 if result["schedulable"] else 1)
@@ -0,0 +1,73 @@
+"""!
+@file trace_decode.py
+@brief Decodes binary task traces written by @c cotask.Task.dump_trace().
+
+@detail Run on the host computer after copying the trace file off the board:
+        @code
+        python trace_decode.py trace.bin
+        @endcode
+"""
+
+import struct
+import sys
+
+# These must match the constants in cotask.py
+TRACE_HEADER = '<4sBBHI'
+TRACE_MAGIC = b'CTRC'
+
+
+def decode_traces(data):
+    """!
+    @brief Splits a buffer of one or more trace dumps into per-task traces.
+
+    @param data Bytes read from a file written by @c TaskList.dump_traces()
+
+    @return A list of (name, dropped, pairs) tuples, one per task, where
+            @c dropped is the number of transitions overwritten on the board
+            and @c pairs is a list of (delta time in us, to-state) tuples
+    """
+    traces = []
+    head_size = struct.calcsize(TRACE_HEADER)
+    offset = 0
+    while offset < len(data):
+        magic, item_size, name_len, num, total = struct.unpack_from(
+            TRACE_HEADER, data, offset)
+        if magic != TRACE_MAGIC:
+            raise ValueError(f"Bad trace header at byte {offset}")
+        offset += head_size
+        name = data[offset:offset + name_len].decode()
+        offset += name_len
+
+        item_fmt = '<' + {2: 'h', 4: 'i', 8: 'q'}[item_size] * (2 * num)
+        items = struct.unpack_from(item_fmt, data, offset)
+        offset += item_size * 2 * num
+
+        pairs = list(zip(items[0::2], items[1::2]))
+        traces.append((name, total - num, pairs))
+    return traces
+
+
+def format_trace(name, dropped, pairs):
+    """!
+    @brief Formats one decoded trace the same way as @c Task.get_trace().
+    """
+    lines = [f"Task {name}:"]
+    if dropped > 0:
+        lines.append(f"  ({dropped} earlier transitions overwritten)")
+    last_state = None if dropped > 0 else 0
+    total_time = 0.0
+    for delta, state in pairs:
+        if last_state is None:
+            lines.append(f"{total_time: 12.6f}:  ? -> {state:d}")
+        else:
+            total_time += delta / 1000000.0
+            lines.append(f"{total_time: 12.6f}: {last_state: 2d} -> {state:d}")
+        last_state = state
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    for filename in sys.argv[1:]:
+        with open(filename, 'rb') as f:
+            for trace in decode_traces(f.read()):
+                print(format_trace(*trace))
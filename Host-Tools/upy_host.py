@@ -0,0 +1,447 @@
+"""!
+@file upy_host.py
+@brief Lets the board's MicroPython files run on a host computer.
+
+@detail The files in @c Romi-Files import @c utime, @c micropython and
+        @c pyb, and use MicroPython additions to @c time and @c gc. Calling
+        @c install() puts stand-ins for these into @c sys.modules, all driven
+        by a @c VirtualClock, so that @c cotask, @c task_share and the other
+        files can be imported unmodified:
+        @code
+        import upy_host
+        clock = upy_host.install()
+        import cotask, task_share
+        @endcode
+        Time only passes when the clock is advanced, by a simulator such as
+        @c vsim.VirtualRuntime or by calls to @c pyb.udelay() and
+        @c pyb.delay(). Ticks wrap around as they do on the board, so code
+        which doesn't use @c ticks_diff() properly fails here too.
+
+        The @c pyb stand-in models pins, timers, I2C buses and external
+        interrupts only as far as needed to hold their state. Simulated
+        hardware, such as a model of the robot, reads and writes that state:
+        pins have an output latch @c _value and an input level @c _input,
+        timers have @c _counter and channels have @c _compare, and I2C buses
+        hold register contents in @c memory. Reading an input pin takes
+        @c PIN_READ_US of virtual time, so polling loops such as the one in
+        @c QTRX.read_sensor() end as they would on the board.
+        Pins and timer channels count their writes in @c writes so that
+        benchmarks can count hardware accesses.
+
+        Install the stand-ins once per process, before importing any of the
+        board's files, since those keep the modules they first imported.
+"""
+
+import gc
+import os
+import sys
+import time
+import types
+
+## MicroPython's tick counters wrap around at this value.
+TICKS_PERIOD = 1 << 30
+
+## Timer clock frequency used to find PWM periods, as on the STM32F4.
+TIMER_CLOCK = 84000000
+
+## Virtual time taken to read an input pin, in microseconds.
+PIN_READ_US = 1
+
+## The directory holding the board's files.
+ROMI_FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'Romi-Files')
+
+
+class VirtualClock:
+    """!
+    @brief A microsecond clock which only moves when told to.
+    """
+
+    def __init__(self):
+        ## The time in microseconds since the clock was created; unlike
+        #  ticks this never wraps around
+        self.us = 0
+
+    def advance(self, usec):
+        """!
+        @brief Moves the clock forward.
+
+        @param usec The number of microseconds to add to the time
+        """
+        self.us += int(usec)
+
+    def ticks_us(self):
+        return self.us % TICKS_PERIOD
+
+    def ticks_ms(self):
+        return (self.us // 1000) % TICKS_PERIOD
+
+
+def ticks_diff(ticks1, ticks2):
+    """!
+    @brief Signed difference of two tick values, as in MicroPython.
+    """
+    half = TICKS_PERIOD // 2
+    return ((ticks1 - ticks2 + half) % TICKS_PERIOD) - half
+
+
+def ticks_add(ticks, delta):
+    """!
+    @brief Adds a possibly negative number to a tick value, as in MicroPython.
+    """
+    return (ticks + delta) % TICKS_PERIOD
+
+
+class Heap:
+    """!
+    @brief A stand-in for the board's heap used by the @c gc additions.
+
+    @detail CPython's memory use says nothing about the board's, so the
+            amount free is whatever a simulation sets it to.
+    """
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.allocated = 0
+        self.threshold = -1
+
+    def mem_free(self):
+        return self.size - self.allocated
+
+    def mem_alloc(self):
+        return self.allocated
+
+
+# -----------------------------------------------------------------------------
+# pyb stand-in
+
+class _CpuPins:
+    # Pin.cpu.A8 and so on are just the pin names
+    def __getattr__(self, name):
+        return name
+
+
+class Pin:
+    """!
+    @brief A GPIO pin which remembers its value and counts writes.
+    """
+    IN = 0
+    OUT_PP = 1
+    OUT_OD = 2
+    AF_PP = 3
+    ANALOG = 4
+    PULL_NONE = 0
+    PULL_UP = 1
+    PULL_DOWN = 2
+    cpu = _CpuPins()
+    board = _CpuPins()
+
+    ## The virtual clock, set by install()
+    clock = None
+
+    def __init__(self, pin_id, mode=IN, pull=PULL_NONE, **kwargs):
+        self._name = pin_id.name() if isinstance(pin_id, Pin) else pin_id
+        self._mode = mode
+        self._pull = pull
+        self._value = 0
+        self._input = 1 if pull == Pin.PULL_UP else 0
+        self.writes = 0
+
+    def init(self, mode=IN, pull=PULL_NONE, **kwargs):
+        self._mode = mode
+        self._pull = pull
+
+    def value(self, val=None):
+        if val is None:
+            if self._mode != Pin.IN:
+                return self._value
+            Pin.clock.advance(PIN_READ_US)
+            return self._input() if callable(self._input) else self._input
+        self._value = 1 if val else 0
+        self.writes += 1
+
+    def high(self):
+        self.value(1)
+
+    def low(self):
+        self.value(0)
+
+    def name(self):
+        return self._name
+
+
+class TimerChannel:
+    """!
+    @brief A timer channel holding a PWM compare value and callback.
+    """
+
+    def __init__(self, timer, number, mode, pin):
+        self._timer = timer
+        self._number = number
+        self._mode = mode
+        self._pin = pin
+        self._compare = 0
+        self._callback = None
+        self.writes = 0
+
+    def pulse_width(self, width=None):
+        if width is None:
+            return self._compare
+        self._compare = int(width)
+        self.writes += 1
+
+    def pulse_width_percent(self, percent=None):
+        top = self._timer.period() + 1
+        if percent is None:
+            return 100 * self._compare / top
+        self._compare = int(percent * top / 100)
+        self.writes += 1
+
+    def compare(self, value=None):
+        return self.pulse_width(value)
+
+    def callback(self, fun):
+        self._callback = fun
+
+
+class Timer:
+    """!
+    @brief A hardware timer with a counter which simulations may set.
+    """
+    PWM = 0
+    PWM_INVERTED = 1
+    OC_TIMING = 2
+    IC = 3
+    ENC_A = 4
+    ENC_B = 5
+    ENC_AB = 6
+    UP = 0
+
+    def __init__(self, number, freq=None, prescaler=0, period=0xFFFF,
+                 callback=None, **kwargs):
+        self._number = number
+        self._prescaler = prescaler
+        if freq is not None:
+            self._freq = freq
+            self._period = TIMER_CLOCK // int(freq) - 1
+        else:
+            self._period = period
+            self._freq = TIMER_CLOCK / ((prescaler + 1) * (period + 1))
+        self._counter = 0
+        self._callback = callback
+        self.channels = {}
+
+    def init(self, freq=None, prescaler=0, period=0xFFFF, callback=None,
+             **kwargs):
+        self.__init__(self._number, freq, prescaler, period, callback)
+
+    def channel(self, number, mode=None, pin=None, **kwargs):
+        if mode is None:
+            return self.channels.get(number)
+        chan = TimerChannel(self, number, mode, pin)
+        self.channels[number] = chan
+        return chan
+
+    def counter(self, value=None):
+        if value is None:
+            return self._counter
+        self._counter = value
+
+    def period(self, value=None):
+        if value is None:
+            return self._period
+        self._period = value
+
+    def freq(self):
+        return self._freq
+
+    def callback(self, fun):
+        self._callback = fun
+
+    def deinit(self):
+        self._callback = None
+
+
+class I2C:
+    """!
+    @brief An I2C bus whose devices are 256 byte register maps.
+
+    @detail Every @c I2C object made for the same bus number shares the same
+            registers, so a simulation can set sensor readings on any of them.
+    """
+    CONTROLLER = 0
+    PERIPHERAL = 1
+    MASTER = 0
+    SLAVE = 1
+    _buses = {}
+
+    def __init__(self, bus, mode=CONTROLLER, **kwargs):
+        self.memory = I2C._buses.setdefault(bus, {})
+
+    def init(self, mode=CONTROLLER, **kwargs):
+        pass
+
+    def registers(self, addr):
+        """!
+        @brief Returns the bytearray of registers of the device at an address.
+        """
+        return self.memory.setdefault(addr, bytearray(256))
+
+    def mem_read(self, data, addr, memaddr, **kwargs):
+        regs = self.registers(addr)
+        if isinstance(data, int):
+            return bytes(regs[memaddr:memaddr + data])
+        data[:] = regs[memaddr:memaddr + len(data)]
+        return data
+
+    def mem_write(self, data, addr, memaddr, **kwargs):
+        regs = self.registers(addr)
+        if isinstance(data, int):
+            data = bytes((data & 0xFF,))
+        regs[memaddr:memaddr + len(data)] = data
+
+    def scan(self):
+        return sorted(self.memory)
+
+
+class UART:
+    """!
+    @brief A serial port which keeps what is written to it.
+    """
+
+    def __init__(self, bus, baudrate=9600, **kwargs):
+        self.output = bytearray()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.output += data
+        return len(data)
+
+    def any(self):
+        return 0
+
+    def read(self, nbytes=None):
+        return None
+
+
+class ExtInt:
+    """!
+    @brief An external interrupt which a simulation fires with @c trigger().
+    """
+    IRQ_RISING = 0
+    IRQ_FALLING = 1
+    IRQ_RISING_FALLING = 2
+    all = []
+
+    def __init__(self, pin, mode, pull, callback):
+        self._pin = pin
+        self._callback = callback
+        ExtInt.all.append(self)
+
+    def trigger(self):
+        self._callback(self._pin)
+
+    def enable(self):
+        pass
+
+    def disable(self):
+        pass
+
+
+def _make_pyb(clock):
+    pyb = types.ModuleType('pyb')
+    pyb.Pin = Pin
+    pyb.Timer = Timer
+    pyb.I2C = I2C
+    pyb.UART = UART
+    pyb.ExtInt = ExtInt
+    pyb.disable_irq = lambda: True
+    pyb.enable_irq = lambda state=True: None
+    pyb.repl_uart = lambda uart=None: None
+    pyb.micros = clock.ticks_us
+    pyb.millis = clock.ticks_ms
+    pyb.elapsed_micros = lambda start: ticks_diff(clock.ticks_us(), start)
+    pyb.elapsed_millis = lambda start: ticks_diff(clock.ticks_ms(), start)
+    pyb.udelay = clock.advance
+    pyb.delay = lambda ms: clock.advance(ms * 1000)
+    pyb.main = lambda filename: None
+    return pyb
+
+
+def _make_utime(clock):
+    utime = types.ModuleType('utime')
+    utime.ticks_us = clock.ticks_us
+    utime.ticks_ms = clock.ticks_ms
+    utime.ticks_cpu = clock.ticks_us
+    utime.ticks_diff = ticks_diff
+    utime.ticks_add = ticks_add
+    utime.sleep_us = clock.advance
+    utime.sleep_ms = lambda ms: clock.advance(ms * 1000)
+    utime.sleep = lambda sec: clock.advance(sec * 1000000)
+    utime.time = lambda: clock.us // 1000000
+    return utime
+
+
+def _make_micropython(pending):
+    mpy = types.ModuleType('micropython')
+    mpy.native = lambda fun: fun
+    mpy.viper = lambda fun: fun
+    mpy.const = lambda value: value
+    mpy.alloc_emergency_exception_buf = lambda size: None
+    mpy.mem_info = lambda *args: None
+
+    # Scheduled functions are kept until a simulator runs them
+    def schedule(fun, arg):
+        pending.append((fun, arg))
+    mpy.schedule = schedule
+    mpy.pending = pending
+    return mpy
+
+
+def install(clock=None, heap=None):
+    """!
+    @brief Installs the MicroPython stand-ins and makes the board's files
+           importable.
+
+    @detail Stand-ins for @c utime, @c micropython and @c pyb replace any
+            installed before. The @c time module gets the @c ticks_*
+            and @c sleep_ms functions of MicroPython's @c time, and @c gc
+            gets @c mem_free(), @c mem_alloc() and @c threshold(); the
+            standard functions of both are left as they are.
+
+    @param clock The @c VirtualClock to use, or @c None to make a new one
+    @param heap The @c Heap to report from @c gc, or @c None for a new one
+
+    @return The clock which drives the stand-ins
+    """
+    if clock is None:
+        clock = VirtualClock()
+    if heap is None:
+        heap = Heap()
+    utime = _make_utime(clock)
+    sys.modules['utime'] = utime
+    sys.modules['pyb'] = _make_pyb(clock)
+    sys.modules['micropython'] = _make_micropython([])
+
+    for name in ('ticks_us', 'ticks_ms', 'ticks_cpu', 'ticks_diff',
+                 'ticks_add', 'sleep_ms', 'sleep_us'):
+        setattr(time, name, getattr(utime, name))
+
+    gc.mem_free = heap.mem_free
+    gc.mem_alloc = heap.mem_alloc
+    def threshold(amount=None):
+        if amount is None:
+            return heap.threshold
+        heap.threshold = amount
+    gc.threshold = threshold
+    gc.heap = heap
+
+    Pin.clock = clock
+    I2C._buses.clear()
+    del ExtInt.all[:]
+
+    path = os.path.normpath(ROMI_FILES)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    return clock
@@ -0,0 +1,206 @@
+"""!
+@file vsim.py
+@brief Runs cotask task lists in virtual time on a host computer.
+
+@detail A @c VirtualRuntime runs the unmodified @c cotask scheduler against
+        the @c VirtualClock of @c upy_host. Each time a task runs, the clock
+        is moved forward by that task's execution cost; when no task is ready
+        the clock jumps straight to the next scheduled run. Runs are
+        therefore deterministic and much faster than real time, which makes
+        it possible to compare scheduling policies and to reproduce overruns.
+
+        Run on the host computer to simulate the tasks in @c main.py:
+        @code
+        python vsim.py [seconds] [inner_cost_us] [outer_cost_us]
+                       [sensing_cost_us] [supervisor_cost_us]
+        @endcode
+        The tasks are set up as in @c main.py, with the supervisor task
+        fitting the outer loop's period to the speed.
+"""
+
+import os
+import sys
+import time
+
+import upy_host
+
+
+class VirtualRuntime:
+    """!
+    @brief Runs a task list, charging each run of a task a cost in virtual
+           time.
+    """
+
+    def __init__(self, task_list, clock, costs=None, default_cost=100):
+        """!
+        @brief Sets up a simulation of the tasks in a task list.
+
+        @param task_list The @c cotask.TaskList to be run
+        @param clock The @c upy_host.VirtualClock which drives the tasks
+        @param costs A dictionary from task name to execution cost. A cost
+               is a number of microseconds or a function which is called
+               with the task and the number of times it has run and returns
+               a number of microseconds, which makes it easy to model
+               occasional long runs
+        @param default_cost The cost in microseconds of tasks which aren't
+               in @c costs; it must be at least 1
+        """
+        self.task_list = task_list
+        self.clock = clock
+        self.costs = costs if costs is not None else {}
+        self.default_cost = default_cost
+
+        ## Functions called at regular intervals, such as models of the
+        #  hardware, as [period_us, next_time_us, function] lists
+        self.hooks = []
+
+        ## The number of runs of each task, by name
+        self.runs = {}
+
+        self._ran = False
+        for pri in task_list.pri_list:
+            for task in pri[2:]:
+                task._run_gen = self._costed(task, task._run_gen)
+
+    def _costed(self, task, gen):
+        # Wrap a task's generator so that each run takes virtual time
+        cost = self.costs.get(task.name, self.default_cost)
+        runs = 0
+        for state in gen:
+            runs += 1
+            self.runs[task.name] = runs
+            self.clock.advance(cost(task, runs) if callable(cost) else cost)
+            self._ran = True
+            yield state
+
+    def every(self, period_us, fun):
+        """!
+        @brief Calls a function at regular intervals of virtual time.
+
+        @detail The function is called with the clock's time in microseconds.
+                Hooks run between task runs, as interrupts would on the board
+                at the resolution of task runs.
+
+        @param period_us The time between calls in microseconds
+        @param fun The function to call
+        """
+        self.hooks.append([period_us, self.clock.us + period_us, fun])
+
+    def _run_hooks(self):
+        for hook in self.hooks:
+            while hook[1] <= self.clock.us:
+                hook[2](hook[1])
+                hook[1] += hook[0]
+
+    def _run_scheduled(self):
+        # Run functions passed to micropython.schedule()
+        pending = sys.modules['micropython'].pending
+        while pending:
+            fun, arg = pending.pop(0)
+            fun(arg)
+
+    def _next_event(self):
+        # Find how long until a task is due or a hook needs to run
+        wait = None
+        for pri in self.task_list.pri_list:
+            for task in pri[2:]:
+                if task.go_flag:
+                    return 0
+                if task.period is not None:
+                    late = upy_host.ticks_diff(self.clock.ticks_us(),
+                                               task._next_run)
+                    if wait is None or -late < wait:
+                        wait = -late
+        for hook in self.hooks:
+            if wait is None or hook[1] - self.clock.us < wait:
+                wait = hook[1] - self.clock.us
+        return wait
+
+    def run(self, seconds):
+        """!
+        @brief Runs the tasks for a length of virtual time.
+
+        @param seconds The number of seconds of virtual time to run
+        """
+        end = self.clock.us + int(seconds * 1000000)
+        while self.clock.us < end:
+            self._run_hooks()
+            self._run_scheduled()
+            self._ran = False
+            self.task_list.pri_sched()
+            if not self._ran:
+                wait = self._next_event()
+                if wait is None:
+                    self.clock.us = end
+                else:
+                    self.clock.advance(max(1, min(wait + 1,
+                                                  end - self.clock.us)))
+
+
+def load_main():
+    """!
+    @brief Imports @c main.py with the hardware stand-ins from @c upy_host.
+
+    @detail @c install() must have been called first. Setup code in
+            @c main.py runs against the stand-ins; the code under
+            @c __name__ == "__main__" does not run. @c main.py opens
+            @c calibration.json and its other files from the current
+            directory, as on the board, so it is imported from
+            @c Romi-Files whichever directory the simulation was started
+            from. Without the calibration file @c main.py would quietly use
+            its defaults, so a missing file is an error here.
+
+    @return The imported @c main module
+    """
+    calibration = os.path.join(upy_host.ROMI_FILES, 'calibration.json')
+    if not os.path.isfile(calibration):
+        raise FileNotFoundError(f"No calibration file at {calibration}")
+    cwd = os.getcwd()
+    os.chdir(upy_host.ROMI_FILES)
+    try:
+        import main
+    finally:
+        os.chdir(cwd)
+    return main
+
+
+if __name__ == "__main__":
+    args = [float(a) for a in sys.argv[1:]]
+    sim_seconds = args[0] if len(args) > 0 else 600
+    inner_cost = args[1] if len(args) > 1 else 1500
+    outer_cost = args[2] if len(args) > 2 else 9000
+    sensing_cost = args[3] if len(args) > 3 else 3000
+    supervisor_cost = args[4] if len(args) > 4 else 100
+
+    clock = upy_host.install()
+    import cotask
+    main = load_main()
+
+    tasks = cotask.TaskList()
+    tasks.append(cotask.Task(main.inner_loop_task, name='InnerLoop',
+                             priority=2, period=10, profile=True,
+                             overrun=cotask.OVERRUN_SKIP))
+    tasks.append(cotask.Task(main.sensing_task, name='Sensing',
+                             priority=2,
+                             period=main.sensing_settings['period_ms'],
+                             profile=True, overrun=cotask.OVERRUN_SKIP))
+    task_outer = cotask.Task(main.outer_loop_task, name='OuterLoop',
+                             priority=1, period=main.outer_period.nominal_ms,
+                             profile=True, overrun=cotask.OVERRUN_SKIP)
+    tasks.append(task_outer)
+    tasks.append(cotask.Task(main.supervisor_task, name='Supervisor',
+                             priority=0, period=main.SUPERVISOR_PERIOD_MS,
+                             profile=True))
+    main.outer_period.govern(task_outer, tasks)
+    runtime = VirtualRuntime(tasks, clock, {'InnerLoop': inner_cost,
+                                            'Sensing': sensing_cost,
+                                            'OuterLoop': outer_cost,
+                                            'Supervisor': supervisor_cost})
+
+    start = time.perf_counter()
+    runtime.run(sim_seconds)
+    wall = time.perf_counter() - start
+
+    print(tasks)
+    print(f"{sim_seconds:.0f} s simulated in {wall:.2f} s "
+          f"({sim_seconds / wall:.0f}x real time)")
@@ -0,0 +1,52 @@
+import json
+
+
+class Calibration:
+    """
+    @brief Class to load robot parameters from a calibration file
+
+    @detail Parameters are kept in a JSON file on the board, default calibration.json, in named sections
+            such as "motor_model". Values missing from the file, or a missing file, fall back to defaults
+            given in code, so the robot still runs before it has been calibrated.
+
+    """
+
+    def __init__ (self, filename="calibration.json"):
+        """
+        @brief Reads the calibration file
+
+        @param filename = name of the calibration file on the board's filesystem
+
+        """
+        self.filename = filename
+        try:
+            with open(filename) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            # No file or a damaged one; use the defaults
+            self.data = {}
+
+    def section (self, name, defaults):
+        """
+        @brief Returns the parameters in one section of the file
+
+        @param name = name of the section
+
+        @param defaults = dictionary of default values; only keys in it are returned
+
+        """
+        values = self.data.get(name, {})
+        return {key: values.get(key, default) for key, default in defaults.items()}
+
+    def save_section (self, name, values):
+        """
+        @brief Replaces one section of the file and writes the file back
+
+        @param name = name of the section
+
+        @param values = dictionary of values to save
+
+        """
+        self.data[name] = values
+        with open(self.filename, "w") as f:
+            json.dump(self.data, f)
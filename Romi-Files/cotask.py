@@ -28,10 +28,93 @@
 #  POSSIBILITY OF SUCH DAMAGE.
 
 import gc                              # Memory allocation garbage collector
+import array                           # Preallocated storage for traces
+import struct                          # Packing of binary trace dumps
 import utime                           # Micropython version of time library
 import micropython                     # This shuts up incorrect warnings
 
 
+## The number of state transitions kept in a task's trace buffer when tracing
+#  is turned on with @c trace=True rather than with a buffer size.
+TRACE_SIZE = 100
+
+## Type code of the trace buffer; each transition takes two items of it.
+TRACE_TYPE = 'i'
+
+## Header written at the start of each task's binary trace dump: a magic
+#  string, trace item size in bytes, length of the task name, number of
+#  transitions in the dump and total number of transitions ever recorded.
+TRACE_HEADER = '<4sBBHI'
+
+## The most transitions a trace buffer may keep, as the number kept is written
+#  in 16 bits of @c TRACE_HEADER.
+TRACE_MAX_SIZE = 0xFFFF
+
+## Magic string which marks the start of a binary trace dump.
+TRACE_MAGIC = b'CTRC'
+
+## Overrun policy: after a task runs late by one or more whole periods, run
+#  it again for each period missed so that it catches up. This is the
+#  original behavior of the scheduler.
+OVERRUN_CATCH_UP = 0
+
+## Overrun policy: after a task runs late by one or more whole periods, skip
+#  the missed runs and schedule the next run at the next time which is a
+#  whole number of periods after the original schedule.
+OVERRUN_SKIP = 1
+
+## Overrun policy: after a task runs late by one or more whole periods, skip
+#  the missed runs and schedule the next run one period after now, so that
+#  the schedule is realigned to the time of the late run.
+OVERRUN_REALIGN = 2
+
+## The number of buckets in each run time and lateness histogram. Bucket 0
+#  counts times of 0 us, bucket @c b counts times from 2**(b-1) to
+#  2**b - 1 us, and the last bucket also counts everything longer.
+HIST_BUCKETS = 20
+
+## The shortest time in microseconds between checks of the free heap by the
+#  scheduler's garbage collection. @c gc.mem_free() scans the heap's
+#  allocation table, so it isn't called every time the scheduler looks for
+#  a task to run.
+GC_CHECK_US = 1000
+
+
+## Find the logarithmic histogram bucket into which a time falls.
+#  The loop runs at most @c HIST_BUCKETS - 1 times, so this takes a bounded
+#  amount of time and allocates no memory.
+#  @param usec The time in microseconds
+#  @return The index of the histogram bucket
+@micropython.native
+def hist_bucket(usec):
+    bucket = 0
+    while usec > 0 and bucket < HIST_BUCKETS - 1:
+        usec >>= 1
+        bucket += 1
+    return bucket
+
+
+## Estimate a percentile of the times counted in a histogram.
+#  The estimate is the upper edge of the bucket holding the percentile, but
+#  never more than the largest time actually seen.
+#  @param hist The histogram, an array of @c HIST_BUCKETS counts
+#  @param fraction The percentile as a fraction, such as 0.99 for p99
+#  @param largest The largest time seen in microseconds
+#  @return The estimated percentile in microseconds, or @c None if the
+#          histogram is empty
+def hist_percentile(hist, fraction, largest):
+    total = sum(hist)
+    if total == 0:
+        return None
+    target = fraction * total
+    count = 0
+    for bucket in range(len(hist)):
+        count += hist[bucket]
+        if count >= target:
+            return min((1 << bucket) - 1, largest)
+    return largest
+
+
 ## Implements multitasking with scheduling and some performance logging.
 #
 #  This class implements behavior common to tasks in a cooperative 
@@ -81,12 +164,22 @@ class Task:
     #         The time can be given in a @c float or @c int; it will be 
     #         converted to microseconds for internal use by the scheduler.
     #  @param profile Set to @c True to enable run-time profiling 
-    #  @param trace Set to @c True to generate a list of transitions between
-    #         states. @b Note: This slows things down and allocates memory.
+    #  @param trace Set to @c True to record transitions between states in a
+    #         ring buffer holding the last @c TRACE_SIZE transitions, or to an
+    #         integer to choose how many transitions are kept, at most
+    #         @c TRACE_MAX_SIZE. The buffer is allocated here, so recording a
+    #         transition doesn't allocate memory
     #  @param shares A list or tuple of shares and queues used by this task.
     #         If no list is given, no shares are passed to the task
+    #  @param overrun What to do when a timed task is late by one or more
+    #         whole periods: @c OVERRUN_CATCH_UP (the default), 
+    #         @c OVERRUN_SKIP or @c OVERRUN_REALIGN
+    #  @param on_miss A function to be called as @c on_miss(task, missed)
+    #         when the task misses a deadline, where @c missed is the number
+    #         of whole periods missed, or @c None for no callback
     def __init__(self, run_fun, name="NoName", priority=0, period=None,
-                 profile=False, trace=False, shares=()):
+                 profile=False, trace=False, shares=(),
+                 overrun=OVERRUN_CATCH_UP, on_miss=None):
         # The function which is run to implement this task's code. Since it 
         # is a generator, we "run" it here, which doesn't actually run it but
         # gets it going as a generator which is ready to yield values
@@ -114,19 +207,40 @@ class Task:
             self.period = period
             self._next_run = None
 
+        # What to do when the task misses deadlines, and a function to call
+        # when it does so
+        self._overrun = overrun
+        self._on_miss = on_miss
+
+        # The number of times the task has missed a deadline and the total
+        # number of periods which were missed. These are kept whether or not
+        # the task is being profiled
+        self._misses = 0
+        self._missed_periods = 0
+
         # Flag which causes the task to be profiled, in which the execution
         #  time of the @c run() method is measured and basic statistics kept. 
         self._prof = profile
+        self._run_hist = array.array('L', range(HIST_BUCKETS if profile else 0))
+        self._late_hist = array.array('L', range(HIST_BUCKETS if profile else 0))
         self.reset_profile()
 
         # The previous state in which the task last ran. It is used to watch
         # for and track state transitions.
         self._prev_state = 0
 
-        # If transition tracing has been enabled, create an empty list in 
-        # which to store transition (time, to-state) stamps
-        self._trace = trace
-        self._tr_data = []
+        # If transition tracing has been enabled, allocate a ring buffer in
+        # which to store (delta time, to-state) pairs. Each pair occupies two
+        # consecutive items; the oldest pairs are overwritten when it's full
+        if trace is True:
+            trace = TRACE_SIZE
+        if trace and not 0 < int(trace) <= TRACE_MAX_SIZE:
+            raise ValueError('Trace size must be 1 to ' + str(TRACE_MAX_SIZE))
+        self._trace = bool(trace)
+        self._tr_size = int(trace) if trace else 0
+        self._tr_data = array.array(TRACE_TYPE, range(2 * self._tr_size))
+        self._tr_idx = 0
+        self._tr_count = 0
         self._prev_time = utime.ticks_us()
 
         ## Flag which is set true when the task is ready to be run by the
@@ -165,22 +279,24 @@ class Task:
                     self._run_sum += runt
                     if runt > self._slowest:
                         self._slowest = runt
+                    self._run_hist[hist_bucket(runt)] += 1
 
-            # If transition logic tracing is on, record a transition; if not,
-            # ignore the state. If out of memory, switch tracing off and 
-            # run the memory allocation garbage collector
+            # If transition logic tracing is on, record a transition with the
+            # time since the previous transition; if not, ignore the state
             if self._trace:
-                try:
-                    if curr_state != self._prev_state:
-                        self._tr_data.append(
-                            (utime.ticks_diff(etime, self._prev_time),
-                             curr_state))
-                except MemoryError:
-                    self._trace = False
-                    gc.collect()
+                if curr_state != self._prev_state:
+                    idx = self._tr_idx
+                    self._tr_data[idx] = utime.ticks_diff(etime,
+                                                          self._prev_time)
+                    self._tr_data[idx + 1] = curr_state
+                    idx += 2
+                    if idx >= len(self._tr_data):
+                        idx = 0
+                    self._tr_idx = idx
+                    self._tr_count += 1
+                    self._prev_time = etime
 
                 self._prev_state = curr_state
-                self._prev_time = etime
 
             return True
 
@@ -198,17 +314,38 @@ class Task:
         # If this task uses a timer, check if it's time to run run() again. If
         # so, set go flag and set the timer to go off at the next run time
         if self.period != None:
-            late = utime.ticks_diff(utime.ticks_us(), self._next_run)
+            now = utime.ticks_us()
+            late = utime.ticks_diff(now, self._next_run)
             if late > 0:
                 self.go_flag = True
-                self._next_run = utime.ticks_diff(self.period, 
-                                                  -self._next_run)
+
+                # If the run is late by a whole period or more, the deadline
+                # (the next scheduled run) has been missed; move the next run
+                # time as the overrun policy says
+                if late >= self.period:
+                    missed = late // self.period
+                    self._misses += 1
+                    self._missed_periods += missed
+                    if self._overrun == OVERRUN_SKIP:
+                        self._next_run = utime.ticks_add(self._next_run,
+                            (missed + 1) * self.period)
+                    elif self._overrun == OVERRUN_REALIGN:
+                        self._next_run = utime.ticks_add(now, self.period)
+                    else:
+                        self._next_run = utime.ticks_add(self._next_run,
+                                                         self.period)
+                    if self._on_miss is not None:
+                        self._on_miss(self, missed)
+                else:
+                    self._next_run = utime.ticks_diff(self.period, 
+                                                      -self._next_run)
 
                 # If keeping a latency profile, record the data
                 if self._prof:
                     self._late_sum += late
                     if late > self._latest:
                         self._latest = late
+                    self._late_hist[hist_bucket(late)] += 1
 
         # If the task doesn't use a timer, we rely on go_flag to signal ready
         return self.go_flag
@@ -216,13 +353,35 @@ class Task:
 
     ## This method sets the period between runs of the task to the given
     #  number of milliseconds, or @c None if the task is triggered by calls
-    #  to @c go() rather than time.
+    #  to @c go() rather than time. The next run already scheduled keeps its
+    #  time; a task which had no period is first run one new period from now.
     #  @param new_period The new period in milliseconds between task runs
     def set_period(self, new_period):
         if new_period is None:
             self.period = None
+            self._next_run = None
         else:
-            self.period = int(new_period) * 1000
+            self.period = int(new_period * 1000)
+            if self._next_run is None:
+                self._next_run = utime.ticks_add(utime.ticks_us(),
+                                                 self.period)
+
+
+    ## This method returns the task's average run duration, which together
+    #  with its period gives the share of the CPU the task uses.
+    #  @return The average run duration in microseconds, or @c None if the
+    #          task isn't profiled or hasn't run enough to tell
+    def get_mean_duration(self):
+        if self._runs > 2:
+            return self._run_sum / (self._runs - 2)
+        return None
+
+
+    ## This method returns the task's deadline miss counts.
+    #  @return A tuple holding the number of times the task has missed a
+    #          deadline and the total number of periods which were missed
+    def get_misses(self):
+        return (self._misses, self._missed_periods)
 
 
     ## This method resets the variables used for execution time profiling.
@@ -233,28 +392,111 @@ class Task:
         self._slowest = 0
         self._late_sum = 0
         self._latest = 0
+        for bucket in range(len(self._run_hist)):
+            self._run_hist[bucket] = 0
+            self._late_hist[bucket] = 0
+
+
+    ## This method returns percentiles of the task's run duration and
+    #  lateness, estimated from the profiling histograms.
+    #  @return A tuple (p50 duration, p99 duration, p50 lateness, p99
+    #          lateness) in microseconds; items are @c None if no data
+    def get_percentiles(self):
+        return (hist_percentile(self._run_hist, 0.5, self._slowest),
+                hist_percentile(self._run_hist, 0.99, self._slowest),
+                hist_percentile(self._late_hist, 0.5, self._latest),
+                hist_percentile(self._late_hist, 0.99, self._latest))
+
+
+    ## This method returns the task's profile in a compact, one line form
+    #  which can be saved and analyzed on another computer.
+    #  The line holds comma separated fields: name, priority, period in us
+    #  (empty if not timed), runs, total and maximum run time in us, total and
+    #  maximum lateness in us, the run time and lateness histograms as
+    #  space separated bucket counts, the number of deadline misses and the
+    #  number of periods missed.
+    #  @return A string holding the task's profile, without a newline
+    def export_profile(self):
+        period = '' if self.period is None else str(self.period)
+        return ','.join((self.name, str(self.priority), period,
+                         str(self._runs), str(self._run_sum),
+                         str(self._slowest), str(self._late_sum),
+                         str(self._latest),
+                         ' '.join(str(n) for n in self._run_hist),
+                         ' '.join(str(n) for n in self._late_hist),
+                         str(self._misses), str(self._missed_periods)))
 
 
     ## This method returns a string containing the task's transition trace.
-    #  The trace is a set of tuples, each of which contains a time and the
-    #  states from and to which the system transitioned. 
+    #  The trace is a set of lines, each of which contains a time and the
+    #  states from and to which the system transitioned. If the ring buffer
+    #  has wrapped, times are measured from the oldest transition still held
+    #  and the state before that transition is unknown.
     #  @return A possibly quite large string showing state transitions
     def get_trace(self):
         tr_str = 'Task ' + self.name + ':'
         if self._trace:
             tr_str += '\n'
-            last_state = 0
+            dropped = self._tr_count - self._tr_size
+            if dropped > 0:
+                tr_str += f'  ({dropped} earlier transitions overwritten)\n'
+            last_state = None if dropped > 0 else 0
             total_time = 0.0
-            for item in self._tr_data:
-                total_time += item[0] / 1000000.0
-                tr_str += '{: 12.6f}: {: 2d} -> {:d}\n'.format (total_time, 
-                    last_state, item[1])
-                last_state = item[1]
+            for delta, state in self._trace_pairs():
+                if last_state is None:
+                    tr_str += f'{total_time: 12.6f}:  ? -> {state:d}\n'
+                else:
+                    total_time += delta / 1000000.0
+                    tr_str += '{: 12.6f}: {: 2d} -> {:d}\n'.format (
+                        total_time, last_state, state)
+                last_state = state
         else:
             tr_str += ' not traced'
         return tr_str
 
 
+    ## Generator which yields the (delta time, to-state) pairs held in the
+    #  trace buffer, oldest first.
+    def _trace_pairs(self):
+        length = len(self._tr_data)
+        if self._tr_count * 2 >= length:
+            idx = self._tr_idx
+            num = length // 2
+        else:
+            idx = 0
+            num = self._tr_count
+        for _ in range(num):
+            yield self._tr_data[idx], self._tr_data[idx + 1]
+            idx += 2
+            if idx >= length:
+                idx = 0
+
+
+    ## This method writes the task's transition trace to a stream in binary
+    #  form so that it can be decoded on a host computer.
+    #  The dump begins with a header packed as @c TRACE_HEADER, followed by
+    #  the task name and then the (delta time, to-state) pairs, oldest first,
+    #  as raw @c TRACE_TYPE items. The pairs are written straight from the
+    #  trace buffer, so the dump doesn't copy the trace.
+    #  @param stream A file or other object with a @c write() method which
+    #         accepts bytes, such as a file opened in @c 'wb' mode
+    def dump_trace(self, stream):
+        length = len(self._tr_data)
+        wrapped = self._tr_count * 2 >= length
+        num = length // 2 if wrapped else self._tr_count
+        name = self.name.encode()[:255]
+        stream.write(struct.pack(TRACE_HEADER, TRACE_MAGIC,
+                                 struct.calcsize(TRACE_TYPE), len(name),
+                                 num, self._tr_count))
+        stream.write(name)
+        view = memoryview(self._tr_data)
+        if wrapped:
+            stream.write(view[self._tr_idx:])
+            stream.write(view[:self._tr_idx])
+        else:
+            stream.write(view[:2 * num])
+
+
     ## Method to set a flag so that this task indicates that it's ready to run.
     #  This method may be called from an interrupt service routine or from
     #  another task which has data that this task needs to process soon.
@@ -280,6 +522,15 @@ class Task:
             rst += f"{avg_dur: 10.3f}{(self._slowest / 1000.0): 10.3f}"
             if self.period != None:
                 rst += f"{avg_late: 10.3f}{(self._latest / 1000.0): 10.3f}"
+            else:
+                rst += '         -         -'
+            for pct in self.get_percentiles():
+                if pct is None:
+                    rst += '         -'
+                else:
+                    rst += f"{(pct / 1000.0): 10.3f}"
+            if self.period != None:
+                rst += f"{self._misses: 8d}"
         return rst
 
 
@@ -308,6 +559,50 @@ class TaskList:
         #  that priority. 
         self.pri_list = []
 
+        ## Free heap in bytes below which the scheduler collects garbage when
+        #  no task is ready, or @c None if the scheduler leaves garbage
+        #  collection alone. See @c schedule_gc().
+        self.gc_threshold = None
+
+        ## Free heap in bytes below which garbage is collected at once,
+        #  whether there's slack or not.
+        self.gc_emergency = 0
+
+        ## The least slack in microseconds before the next task is due in
+        #  which garbage is collected. The last collection's pause is used
+        #  instead if it was longer.
+        self.gc_min_slack = 0
+
+        ## The number of collections made in slack time.
+        self.gc_count = 0
+
+        ## The number of collections made without enough slack because the
+        #  free heap fell below @c gc_emergency.
+        self.gc_forced = 0
+
+        ## The number of checks which found the free heap below the threshold
+        #  but not enough slack to collect.
+        self.gc_deferred = 0
+
+        ## The total, longest and last collection pauses in microseconds.
+        self.gc_pause_sum = 0
+        self.gc_slowest = 0
+        self.gc_last = 0
+
+        ## The time at which the free heap was last checked.
+        self._gc_checked = utime.ticks_us()
+
+        ## Whether the free heap was below the threshold when last checked.
+        self._gc_low = False
+
+        ## Whether a lack of slack has been counted since a task last ran.
+        self._gc_waited = False
+
+        ## Functions which give the time in microseconds until work outside
+        #  the task list, such as a timer interrupt's, next needs the CPU.
+        #  See @c add_deadline().
+        self._deadlines = []
+
 
     ## Append a task to the task list. The list will be sorted by task 
     #  priorities so that the scheduler can quickly find the highest priority
@@ -372,17 +667,166 @@ class TaskList:
                 if pri[1] >= length:
                     pri[1] = 2
                 if ran:
+                    if self.gc_threshold is not None:
+                        self._gc_check(False)
                     return
 
+        # No task was ready, so this is the time to collect garbage
+        if self.gc_threshold is not None:
+            self._gc_check(True)
+
+
+    ## Have the priority scheduler collect garbage in slack time rather than
+    #  leaving it to the heap filling up, which may happen in the middle of
+    #  any task's run. Automatic garbage collection is turned off. Then, when
+    #  @c pri_sched() finds no task ready to run and the free heap is below
+    #  @c threshold, it runs @c gc.collect() if the next timed task isn't due
+    #  for at least @c min_slack_us, or for as long as the last collection
+    #  took if that was longer. With automatic collection off, MicroPython
+    #  raises @c MemoryError rather than collecting when the heap is full, so
+    #  if the free heap falls below @c emergency, whether because the tasks
+    #  leave no slack or because one allocates a lot, garbage is collected at
+    #  the next check even after a task has run.
+    #  @param threshold Free heap in bytes below which to collect in slack
+    #         time, or @c None to turn automatic collection back on
+    #  @param min_slack_us The least slack in microseconds in which to collect
+    #  @param emergency Free heap in bytes below which to collect at once;
+    #         the default is a quarter of @c threshold
+    def schedule_gc(self, threshold, min_slack_us=2000, emergency=None):
+        self.gc_threshold = threshold
+        if threshold is None:
+            gc.enable()
+            return
+        self.gc_min_slack = min_slack_us
+        self.gc_emergency = threshold // 4 if emergency is None else emergency
+        gc.disable()
+
+
+    ## Tell the scheduler about work outside the task list which mustn't be
+    #  held up, such as a function run by @c micropython.schedule() from a
+    #  timer interrupt. Garbage is then only collected in slack time if it
+    #  leaves that work enough time too.
+    #  @param fun A function which returns the time in microseconds until the
+    #         work next needs the CPU, or @c None if it doesn't at present
+    def add_deadline(self, fun):
+        self._deadlines.append(fun)
+
+
+    ## Find how long it is until the next timed task is due to run, or until
+    #  work added with @c add_deadline() needs the CPU if that's sooner.
+    #  @return The slack in microseconds, 0 if a task is ready to run now, or
+    #          @c None if nothing is timed
+    def slack(self):
+        now = utime.ticks_us()
+        slack = None
+        for pri in self.pri_list:
+            for task in pri[2:]:
+                if task.go_flag:
+                    return 0
+                if task.period is not None and task._next_run is not None:
+                    wait = utime.ticks_diff(task._next_run, now)
+                    if slack is None or wait < slack:
+                        slack = wait
+        for fun in self._deadlines:
+            wait = fun()
+            if wait is not None and (slack is None or wait < slack):
+                slack = wait
+        if slack is not None and slack < 0:
+            slack = 0
+        return slack
+
+
+    ## Collect garbage if the free heap is low and there's slack, or at once
+    #  if it's very low. The free heap is measured at most once every
+    #  @c GC_CHECK_US; once it has been found below the threshold, each time
+    #  no task is ready the slack is checked until there's enough of it.
+    #  See @c schedule_gc().
+    #  @param idle @c True if no task was ready to run, so there may be slack
+    def _gc_check(self, idle):
+        if idle and self._gc_low:
+            slack = self.slack()
+            need = self.gc_last if self.gc_last > self.gc_min_slack \
+                else self.gc_min_slack
+            if slack is not None and slack < need:
+                # Count each idle time which is too short only once
+                if not self._gc_waited:
+                    self._gc_waited = True
+                    self.gc_deferred += 1
+                return
+            self.gc_count += 1
+            self._collect()
+            return
+
+        if not idle:
+            self._gc_waited = False
+        now = utime.ticks_us()
+        if utime.ticks_diff(now, self._gc_checked) < GC_CHECK_US:
+            return
+        self._gc_checked = now
+        free = gc.mem_free()
+        if free < self.gc_emergency:
+            self.gc_forced += 1
+            self._collect()
+        else:
+            self._gc_low = free < self.gc_threshold
+
+
+    ## Run the garbage collector and record how long it took.
+    def _collect(self):
+        start = utime.ticks_us()
+        gc.collect()
+        end = utime.ticks_us()
+        pause = utime.ticks_diff(end, start)
+        self.gc_last = pause
+        self.gc_pause_sum += pause
+        if pause > self.gc_slowest:
+            self.gc_slowest = pause
+        self._gc_low = False
+        self._gc_checked = end
+
+
+    ## Write the binary transition traces of all the tasks in the list to a
+    #  stream, one after another. See @c Task.dump_trace() for the format.
+    #  @param stream A file or other object with a @c write() method
+    def dump_traces(self, stream):
+        for pri in self.pri_list:
+            for task in pri[2:]:
+                task.dump_trace(stream)
+
+
+    ## Create a compact export of the profiles of all the tasks in the list,
+    #  one line per task as made by @c Task.export_profile(). The first line
+    #  is a header which names the fields.
+    #  @return A string holding the exported profiles
+    def export_profile(self):
+        ret_str = '# name,priority,period_us,runs,run_sum_us,slowest_us,' \
+            'late_sum_us,latest_us,run_hist,late_hist,misses,missed_periods\n'
+        for pri in self.pri_list:
+            for task in pri[2:]:
+                ret_str += task.export_profile() + '\n'
+
+        return ret_str
+
 
     ## Create some diagnostic text showing the tasks in the task list.
+    #  Percentiles are estimated from the tasks' logarithmic histograms.
     def __repr__(self):
         ret_str = 'TASK             PRI    PERIOD    RUNS   AVG DUR   MAX ' \
-            'DUR  AVG LATE  MAX LATE\n'
+            'DUR  AVG LATE  MAX LATE   P50 DUR   P99 DUR  P50 LATE  P99 LATE' \
+            '  MISSES\n'
         for pri in self.pri_list:
             for task in pri[2:]:
                 ret_str += str(task) + '\n'
 
+        collections = self.gc_count + self.gc_forced
+        if collections > 0:
+            ret_str += f"GC: {collections} collections, {self.gc_forced} " \
+                f"forced, {self.gc_deferred} deferred, pause avg " \
+                f"{(self.gc_pause_sum / collections / 1000.0):.3f} max " \
+                f"{(self.gc_slowest / 1000.0):.3f} ms\n"
+        elif self.gc_threshold is not None:
+            ret_str += f"GC: no collections, {self.gc_deferred} deferred\n"
+
         return ret_str
 
 
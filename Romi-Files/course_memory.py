@@ -0,0 +1,236 @@
+import array
+import math
+import struct
+
+# Features seen at a place on the course, as bits of the feature byte of each bin
+FEATURE_GAP = 0x01    # No sensor saw the line
+FEATURE_CROSS = 0x02  # Line across the whole sensor, such as the finish line
+FEATURE_TURN = 0x04   # Curvature above turn_curvature
+
+# Header of a saved course: magic, number of bins, bin length in ft
+HEADER = '<4sHf'
+MAGIC = b'CRSM'
+
+# Curvature is kept in thousandths of 1/ft
+CURVATURE_SCALE = 1000
+
+# Planned speeds are kept in thousandths of ft/s
+SPEED_SCALE = 1000
+
+# What struct raises for bad data: struct.error on CPython, ValueError on MicroPython, which has no struct.error
+STRUCT_ERROR = getattr(struct, 'error', ValueError)
+
+
+class CourseMemory:
+    """
+    @brief Class to remember a course on one lap and look it up by distance on the next
+
+    @detail The course is split into bins of equal length along the path driven, measured by odometry.
+            Each bin keeps the curvature driven through it as a 16 bit integer and a byte of features,
+            so 1000 bins, 100 ft at 0.1 ft per bin, take 3 KB in flash. plan() turns the curvature into
+            a speed for each bin. Each speed is the fastest at which the robot can take the bin and still
+            slow down in time for the bins after it, so lookups while racing see turns before the line
+            sensor does, and each lookup is one index.
+
+            No bins are allocated until learn() makes size of them for a learning lap, or load() makes
+            as many as the saved course has. A loaded course takes 5 bytes of RAM per bin.
+
+            Odometry drifts from the distances learned, and counts the detour around the round block
+            and turns on the spot. sync() re-aligns the course where a remembered feature, such as a gap
+            in a dashed line, begins again, by keeping an offset which is added to every distance
+            looked up.
+
+    """
+
+    def __init__ (self, bin_ft=0.1, size=1000):
+        """
+        @brief Init for the course memory
+
+        @param bin_ft = length of course in each bin, ft
+
+        @param size = most bins to keep
+
+        """
+        self.bin_ft = bin_ft
+        self.size = size
+        self.curvature = None   # Curvature in 1/1000 ft
+        self.features = None
+        self.counts = None      # Samples averaged into each bin while learning
+        self.speed = None       # Planned speed in 1/1000 ft/s, made by plan()
+        self.count = 0          # Bins in use
+        self.offset = 0.0       # Added to odometry distances to find the place on the course, ft
+        self.syncs = 0          # Number of times sync() has re-aligned the course
+
+    def learn (self):
+        """
+        @brief Makes room for size bins to learn a course into with record()
+        """
+        self.curvature = array.array('h', [0] * self.size)
+        self.features = bytearray(self.size)
+        self.counts = bytearray(self.size)
+        self.count = 0
+        self.offset = 0.0
+
+    def index (self, distance):
+        """
+        @brief Returns the bin holding a distance along the course
+
+        @param distance = distance from the start in ft, from odometry
+
+        """
+        idx = int((distance + self.offset) / self.bin_ft)
+        if idx < 0:
+            return 0
+        if idx >= self.count:
+            return self.count - 1 if self.count else 0
+        return idx
+
+    def record (self, distance, v, yaw_rate, features=0):
+        """
+        @brief Adds a sample to the course while learning, after learn()
+
+        @param distance = distance from the start in ft
+
+        @param v = measured velocity in ft/s
+
+        @param yaw_rate = measured yaw rate in rad/s
+
+        @param features = FEATURE_ bits seen at this distance
+
+        """
+        idx = int(distance / self.bin_ft)
+        if idx < 0 or idx >= self.size:
+            return
+        if idx >= self.count:
+            self.count = idx + 1
+        self.features[idx] |= features
+        if v > 0.1:
+            # Running average of the curvature through the bin
+            sample = int(CURVATURE_SCALE * yaw_rate / v)
+            if sample > 32767:
+                sample = 32767
+            elif sample < -32767:
+                sample = -32767
+            num = self.counts[idx]
+            if num < 255:
+                self.curvature[idx] = (self.curvature[idx] * num + sample) // (num + 1)
+                self.counts[idx] = num + 1
+
+    def plan (self, v_min, v_max, a_lat, decel, turn_curvature=1.0):
+        """
+        @brief Works out the speed for each bin and marks the turns
+
+        @param v_min = slowest planned speed in ft/s
+
+        @param v_max = fastest planned speed in ft/s
+
+        @param a_lat = sideways acceleration allowed in turns, ft/s^2
+
+        @param decel = deceleration allowed before turns, ft/s^2
+
+        @param turn_curvature = curvature in 1/ft above which a bin is marked as a turn
+
+        """
+        if self.speed is None or len(self.speed) < self.count:
+            self.speed = array.array('h', [0] * self.count)
+
+        # Fastest speed through each bin's curve
+        v_max = min(v_max, 32767 / SPEED_SCALE)
+        for idx in range(self.count):
+            k = abs(self.curvature[idx]) / CURVATURE_SCALE
+            v = math.sqrt(a_lat / k) if k > 0 else v_max
+            self.speed[idx] = int(SPEED_SCALE * min(v_max, max(v_min, v)))
+            if k > turn_curvature:
+                self.features[idx] |= FEATURE_TURN
+            else:
+                self.features[idx] &= ~FEATURE_TURN
+
+        # Backwards from the end, slow enough to brake for every later bin
+        for idx in range(self.count - 2, -1, -1):
+            following = self.speed[idx + 1] / SPEED_SCALE
+            reachable = int(SPEED_SCALE * math.sqrt(following ** 2 + 2 * decel * self.bin_ft))
+            if reachable < self.speed[idx]:
+                self.speed[idx] = reachable
+
+    def speed_at (self, distance):
+        """
+        @brief Returns the planned speed in ft/s at a distance along the course, from odometry
+        """
+        return self.speed[self.index(distance)] / SPEED_SCALE
+
+    def curvature_at (self, distance):
+        """
+        @brief Returns the remembered curvature in 1/ft at a distance along the course, from odometry
+        """
+        return self.curvature[self.index(distance)] / CURVATURE_SCALE
+
+    def sync (self, distance, feature, window_ft=0.5):
+        """
+        @brief Re-aligns the course with the odometry where a feature begins while racing
+
+        @detail The nearest bin within window_ft of the place looked up at which the feature began while
+                learning is taken to be where the robot is now. If there is none, nothing changes.
+
+        @param distance = distance from the start in ft, from odometry
+
+        @param feature = FEATURE_ bit which has just begun, such as FEATURE_GAP when the line is lost
+
+        @param window_ft = farthest to look for the feature either way, ft
+
+        @return True if the course was re-aligned
+
+        """
+        features = self.features
+        here = int((distance + self.offset) / self.bin_ft)
+        for step in range(int(window_ft / self.bin_ft) + 1):
+            for idx in (here - step, here + step):
+                if (0 <= idx < self.count and features[idx] & feature
+                        and (idx == 0 or not features[idx - 1] & feature)):
+                    self.offset = idx * self.bin_ft - distance
+                    self.syncs += 1
+                    return True
+        return False
+
+    def save (self, filename):
+        """
+        @brief Writes the learned course to a file in flash
+
+        @param filename = name of the course file
+
+        """
+        with open(filename, 'wb') as f:
+            f.write(struct.pack(HEADER, MAGIC, self.count, self.bin_ft))
+            f.write(memoryview(self.curvature)[:self.count])
+            f.write(memoryview(self.features)[:self.count])
+
+    def load (self, filename):
+        """
+        @brief Reads a course saved by save()
+
+        @param filename = name of the course file
+
+        @return True if a course was read, False if there is no usable file, such as one cut short
+
+        """
+        try:
+            with open(filename, 'rb') as f:
+                header = f.read(struct.calcsize(HEADER))
+                if len(header) != struct.calcsize(HEADER):
+                    return False
+                magic, count, bin_ft = struct.unpack(HEADER, header)
+                if magic != MAGIC or count == 0 or count > self.size:
+                    return False
+                curvature = array.array('h', [0] * count)
+                features = bytearray(count)
+                # A short read would leave zeros, which look like a straight course
+                if f.readinto(curvature) != 2 * count or f.readinto(features) != count:
+                    return False
+        except (OSError, ValueError, STRUCT_ERROR):
+            return False
+        self.bin_ft = bin_ft
+        self.curvature = curvature
+        self.features = features
+        self.counts = None
+        self.count = count
+        self.offset = 0.0
+        return True
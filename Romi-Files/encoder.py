@@ -31,15 +31,22 @@ class Encoder:
         self.speed = 0
         self.alpha = 0.8  # Smoothing factor for low-pass filter; adjust as needed (0 < alpha < 1)
 
-    def update(self): 
+    def update(self, counter=None, now=None): 
         """
         @brief The main method in Encoder to get position and speed.
+
+        @param counter = timer count read earlier, such as in a timer interrupt; read now if None
+
+        @param now = time.ticks_us() when counter was read
         """
         # Calculate Delta
-        self.current_position = self.tim.counter()
+        if counter is None:
+            counter = self.tim.counter()
+            now = time.ticks_us()
+        self.current_position = counter
         self.delta = self.current_position - self.prev_position
         self.last_time = self.current_time
-        self.current_time = time.ticks_us()
+        self.current_time = now
 
         # Set previous value for next update iteration
         self.prev_position = self.current_position
@@ -56,10 +63,11 @@ class Encoder:
         # Calculate raw speed
         radians_per_tick = (2 * math.pi) / (12 * 120) 
         time_interval = time.ticks_diff(self.current_time, self.last_time) * 1e-6  # Convert microseconds to seconds
-        raw_speed = (self.delta * radians_per_tick) / time_interval
+        if time_interval > 0:  # Two updates in the same microsecond give no speed
+            raw_speed = (self.delta * radians_per_tick) / time_interval
         
-        # Apply low-pass filter to smooth the speed
-        self.speed = self.alpha * self.speed + (1 - self.alpha) * raw_speed
+            # Apply low-pass filter to smooth the speed
+            self.speed = self.alpha * self.speed + (1 - self.alpha) * raw_speed
 
     def get_position(self):
         """
@@ -88,9 +96,12 @@ class Encoder:
             print(self.tim.counter())
             time.sleep(1)
 
-    def get_speed(self):
+    def get_speed(self, update=True):
         """
         @brief Returns the current filtered speed of the motor in rad/s.
+
+        @param update = if False, return the speed from the last update, such as when a timer keeps it updated
         """
-        self.update()
+        if update:
+            self.update()
         return -self.speed
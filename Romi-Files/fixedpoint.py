@@ -0,0 +1,213 @@
+import time
+
+# Fixed point formats. A value in Qn is an int holding the real value times 2**n. On a 32 bit port,
+# MicroPython keeps ints within +/-2**30 in the object itself, with no heap allocation, while every float
+# is allocated on the heap. Every product below is kept under 2**30 by the saturation limits, so none of
+# this allocates.
+Q = 8                # Wheel speeds in rad/s, duties in percent, gains
+ONE = 1 << Q         # 1.0 in Q8
+Q_DT = 16            # Time steps in s and the PID integral in error times s
+
+SPEED_MAX = 100 << Q    # Wheel speeds saturate at +/-100 rad/s
+ERROR_MAX = 64 << Q     # PID errors saturate at +/-64
+GAIN_MAX = 32           # Largest PID gain, Kd / dt and 1 / feedforward gain, so products stay under 2**30
+INTEGRAL_MAX = 128      # Largest PID integral limit
+
+# Q8 rad/s for one count in one microsecond, with 12 * 120 counts per wheel revolution as in Encoder:
+# 2 pi / 1440 * 1e6 * 256
+RAD_PER_COUNT_US = 1117011
+DELTA_MAX = 960  # Encoder counts per sample; 960 * RAD_PER_COUNT_US is just under 2**30
+
+
+def to_fixed (x, q=Q):
+    """
+    @brief Converts a number to Qq fixed point; allocates, so keep it out of the control loops
+    """
+    return int(round(x * (1 << q)))
+
+
+def to_float (x, q=Q):
+    """
+    @brief Converts a Qq fixed point number back to a float
+    """
+    return x / (1 << q)
+
+
+class FixedPID:
+    """
+    @brief Class for a PID controller like main.PIDController, in Q8 fixed point
+
+    @detail The time step is fixed when the controller is made, so Ki * dt and Kd / dt are worked out
+            once. The error saturates at ERROR_MAX and the integral, kept in Q16 error seconds, at the
+            integral limit, so with gains below GAIN_MAX each term is under 2**28 and the sum under
+            2**30. Shifts round down rather than toward zero, so results may differ from the float
+            controller by 1/256.
+
+    """
+
+    def __init__ (self, Kp, Ki, Kd, dt, out_max, integral_limit=100):
+        """
+        @brief Init for the controller
+
+        @param Kp, Ki, Kd = gains, as for main.PIDController; Kp, Ki and Kd / dt must be below GAIN_MAX
+
+        @param dt = time step, below 0.5 s
+
+        @param out_max = largest output magnitude
+
+        @param integral_limit = largest integral magnitude, below INTEGRAL_MAX
+
+        """
+        if max(abs(Kp), abs(Ki), abs(Kd / dt)) >= GAIN_MAX or integral_limit >= INTEGRAL_MAX or dt >= 0.5:
+            raise ValueError('Gains, integral limit or time step too large for Q8')
+        self.kp = to_fixed(Kp)
+        self.ki = to_fixed(Ki)
+        self.kd_dt = to_fixed(Kd / dt)
+        self.dt = to_fixed(dt, Q_DT)
+        self.out_max = to_fixed(out_max)
+        self.integral_limit = to_fixed(integral_limit, Q_DT)
+        self.integral = 0
+        self.prev_error = 0
+
+    def reset (self):
+        """
+        @brief Clears the integral and the previous error, such as after something else has driven the motor
+        """
+        self.integral = 0
+        self.prev_error = 0
+
+    def update (self, setpoint, measurement):
+        """
+        @brief Works out the controller output
+
+        @param setpoint = setpoint in Q8
+
+        @param measurement = measurement in Q8
+
+        @return Output in Q8
+
+        """
+        error = setpoint - measurement
+        if error > ERROR_MAX:
+            error = ERROR_MAX
+        elif error < -ERROR_MAX:
+            error = -ERROR_MAX
+
+        integral = self.integral + ((error * self.dt) >> Q)
+        if integral > self.integral_limit:
+            integral = self.integral_limit
+        elif integral < -self.integral_limit:
+            integral = -self.integral_limit
+        self.integral = integral
+
+        derivative = error - self.prev_error
+        self.prev_error = error
+
+        output = (self.kp * error + self.ki * (integral >> (Q_DT - Q)) + self.kd_dt * derivative) >> Q
+        if output > self.out_max:
+            output = self.out_max
+        elif output < -self.out_max:
+            output = -self.out_max
+        return output
+
+
+class FixedFeedforward:
+    """
+    @brief Class for the motor feedforward of main.MotorFeedforward, in Q8 fixed point
+    """
+
+    def __init__ (self, gain, offset, min_speed=0.05):
+        """
+        @brief Init for the feedforward, with the motor model identified for main.MotorFeedforward
+
+        @param gain = wheel speed per percent duty, rad/s; 0 for no feedforward
+
+        @param offset = duty at which the motor starts to turn, percent
+
+        @param min_speed = speed below which no feedforward is given, rad/s
+
+        """
+        if gain and abs(1 / gain) >= GAIN_MAX:
+            raise ValueError('Feedforward gain too small for Q8')
+        self.inv_gain = to_fixed(1 / gain) if gain else 0
+        self.offset = to_fixed(offset) if gain else 0
+        self.min_speed = to_fixed(min_speed)
+
+    def duty (self, speed):
+        """
+        @brief Returns the duty in Q8 percent for a wheel speed in Q8 rad/s
+        """
+        if speed > self.min_speed:
+            return ((speed * self.inv_gain) >> Q) + self.offset
+        if speed < -self.min_speed:
+            return ((speed * self.inv_gain) >> Q) - self.offset
+        return 0
+
+
+class FixedEncoder:
+    """
+    @brief Class to update an Encoder and find its speed in Q8 fixed point
+
+    @detail The Encoder's position, delta and sample times are kept up to date as Encoder.update does,
+            so the odometry and a float Encoder.update between fixed updates still work. Its float
+            speed isn't; the filtered speed is kept here instead, in Q8 rad/s with the sign of
+            Encoder.get_speed. A sample saturates at DELTA_MAX counts and the speed at SPEED_MAX.
+
+    """
+
+    def __init__ (self, encoder, alpha=0.8):
+        """
+        @brief Init for the fixed point speed of an encoder
+
+        @param encoder = Encoder object to update
+
+        @param alpha = weight of the old speed in the low pass filter, as Encoder.alpha
+
+        """
+        self.encoder = encoder
+        self.tim = encoder.tim
+        self.alpha = to_fixed(alpha)
+        self.speed = 0
+
+    def update (self, counter=None, now=None):
+        """
+        @brief Updates the encoder and the speed
+
+        @param counter = timer count read earlier, such as in a timer interrupt; read now if None
+
+        @param now = time.ticks_us() when counter was read
+
+        @return Filtered speed in Q8 rad/s
+
+        """
+        encoder = self.encoder
+        if counter is None:
+            counter = self.tim.counter()
+            now = time.ticks_us()
+
+        # Counts since the last update, across over- or underflow of the 16 bit timer
+        delta = counter - encoder.prev_position
+        if delta > 32768:
+            delta -= 65536
+        elif delta < -32768:
+            delta += 65536
+        encoder.prev_position = counter
+        encoder.current_position = counter
+        encoder.delta = delta
+        encoder.position += delta
+
+        interval = time.ticks_diff(now, encoder.current_time)
+        encoder.last_time = encoder.current_time
+        encoder.current_time = now
+        if interval > 0:
+            if delta > DELTA_MAX:
+                delta = DELTA_MAX
+            elif delta < -DELTA_MAX:
+                delta = -DELTA_MAX
+            raw = -(delta * RAD_PER_COUNT_US) // interval
+            if raw > SPEED_MAX:
+                raw = SPEED_MAX
+            elif raw < -SPEED_MAX:
+                raw = -SPEED_MAX
+            self.speed = (self.alpha * self.speed + (ONE - self.alpha) * raw) >> Q
+        return self.speed
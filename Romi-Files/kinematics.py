@@ -0,0 +1,61 @@
+class Kinematics:
+    """
+    @brief Class to convert between wheel speeds and the Romi's velocity and yaw rate
+
+    @detail The constants of the conversions are worked out once, when the object is made, so each
+            conversion is only a few multiplications. Results are kept in attributes rather than returned
+            as tuples, so the control loops can convert every run without allocating tuples.
+
+    """
+
+    def __init__ (self, wheel_radius, track_width):
+        """
+        @brief Works out the constants of the conversions
+
+        @param wheel_radius = radius of the wheels in feet
+
+        @param track_width = distance between the wheels in feet
+
+        """
+        self.wheel_radius = wheel_radius
+        self.track_width = track_width
+
+        # Inverse kinematics constants
+        self.inv_radius = 1 / wheel_radius
+        self.half_track_over_radius = track_width / (2 * wheel_radius)
+
+        # Forward kinematics constants
+        self.half_radius = wheel_radius / 2
+        self.radius_over_track = wheel_radius / track_width
+
+        # Results of the last conversions
+        self.omega_left = 0.0   # Left wheel speed in rad/s
+        self.omega_right = 0.0  # Right wheel speed in rad/s
+        self.v = 0.0            # Forward velocity in ft/s
+        self.yaw_rate = 0.0     # Yaw rate in rad/s, positive turning left
+
+    def inverse (self, v, yaw_rate):
+        """
+        @brief Finds the wheel speeds for a velocity and yaw rate, in omega_left and omega_right
+
+        @param v = forward velocity in ft/s
+
+        @param yaw_rate = yaw rate in rad/s
+
+        """
+        straight = self.inv_radius * v
+        turn = self.half_track_over_radius * yaw_rate
+        self.omega_left = straight - turn
+        self.omega_right = straight + turn
+
+    def forward (self, omega_left, omega_right):
+        """
+        @brief Finds the velocity and yaw rate from the wheel speeds, in v and yaw_rate
+
+        @param omega_left = left wheel speed in rad/s
+
+        @param omega_right = right wheel speed in rad/s
+
+        """
+        self.v = self.half_radius * (omega_left + omega_right)
+        self.yaw_rate = self.radius_over_track * (omega_right - omega_left)
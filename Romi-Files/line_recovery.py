@@ -0,0 +1,134 @@
+# Recovery states
+TRACKING = 0  # A sensor sees the line
+BRIDGING = 1  # Line just lost; carrying on as before, across a dash or a short gap
+SEARCH = 2    # Line lost for longer; turning on the spot to look for it
+LOST = 3      # Search found nothing; stopped
+
+STATE_NAMES = ("TRACKING", "BRIDGING", "SEARCH", "LOST")
+
+# Speed limit in ft/s that doesn't limit anything
+NO_LIMIT = 100.0
+
+
+class LineRecovery:
+    """
+    @brief Class to keep following the line when the sensor loses it
+
+    @detail When no sensor sees the line, the last line position and yaw rate are carried across the gap
+            at full speed, so dashed lines and short gaps are bridged without slowing. If the line hasn't
+            come back after bridge_ft or bridge_s, whichever is first, the robot stops and turns on the
+            spot, first towards the side the line was last seen, then back the other way. If that search
+            finds nothing, or takes too long, the robot stays stopped. Seeing the line at any time returns
+            to tracking.
+
+            Every update sets yaw, line_error and speed_limit, which the outer loop uses in place of the
+            line follower's output.
+
+    """
+
+    def __init__ (self, bridge_ft=0.25, bridge_s=0.5, search_yaw_rate=1.5, search_angle=1.0, search_speed=0.0):
+        """
+        @brief Init for line recovery
+
+        @param bridge_ft = longest gap to bridge, ft
+
+        @param bridge_s = longest time to bridge, s
+
+        @param search_yaw_rate = yaw rate while searching, rad/s
+
+        @param search_angle = angle to search on the side the line was last seen, rad; the search then turns
+                              back through twice this angle
+
+        @param search_speed = forward speed while searching, ft/s
+
+        """
+        self.bridge_ft = bridge_ft
+        self.bridge_s = bridge_s
+        self.search_yaw_rate = search_yaw_rate
+        self.search_angle = search_angle
+        self.search_speed = search_speed
+
+        self.state = TRACKING
+        self.yaw = 0             # Yaw rate setpoint, rad/s
+        self.line_error = 0      # Line position from the center of the sensor, in sensor pitches
+        self.speed_limit = NO_LIMIT
+
+        self.start_distance = 0  # Where the line was lost
+        self.state_time = 0      # Time in the current state, s
+        self.direction = 1       # Side being searched, 1 for left and -1 for right
+        self.swept = 0           # Angle turned in the current search direction, rad
+        self.sweeps = 0          # Search directions finished
+        self.entries = [0, 0, 0, 0]  # Number of times each state has been entered, by state
+
+    def update (self, seen, line_yaw, line_error, distance, yaw_rate, dt):
+        """
+        @brief Works out the yaw rate setpoint and speed limit for one outer loop run
+
+        @param seen = True if a sensor sees the line
+
+        @param line_yaw = yaw rate setpoint from the line follower, used while the line is seen, rad/s
+
+        @param line_error = line position from the center of the sensor while the line is seen, in sensor
+                            pitches (the spacing of neighbouring sensors), -3.5 to 3.5 across the 8 sensors
+
+        @param distance = distance driven from the wheel encoders, ft
+
+        @param yaw_rate = measured yaw rate, rad/s
+
+        @param dt = time since the last update, s
+
+        @return The recovery state
+
+        """
+        if seen:
+            if self.state != TRACKING:
+                self.entries[TRACKING] += 1
+            self.state = TRACKING
+            self.yaw = line_yaw
+            self.line_error = line_error
+            self.speed_limit = NO_LIMIT
+            return TRACKING
+
+        self.state_time += dt
+        if self.state == TRACKING:
+            # Carry on with the last yaw rate and line position
+            self.state = BRIDGING
+            self.entries[BRIDGING] += 1
+            self.state_time = 0
+            self.start_distance = distance
+
+        if self.state == BRIDGING:
+            if abs(distance - self.start_distance) >= self.bridge_ft or self.state_time >= self.bridge_s:
+                self.state = SEARCH
+                self.entries[SEARCH] += 1
+                self.state_time = 0
+                self.direction = 1 if self.line_error <= 0 else -1  # Line last seen on the left is a negative error
+                self.swept = 0
+                self.sweeps = 0
+            else:
+                return BRIDGING
+
+        if self.state == SEARCH:
+            self.swept += self.direction * yaw_rate * dt
+            if self.swept >= self.search_angle * (1 + self.sweeps):
+                # Search back the other way, past where the line was lost
+                self.sweeps += 1
+                self.direction = -self.direction
+                self.swept = 0
+            # Give up after both directions, or after twice the time they should take if the robot is stuck
+            if self.sweeps >= 2 or self.state_time > 6 * self.search_angle / self.search_yaw_rate:
+                self.state = LOST
+                self.entries[LOST] += 1
+            else:
+                self.yaw = self.direction * self.search_yaw_rate
+                self.speed_limit = self.search_speed
+                return SEARCH
+
+        # Lost
+        self.yaw = 0
+        self.speed_limit = 0
+        return LOST
+
+    def __repr__ (self):
+        return ('LineRecovery: entered BRIDGING {} times, SEARCH {}, LOST {}, back to TRACKING {}'
+                .format(self.entries[BRIDGING], self.entries[SEARCH], self.entries[LOST], self.entries[TRACKING]))
@@ -1,18 +1,29 @@
 import pyb  # Import pyb fully to access its functions directly with pyb.function_name()
+import micropython
 from pyb import Timer, Pin, I2C
 import task_share
 import cotask
-from motor import Motor
+from motor import Motor, MotorPair
 from encoder import Encoder
 from imu import IMU
 import math
 import time
 from qtrx import QTRX
+from kinematics import Kinematics
+from maneuver import Maneuver
+from speed_planner import SpeedPlanner
+from course_memory import CourseMemory, FEATURE_GAP, FEATURE_CROSS
+from line_recovery import LineRecovery, TRACKING, BRIDGING
+from speed_loop import SpeedLoop
+from period_governor import PeriodGovernor
+from sensor_fusion import SensorFusion
+from calibration import Calibration
+import array
 
 BT_ser = pyb.UART(3, 115200)
 pyb.repl_uart(BT_ser)
 
-# Constants for robot geometry
+# Constants for robot geometry, used if calibration.json doesn't give them
 WHEEL_RADIUS = 1.375/12  # Radius of wheels in feet
 TRACK_WIDTH = 5.5/12    # Distance between wheels in feet
 
@@ -35,13 +46,22 @@ Ki_line = 0.15 # Integral gain for line following
 Kd_line = 0.1
 
 
+# Set INNER_LOOP_TIMER to run the wheel speed loop from hardware timer INNER_LOOP_TIMER_NUM at INNER_LOOP_HZ
+# rather than as a task, so its rate doesn't depend on the other tasks. The inner loop task then only starts
+# maneuvers and hands the motors between them and the speed loop
+INNER_LOOP_TIMER = False
+INNER_LOOP_TIMER_NUM = 6
+INNER_LOOP_HZ = 200
+
 # Shared variables
-left_motor_speed = task_share.Share('f')              # Desired speed for left motor
-right_motor_speed = task_share.Share('f')             # Desired speed for right motor
+# Desired (left, right) motor speeds, written and read as one record so the inner loop never
+# sees one new and one old speed. When both sides are tasks, a sequence counter protects it. The speed
+# loop reads it from a scheduled callback, which could spin forever on a write it interrupted, so then
+# interrupts are turned off around each access instead
+motor_speeds = task_share.StructShare('ff', thread_protect=INNER_LOOP_TIMER, name='Motor Speeds')
 
 # Initialize motor speed variables with zero to prevent undefined reads in inner loop
-left_motor_speed.put(0.0)  # Initialize with zero speed
-right_motor_speed.put(0.0)  # Initialize with zero speed
+motor_speeds.put(0.0, 0.0)  # Initialize with zero speed
 
 # Define the pins for the left and right bumpers with internal pull-ups enabled
 BMP0 = pyb.Pin(pyb.Pin.cpu.C6, mode=pyb.Pin.IN, pull=pyb.Pin.PULL_UP) # Right bumper pin 0 (input with pull-up)
@@ -59,9 +79,7 @@ qtrx = QTRX(sensor_pins)
 
 # Global variables
 call_round_block = False
-round_block_state = 0  # 0: not active, 1: reverse, 2: turn1, 3: straight1, 4: turn2, 5: straight2, 6: turn3, 7: end
 last_trigger_time = 0
-round_block_start_time = 0
 crossed_line = False
     
 def bumper_isr(line):
@@ -72,12 +90,6 @@ def bumper_isr(line):
             last_trigger_time = current_time
             call_round_block = True
 
-# Decoupling Matrix Function
-def calculate_motor_speeds(v, yaw_rate):
-    omega_l = (1 / WHEEL_RADIUS) * v - (TRACK_WIDTH / (2 * WHEEL_RADIUS)) * yaw_rate
-    omega_r = (1 / WHEEL_RADIUS) * v + (TRACK_WIDTH / (2 * WHEEL_RADIUS)) * yaw_rate
-    return omega_l, omega_r
-
 def calibrate_imu_before_running():
     """
     Initializes and calibrates the IMU before starting the main task loops.
@@ -103,6 +115,11 @@ class PIDController:
         self.Ki = Ki
         self.Kd = Kd
 
+    def reset(self):
+        # Clear the integral and previous error, such as when another loop has been in control
+        self.integral = 0
+        self.prev_error = 0
+
     def update(self, setpoint, measurement, dt):
         error = setpoint - measurement
         
@@ -122,257 +139,468 @@ class PIDController:
         if output <= -self.out_max:
             output = -self.out_max
         return output
+
+# Motor Feedforward Class
+class MotorFeedforward:
+    """
+    Duty cycle which should give a wheel speed, from the identified motor model
+    speed = gain * (duty - offset * sign(duty)). Added to the PID output so the PID only corrects the
+    model's error. A gain of 0 means the motor hasn't been identified, so no feedforward is given.
+    Fit gain and offset with Host-Tools/identify_motor.py from a log made with LOG_MOTOR_DATA.
+    """
+    def __init__(self, gain, offset, min_speed=0.05):
+        self.inv_gain = 1 / gain if gain else 0
+        self.offset = offset if gain else 0
+        self.min_speed = min_speed  # Below this speed (rad/s) no feedforward, so the wheel can stop
+
+    def duty(self, speed):
+        if speed > self.min_speed:
+            return speed * self.inv_gain + self.offset
+        if speed < -self.min_speed:
+            return speed * self.inv_gain - self.offset
+        return 0
     
 
 
 # Instantiate outer loop controllers
 outer_controller_v = PIDController(Kp_outer_v, Ki_outer_v, Kd_outer_v, 10, integral_limit=10)
 outer_controller_yaw = PIDController(Kp_outer_yaw, Ki_outer_yaw, Kd_outer_v, 50, integral_limit=50)
+# The same loops for maneuver steps which hold a velocity and yaw rate, kept apart from the outer loop's so
+# neither upsets the other's integral or derivative
+maneuver_controller_v = PIDController(Kp_outer_v, Ki_outer_v, Kd_outer_v, 10, integral_limit=10)
+maneuver_controller_yaw = PIDController(Kp_outer_yaw, Ki_outer_yaw, Kd_outer_v, 50, integral_limit=50)
 encoder_left = Encoder(Timer(2, prescaler=0, period=65535), Pin.cpu.A0, Pin.cpu.A1)
 encoder_right = Encoder(Timer(3, prescaler=0, period=65535), Pin.cpu.A6, Pin.cpu.A7)
 
 line_controller = PIDController(Kp_line,Ki_line,Kd_line,10,10)
 
-motor_left = Motor(Timer(1, freq=20000), Pin.cpu.A8, Pin.cpu.B10, Pin.cpu.B4)  
-motor_right = Motor(Timer(4, freq=20000), Pin.cpu.B6, Pin.cpu.C7, Pin.cpu.A9)
+motor_left = Motor(Timer(1, freq=20000), Pin.cpu.A8, Pin.cpu.B10, Pin.cpu.B4, fast=True)  
+motor_right = Motor(Timer(4, freq=20000), Pin.cpu.B6, Pin.cpu.C7, Pin.cpu.A9, fast=True)
+drive = MotorPair(motor_left, motor_right)  # Sets both motors together
 
 left_motor_controller = PIDController(Kp_inner, Ki_inner, Kd_inner, 100, integral_limit=100)
 right_motor_controller = PIDController(Kp_inner, Ki_inner, Kd_inner, 100, integral_limit=100)
 
+calibration = Calibration()
+
+# Decoupling matrix and wheel odometry, with the robot geometry from calibration.json
+geometry = calibration.section('kinematics', {'wheel_radius': WHEEL_RADIUS, 'track_width': TRACK_WIDTH})
+kinematics = Kinematics(geometry['wheel_radius'], geometry['track_width'])
+
+# Feedforward from the identified motor models in calibration.json
+motor_model = calibration.section('motor_model', {'left_gain': 0.0, 'left_offset': 0.0,
+                                                  'right_gain': 0.0, 'right_offset': 0.0})
+left_feedforward = MotorFeedforward(motor_model['left_gain'], motor_model['left_offset'])
+right_feedforward = MotorFeedforward(motor_model['right_gain'], motor_model['right_offset'])
+
+# Set LOG_MOTOR_DATA to log (left duty, left speed, right duty, right speed) each inner loop run
+# to motor_log.csv, for identifying the motor models. The newest MOTOR_LOG_SIZE runs are kept
+LOG_MOTOR_DATA = False
+MOTOR_LOG_SIZE = 1000
+if LOG_MOTOR_DATA:
+    motor_log = task_share.Queue('f', 4 * MOTOR_LOG_SIZE, overwrite=True, name='Motor Log')
+    motor_log_row = array.array('f', [0, 0, 0, 0])
+
 imu = IMU(I2C(1, I2C.CONTROLLER))
 
-# Read Initial Heading
-initial_heading = imu.read_heading()/16 
+longitudinal_setpoint = .4  # Setpoint for longitudinal velocity (ft/s), used if calibration.json has no speed planner
+
+# Raises the velocity setpoint on straights and lowers it into curves. Settings are compared in
+# Host-Tools/course_sim.py before they go in calibration.json
+planner_settings = calibration.section('speed_planner', {'v_min': longitudinal_setpoint, 'v_max': longitudinal_setpoint,
+                                                         'accel': 1.0, 'decel': 3.0,
+                                                         'k_error': 0.1, 'k_rate': 0.01, 'k_yaw': 0.1})
+speed_planner = SpeedPlanner(**planner_settings)
+
+# Learn then race: a run with no course file learns the course and saves it when the lap is finished.
+# Later runs race from it, slowing for turns before the sensor sees them. Delete course.bin to learn again
+COURSE_FILE = 'course.bin'
+course_settings = calibration.section('course_memory', {'bin_ft': 0.1, 'v_max': 1.5, 'a_lat': 1.0, 'decel': 2.0,
+                                                        'preview_ft': 0.2, 'yaw_feedforward': 0.5, 'sync_ft': 0.5})
+course = CourseMemory(course_settings['bin_ft'])
+racing = course.load(COURSE_FILE)
+if racing:
+    course.plan(speed_planner.v_min, course_settings['v_max'], course_settings['a_lat'], course_settings['decel'])
+    speed_planner.v_max = course_settings['v_max']
+else:
+    course.learn()
+
+# Bridges dashes and short gaps in the line, then searches for it
+recovery_settings = calibration.section('line_recovery', {'bridge_ft': 0.25, 'bridge_s': 0.5, 'search_yaw_rate': 1.5,
+                                                          'search_angle': 1.0, 'search_speed': 0.0})
+line_recovery = LineRecovery(**recovery_settings)
+
+# Runs the outer loop less often at low speed and more often at high speed, within a CPU budget
+period_settings = calibration.section('outer_period', {'nominal_ms': 30, 'min_ms': 30, 'max_ms': 30,
+                                                       'ft_per_scan': 0.03, 'budget': 0.8, 'step_ms': 2})
+outer_period = PeriodGovernor(**period_settings)
+SUPERVISOR_PERIOD_MS = 100
+
+# The scheduler collects garbage in slack time once the free heap is below GC_THRESHOLD bytes, if the next
+# task isn't due for GC_MIN_SLACK_US or for as long as the last collection took
+GC_THRESHOLD = 16000
+GC_MIN_SLACK_US = 2000
+
+# The sensing task reads each sensor at its own rate and publishes the fused state in sensed_state,
+# so the outer loop reads no sensors itself. With line_ms None, the line sensor is read once per outer loop
+# period, as only the outer loop uses it
+sensing_settings = calibration.section('sensing', {'period_ms': 10, 'imu_ms': 10, 'line_ms': None, 'yaw_alpha': 0.0})
+sensed_state = task_share.StructShare(SensorFusion.FIELDS, thread_protect=False, name='Sensed State')
+fusion = SensorFusion(sensed_state, sensing_settings['yaw_alpha'])
+fusion.publish()
+
+# Set LOG_LINE_SCANS to log (distance, yaw rate, sensors seeing the line as bits) each outer loop run
+# to line_scans.csv, for replaying with Host-Tools/replay_recovery.py. The newest LINE_LOG_SIZE runs are kept
+LOG_LINE_SCANS = False
+LINE_LOG_SIZE = 500
+if LOG_LINE_SCANS:
+    line_log = task_share.Queue('f', 3 * LINE_LOG_SIZE, overwrite=True, name='Line Log')
+    line_log_row = array.array('f', [0, 0, 0])
+
+def hold_velocity(v, yaw_rate, dt=0.01):
+    """
+    One inner loop run of closed loop velocity and yaw rate control, for maneuver steps which hold them.
+    """
+    # Get the current motor speeds from encoders, which the inner loop keeps updated while a maneuver runs
+    if FIXED_POINT:
+        omega_left = to_float(fixed_encoder_left.speed)
+        omega_right = to_float(fixed_encoder_right.speed)
+    else:
+        omega_left = encoder_left.get_speed(update=False)
+        omega_right = encoder_right.get_speed(update=False)
+
+    kinematics.forward(omega_left, omega_right)
+    yaw_rate_measured = imu.read_yaw_rate()*math.pi/180
+
+    v_output = maneuver_controller_v.update(v, kinematics.v, dt)
+    yaw_output = maneuver_controller_yaw.update(yaw_rate, yaw_rate_measured, dt)
 
-longitudinal_setpoint = .4  # Setpoint for longitudinal velocity (ft/s)
+    # Calculate motor speeds using the decoupling matrix
+    kinematics.inverse(v_output, yaw_output)
+    omega_l = kinematics.omega_left
+    omega_r = kinematics.omega_right
+
+    # Update PI controllers for each motor, on top of the feedforward
+    left_pwm = left_feedforward.duty(omega_l) + left_motor_controller.update(omega_l, omega_left, dt)
+    right_pwm = right_feedforward.duty(omega_r) + right_motor_controller.update(omega_r, omega_right, dt)
+
+    drive.set_duties(left_pwm, right_pwm)  # Clamps to +/-100
+
+ENCODER_TICKS_PER_REV = 12 * 120  # Encoder counts per wheel revolution, as in Encoder
+feet_per_tick = 2 * math.pi * kinematics.wheel_radius / ENCODER_TICKS_PER_REV
+
+def odometer():
+    """
+    Distance driven by the middle of the Romi in feet, from the wheel encoders.
+    """
+    return (encoder_left.get_position() + encoder_right.get_position()) * feet_per_tick / 2
+
+def heading_ccw():
+    """
+    Heading in degrees increasing counterclockwise, like the yaw rate. The IMU's heading increases clockwise.
+    """
+    return 360 - imu.read_heading()/16
+
+# Maneuvers run by the inner loop: the detour around the round block and the finish and return.
+# maneuvers.json on the board replaces these, so the course can change without code edits
+DEFAULT_MANEUVERS = {
+    'round_block': [['distance', -0.35, 0.8, 0],    # Reverse
+                    ['turn_by', -70, 3.0],          # Turn 1
+                    ['hold', 1.0, 0.95, 3500],      # Arc around the block
+                    ['hold_line', 1.0, 0.95, 5000], # Keep arcing until the line is found
+                    ['duty', 23, -20, 0]],          # Small turn onto the line
+    'finish': [['distance', 0.6, 1.0, 0],           # Forward into finish
+               ['duty', 0, 0, 250],                 # Stop
+               ['turn_to', 0, 3.0],                 # Turn around to the starting heading
+               ['distance', 3.3, 1.0, 0]],          # Go straight back
+}
+maneuvers = Maneuver(drive, hold_velocity, heading_ccw, odometer, qtrx.is_line)
+maneuvers.load('maneuvers.json', DEFAULT_MANEUVERS)
+maneuvers.home_heading = heading_ccw()  # Read Initial Heading
+
+def start_maneuver(name):
+    """
+    Starts a maneuver sequence, with its velocity and yaw rate loops cleared of the last maneuver's state.
+    """
+    maneuver_controller_v.reset()
+    maneuver_controller_yaw.reset()
+    maneuvers.start(name)
+
+SETPOINT_TIMEOUT_MS = 200  # Stop the wheels if the outer loop hasn't published speeds for this long
+
+if INNER_LOOP_TIMER:
+    speed_loop = SpeedLoop(INNER_LOOP_TIMER_NUM, INNER_LOOP_HZ, (encoder_left, encoder_right),
+                           (left_motor_controller, right_motor_controller), (left_feedforward, right_feedforward),
+                           drive, motor_speeds, SETPOINT_TIMEOUT_MS, motor_log if LOG_MOTOR_DATA else None)
+
+# Set FIXED_POINT to run the inner loop task's wheel speed loop in Q8 fixed point, which allocates nothing
+# on the heap, so the garbage collector has to stop the tasks less often. Host-Tools/compare_fixed.py
+# compares it with the float loop
+FIXED_POINT = False
+if FIXED_POINT:
+    from fixedpoint import FixedPID, FixedFeedforward, FixedEncoder, to_fixed, to_float
+    fixed_encoder_left = FixedEncoder(encoder_left)
+    fixed_encoder_right = FixedEncoder(encoder_right)
+    fixed_left_controller = FixedPID(Kp_inner, Ki_inner, Kd_inner, 0.01, 100, integral_limit=100)
+    fixed_right_controller = FixedPID(Kp_inner, Ki_inner, Kd_inner, 0.01, 100, integral_limit=100)
+    fixed_left_feedforward = FixedFeedforward(motor_model['left_gain'], motor_model['left_offset'])
+    fixed_right_feedforward = FixedFeedforward(motor_model['right_gain'], motor_model['right_offset'])
 
 # Inner Loop Task for Motor Speed Control
 def inner_loop_task():
-    global last_trigger_time, call_round_block, round_block_state, round_block_start_time, final_step
+    global call_round_block, final_step
     # Initialize the motor and encoder objects using the user's specified pins and timers
       
     dt = 0.01 
-    duty = 20
-    turn_time = .65
-    left_correction = 3
 
     final_step = False
-    final_step_state = 0
+    finishing = False
+
+    speeds_version = -1  # Version of motor_speeds last read, so it's only unpacked when it changes
+    omega_left_set = 0.0
+    omega_right_set = 0.0
+    left_set_q8 = 0   # The setpoints in Q8 for the fixed point loop
+    right_set_q8 = 0
+    resumed_ms = time.ticks_ms()  # When the loop last took the motors back; the setpoints aren't stale before then
     
     while True:
-        while call_round_block:
-            if round_block_state == 0:
-                print("Start Reverse")
-                round_block_state = 1  #Start the round block by setting the state to 1
-                round_block_start_time = time.ticks_ms()
-            
-            elif round_block_state == 1: # Reverse
-                 motor_left.set_duty(-duty-left_correction)
-                 motor_right.set_duty(-duty)
-                 if time.ticks_diff(time.ticks_ms(),round_block_start_time) > 750:
-                     print("Start Turn 1")
-                     round_block_state = 2
-                     round_block_start_time = time.ticks_ms()
-                     
-            elif round_block_state == 2: # turn 1
-                 motor_left.set_duty(duty+left_correction)
-                 motor_right.set_duty(-duty)
-                 if time.ticks_diff(time.ticks_ms(),round_block_start_time) > int(turn_time*900):
-                     print("Start Straight 1")
-                     round_block_state = 3
-                     round_block_start_time = time.ticks_ms()                     
-                     
-            elif round_block_state == 3: # arc
-            
-                longitudinal_setpoint = 1  # Setpoint for longitudinal velocity (ft/s)
-                yaw_rate_setpoint = .95     # Setpoint for yaw rate (rad/s)
-                       
-                # Get the current motor speeds from encoders
-                omega_left = encoder_left.get_speed()
-                omega_right = encoder_right.get_speed()
-               
-                linear_velocity = ((omega_left*WHEEL_RADIUS) + (omega_right*WHEEL_RADIUS))/2
-                yaw_rate_measured = imu.read_yaw_rate()*math.pi/180
-                
-                v_output = outer_controller_v.update(longitudinal_setpoint, linear_velocity, dt)
-                yaw_output = outer_controller_yaw.update(yaw_rate_setpoint, yaw_rate_measured, dt)
-                
-                # Calculate motor speeds using the decoupling matrix
-                omega_l, omega_r = calculate_motor_speeds(v_output, yaw_output)
-                
-                # Update PI controllers for each motor
-                left_pwm = left_motor_controller.update(omega_l, omega_left, dt)
-                right_pwm = right_motor_controller.update(omega_r, omega_right, dt)
-                
-                if left_pwm > 100:
-                    left_pwm = 100
-                elif left_pwm < -100:
-                    left_pwm = -100
-                if right_pwm > 100:
-                    right_pwm = 100
-                elif right_pwm < -100:
-                    right_pwm = -100
-                    
-                motor_left.set_duty(left_pwm)
-                motor_right.set_duty(right_pwm)
-
-                if time.ticks_diff(time.ticks_ms(),round_block_start_time) > 3500:
-                     print("Start Straight 1")
-                     round_block_state = 4
-                     round_block_start_time = time.ticks_ms()                               
-                
-            elif round_block_state == 4: # find line
-                 if qtrx.is_line():
-                     motor_left.set_duty(duty+left_correction)
-                     motor_right.set_duty(-duty)
-                     print("Small Turn")
-                     if time.ticks_diff(time.ticks_ms(),round_block_start_time) > 400:
-                         print("Leaving Box Loop")
-                         round_block_state = 0
-                         call_round_block = False
-                         final_step = True
-                   
-            yield 0
-        
-        if final_step and crossed_line:
+        # Start a maneuver when the bumpers hit the round block, or when the finish line is crossed
+        if call_round_block and not maneuvers.running:
+            print("Start Round Block")
+            start_maneuver('round_block')
+        elif final_step and crossed_line and not finishing and not maneuvers.running:
             print("Final")
-            while True:
-                if final_step_state == 0:
-                    final_step_state = 1  #Start the round block by setting the state to 1
-                    round_block_start_time = time.ticks_ms()
-                
-                elif final_step_state == 1: # Forward into finish
-                    motor_left.set_duty(duty)
-                    motor_right.set_duty(duty)
-                    if time.ticks_diff(time.ticks_ms(),round_block_start_time) > 1200:
-                        print("Enter Finish")
-                        final_step_state = 2
-                        round_block_start_time = time.ticks_ms()
-                        
-                elif final_step_state == 2: # Stop
-                    motor_left.set_duty(0)
-                    motor_right.set_duty(0)
-                    if time.ticks_diff(time.ticks_ms(),round_block_start_time) > 1000:
-                        print("Stop")
-                        final_step_state = 3
-                        round_block_start_time = time.ticks_ms()
-
-                elif final_step_state == 3: # turn around
-                    motor_left.set_duty(10+left_correction)
-                    motor_right.set_duty(-10)
-                    if abs(initial_heading - imu.read_heading()/16) <= 0.5:
-                        print("Turn around")
-                        final_step_state = 4
-                        motor_left.set_duty(0)
-                        motor_right.set_duty(0)
-                        round_block_start_time = time.ticks_ms()
-
-                elif final_step_state == 4: # Go straight
-                        motor_left.set_duty(duty-.5)
-                        motor_right.set_duty(duty)  
-                        if time.ticks_diff(time.ticks_ms(),round_block_start_time) > 6600:
-                            print("Done")
-                            motor_left.set_duty(0)
-                            motor_right.set_duty(0)
-                            raise(KeyboardInterrupt)
-                
-                yield 0
+            finishing = True
+            start_maneuver('finish')
+
+        if maneuvers.running:
+            if INNER_LOOP_TIMER:
+                speed_loop.pause()  # The maneuver drives the motors itself
+            # Keep the distance and speeds current for the maneuver and the sensing task, also through
+            # duty steps, which read no speeds
+            if FIXED_POINT:
+                fixed_encoder_left.update()
+                fixed_encoder_right.update()
+            else:
+                encoder_left.update()
+                encoder_right.update()
+            if not maneuvers.run():
+                if finishing:
+                    print("Done")
+                    drive.set_duties(0, 0)
+                    raise(KeyboardInterrupt)
+                print("Leaving Box Loop")
+                if FIXED_POINT:
+                    # Start the wheel speed loop again from where the maneuver left the wheels
+                    fixed_left_controller.reset()
+                    fixed_right_controller.reset()
+                # The outer loop waited out the maneuver without publishing, so give it time to publish again
+                resumed_ms = time.ticks_ms()
+                call_round_block = False
+                final_step = True
+            yield 0
+            continue
+
+        if INNER_LOOP_TIMER:
+            speed_loop.resume()
+            yield 0
+            continue
+
+        # Retrieve target speeds from shared variables, but only when the outer loop has published new ones
+        if motor_speeds.changed_since(speeds_version):
+            speeds_version = motor_speeds.version()
+            omega_left_set, omega_right_set = motor_speeds.get()
+            if FIXED_POINT:
+                left_set_q8 = to_fixed(omega_left_set)
+                right_set_q8 = to_fixed(omega_right_set)
+
+        # If the outer loop has stopped publishing, stop rather than chase an old setpoint
+        if (motor_speeds.age_ms() > SETPOINT_TIMEOUT_MS
+                and time.ticks_diff(time.ticks_ms(), resumed_ms) > SETPOINT_TIMEOUT_MS):
+            omega_left_set = 0.0
+            omega_right_set = 0.0
+            left_set_q8 = 0
+            right_set_q8 = 0
+
+        if FIXED_POINT:
+            # The same loop with integers only
+            omega_left_q8 = fixed_encoder_left.update()
+            omega_right_q8 = fixed_encoder_right.update()
+            left_pwm_q8 = (fixed_left_feedforward.duty(left_set_q8)
+                           + fixed_left_controller.update(left_set_q8, omega_left_q8))
+            right_pwm_q8 = (fixed_right_feedforward.duty(right_set_q8)
+                            + fixed_right_controller.update(right_set_q8, omega_right_q8))
+            drive.set_duties_q8(left_pwm_q8, right_pwm_q8)
+            if LOG_MOTOR_DATA:
+                motor_log_row[0] = to_float(drive.left.output_q8)
+                motor_log_row[1] = to_float(omega_left_q8)
+                motor_log_row[2] = to_float(drive.right.output_q8)
+                motor_log_row[3] = to_float(omega_right_q8)
+                motor_log.put_many(motor_log_row)
+            yield 0
+            continue
 
         # Get the current motor speeds from encoders
         omega_left = encoder_left.get_speed()
         omega_right = encoder_right.get_speed()
-
-        # Retrieve target speeds from shared variables
-        omega_left_set = left_motor_speed.get()
-        omega_right_set = right_motor_speed.get()
         
-        # Update PI controllers for each motor
-        left_pwm = left_motor_controller.update(omega_left_set, omega_left, dt)
-        right_pwm = right_motor_controller.update(omega_right_set, omega_right, dt)
-        
-        if left_pwm > 100:
-            left_pwm = 100
-        elif left_pwm < -100:
-            left_pwm = -100
-        if right_pwm > 100:
-            right_pwm = 100
-        elif right_pwm < -100:
-            right_pwm = -100
-
-        # Set motor PWM duty cycles based on PI control output
-        motor_left.set_duty(left_pwm)
-        motor_right.set_duty(right_pwm)
+        # Update PI controllers for each motor, on top of the feedforward from the motor models
+        left_pwm = left_feedforward.duty(omega_left_set) + left_motor_controller.update(omega_left_set, omega_left, dt)
+        right_pwm = right_feedforward.duty(omega_right_set) + right_motor_controller.update(omega_right_set, omega_right, dt)
+
+        # Set motor PWM duty cycles based on PI control output, clamped to +/-100 by the drive
+        drive.set_duties(left_pwm, right_pwm)
+
+        # Log the duties the drive set, after clamping and slew, which the motor models are fitted to
+        if LOG_MOTOR_DATA:
+            motor_log_row[0] = drive.left.output
+            motor_log_row[1] = omega_left
+            motor_log_row[2] = drive.right.output
+            motor_log_row[3] = omega_right
+            motor_log.put_many(motor_log_row)
 
         yield 0  # Yield for multitasking
 
+# Sensing Task for reading the sensors and publishing the fused state
+def sensing_task():
+    period_ms = sensing_settings['period_ms']
+    imu_every = max(1, sensing_settings['imu_ms'] // period_ms)    # Runs between gyro readings
+    line_ms = sensing_settings['line_ms']
+    line_due = 0  # Runs until the line sensor is next read
+    runs = 0
+    while True:
+        # The inner loop or the speed loop keeps the encoders updated
+        if FIXED_POINT:
+            kinematics.forward(to_float(fixed_encoder_left.speed), to_float(fixed_encoder_right.speed))
+        else:
+            kinematics.forward(encoder_left.get_speed(update=False), encoder_right.get_speed(update=False))
+        fusion.wheels(kinematics.v, kinematics.yaw_rate, odometer())
+
+        if runs % imu_every == 0:
+            fusion.gyro(imu.read_yaw_rate()*math.pi/180)
+
+        if line_due <= 0:
+            raw_values = qtrx.read_all_sensors()
+            readings = [qtrx.threshold_reading(qtrx.normalize_reading(r, min_value=0, max_value=1000))
+                        for r in raw_values]
+            fusion.line(readings, qtrx.calculate_centroid(readings))
+            # The outer loop's period changes with speed, so it's looked up after each reading
+            line_due = max(1, int(line_ms if line_ms is not None else outer_period.period_ms) // period_ms)
+        line_due -= 1
+
+        fusion.publish()
+        runs += 1
+        yield 0
+
 # Outer Loop Task for Velocity and Yaw Rate Control
 def outer_loop_task():
-    alpha = 0
-    previous_filtered_yaw = 0
     global crossed_line
 
     #initial_heading = imu.read_heading()
     
-    dt = .03
+    preview = course_settings['preview_ft']        # How far ahead of the wheels to look up the course, ft
+    yaw_feedforward = course_settings['yaw_feedforward']
+    sync_ft = course_settings['sync_ft']           # How far from the odometry to look for a gap or cross line, ft
+    last_line_count = 0
+    period_changes = 0
     while True:
-        # Read actual velocity and yaw rate from IMU
-        # Get the current motor speeds from encoders
-        omega_left = encoder_left.get_speed()
-        omega_right = encoder_right.get_speed()
-        
-        linear_velocity = ((omega_left*WHEEL_RADIUS) + (omega_right*WHEEL_RADIUS))/2
-    
-        # Retrieve feedback values for the outer loop
-        v_measured = linear_velocity
-        yaw_rate_measured = imu.read_yaw_rate()*math.pi/180
-        filtered_yaw = alpha * previous_filtered_yaw + (1 - alpha) * yaw_rate_measured
-        previous_filtered_yaw = filtered_yaw
-
-        
-        # Line following logic
+        # The period changes with speed; the line gain is lowered when it's longer than the gains were tuned for
+        dt = outer_period.dt
+        if outer_period.changes != period_changes:
+            period_changes = outer_period.changes
+            line_controller.set_gains(Kp_line * outer_period.gain_scale, Ki_line, Kd_line)
 
-        raw_values = qtrx.read_all_sensors()
-        normalized_values = [qtrx.normalize_reading(r,min_value=0, max_value=1000) for r in raw_values]
-        thresholded_values = [qtrx.threshold_reading(n) for n in normalized_values]
-        centroid = qtrx.calculate_centroid(thresholded_values)
-        #print(thresholded_values)
+        # Retrieve feedback values for the outer loop, fused by the sensing task
+        v_measured, filtered_yaw, centroid, line_count, line_bits, distance = sensed_state.get()
 
-        
-        if final_step and sum(thresholded_values) >= 7:
+        if final_step and line_count >= 7:
             crossed_line = True
 
-        if centroid > 0:
+        # Follow the line while it's seen, otherwise bridge the gap or search for it
+        if line_count > 0:
             line_following_control_output = line_controller.update(3.5,centroid,dt)
+            line_error = centroid - 3.5  # In sensor pitches from the middle of the 8 sensors
         else:
             line_following_control_output = 0
+            line_error = 0
+        recovery_state = line_recovery.update(line_count > 0, line_following_control_output, line_error,
+                                              distance, filtered_yaw, dt)
+        line_following_control_output = line_recovery.yaw
+
+        # Faster on straights, slower into curves, no faster than line recovery allows
+        speed_setpoint = min(speed_planner.update(line_recovery.line_error, filtered_yaw, dt),
+                             line_recovery.speed_limit)
+
+        # Race from the learned course, or learn it
+        if racing:
+            # Re-align the course with the odometry where a gap or the cross line begins, as it did while learning
+            if line_count == 0 and last_line_count > 0:
+                course.sync(distance, FEATURE_GAP, sync_ft)
+            elif line_count >= 7 and last_line_count < 7:
+                course.sync(distance, FEATURE_CROSS, sync_ft)
+            if recovery_state == TRACKING or recovery_state == BRIDGING:
+                speed_setpoint = min(speed_setpoint, course.speed_at(distance + preview))
+                line_following_control_output += yaw_feedforward * v_measured * course.curvature_at(distance + preview)
+        else:
+            features = FEATURE_GAP if line_count == 0 else 0
+            if line_count >= 7:
+                features |= FEATURE_CROSS
+            course.record(distance, v_measured, filtered_yaw, features)
+        last_line_count = line_count
+
+        if LOG_LINE_SCANS:
+            line_log_row[0] = distance
+            line_log_row[1] = filtered_yaw
+            line_log_row[2] = line_bits
+            line_log.put_many(line_log_row)
 
         # Update PI controllers for longitudinal and yaw control
-        v_output = outer_controller_v.update(longitudinal_setpoint, v_measured, dt)
+        v_output = outer_controller_v.update(speed_setpoint, v_measured, dt)
         yaw_output = outer_controller_yaw.update(line_following_control_output, filtered_yaw, dt)
         
-        # Calculate motor speeds using the decoupling matrix
-        omega_l, omega_r = calculate_motor_speeds(v_output, yaw_output)
-        
-        while call_round_block:
-            yield 0 
+        # Leave the motors to a maneuver, from the bumpers or the finish, until it's done
+        if call_round_block or maneuvers.running:
+            while call_round_block or maneuvers.running:
+                yield 0
+            speed_planner.reset()  # Build speed up again from the end of the maneuver
+            outer_controller_v.reset()
+            outer_controller_yaw.reset()
+
+        # Calculate motor speeds using the decoupling matrix. The inner loop shares the kinematics
+        # object, so convert after waiting and publish before yielding
+        kinematics.inverse(v_output, yaw_output)
 
         # Update shared variables for inner loop control
-        left_motor_speed.put(omega_l)
-        right_motor_speed.put(omega_r)
+        motor_speeds.put(kinematics.omega_left, kinematics.omega_right)
 
         yield 0  # Yield for multitasking
 
+# Supervisor Task for fitting the outer loop period to the speed
+def supervisor_task():
+    while True:
+        outer_period.update(sensed_state.get()[0])
+        yield 0
+
 if __name__ == "__main__":
     calibrate_imu_before_running()
     time.sleep(5)                 # Break to romi in the right position to run
     
     # Task Scheduler Setup
-    task_inner = cotask.Task(inner_loop_task, name='InnerLoop', priority=2, period=10, profile=True, trace=False)
-    task_outer = cotask.Task(outer_loop_task, name='OuterLoop', priority=1, period=30, profile=True, trace=False)
+    task_inner = cotask.Task(inner_loop_task, name='InnerLoop', priority=2, period=10, profile=True, trace=True,
+                             overrun=cotask.OVERRUN_SKIP)
+    task_sensing = cotask.Task(sensing_task, name='Sensing', priority=2, period=sensing_settings['period_ms'],
+                               profile=True, trace=True, overrun=cotask.OVERRUN_SKIP)
+    task_outer = cotask.Task(outer_loop_task, name='OuterLoop', priority=1, period=outer_period.nominal_ms,
+                             profile=True, trace=True, overrun=cotask.OVERRUN_SKIP)
+    task_supervisor = cotask.Task(supervisor_task, name='Supervisor', priority=0, period=SUPERVISOR_PERIOD_MS,
+                                  profile=True)
 
     # Add tasks to the scheduler task list
     cotask.task_list.append(task_inner)
+    cotask.task_list.append(task_sensing)
     cotask.task_list.append(task_outer)
+    cotask.task_list.append(task_supervisor)
+    outer_period.govern(task_outer, cotask.task_list)
 
     # Setup external interrupts
     pyb.ExtInt(BMP0, pyb.ExtInt.IRQ_FALLING, pyb.Pin.PULL_UP, bumper_isr)
@@ -383,15 +611,62 @@ if __name__ == "__main__":
     pyb.ExtInt(BMP4, pyb.ExtInt.IRQ_FALLING, pyb.Pin.PULL_UP, bumper_isr)
     pyb.ExtInt(BMP5, pyb.ExtInt.IRQ_FALLING, pyb.Pin.PULL_UP, bumper_isr)
 
-    # Run the task scheduler
-    while True:
-        try:
-            cotask.task_list.pri_sched()
-        except KeyboardInterrupt:
-            mot_A = Motor(Timer(1, freq=20000), Pin.cpu.A8, Pin.cpu.B10, Pin.cpu.B4)  # Replace with actual pins
-            mot_B = Motor(Timer(4, freq=20000), Pin.cpu.B6, Pin.cpu.C7, Pin.cpu.A9)
-            mot_A.set_duty(0)
-            mot_B.set_duty(0)
-            break
+    if INNER_LOOP_TIMER:
+        micropython.alloc_emergency_exception_buf(100)  # So errors in the timer interrupt can be reported
+        speed_loop.start()
+
+    # Collect garbage when no task is ready rather than whenever the heap fills, which may be in the
+    # middle of the inner loop, and not so close to a speed loop interrupt that it would delay the loop
+    cotask.task_list.schedule_gc(GC_THRESHOLD, GC_MIN_SLACK_US)
+    if INNER_LOOP_TIMER:
+        cotask.task_list.add_deadline(speed_loop.slack_us)
+
+    # Run the task scheduler, turning automatic garbage collection back on however it stops
+    try:
+        while True:
+            try:
+                cotask.task_list.pri_sched()
+            except KeyboardInterrupt:
+                if INNER_LOOP_TIMER:
+                    speed_loop.stop()
+                drive.stop()
+                break
+    finally:
+        cotask.task_list.schedule_gc(None)
         
     print('\n' + str (cotask.task_list))
+    if INNER_LOOP_TIMER:
+        print(speed_loop)
+    print(outer_period)
+    print(line_recovery)
+    if racing:
+        print('Course re-aligned {} times'.format(course.syncs))
+    print(task_share.memory_summary())
+
+    # Save task profiles, including run time and lateness histograms
+    with open('profile.csv', 'w') as profile_file:
+        profile_file.write(cotask.task_list.export_profile())
+
+    # Save the learned course once a whole lap has been driven
+    if not racing and crossed_line:
+        course.plan(speed_planner.v_min, course_settings['v_max'], course_settings['a_lat'], course_settings['decel'])
+        course.save(COURSE_FILE)
+        print('Saved {} ft of course to {}'.format(course.count * course.bin_ft, COURSE_FILE))
+
+    # Save the line scans for Host-Tools/replay_recovery.py
+    if LOG_LINE_SCANS:
+        with open('line_scans.csv', 'w') as log_file:
+            log_file.write('distance,yaw_rate,sensors\n')
+            while line_log.get_many(line_log_row) == 3:
+                log_file.write('{},{},{}\n'.format(line_log_row[0], line_log_row[1], int(line_log_row[2])))
+
+    # Save the motor log for Host-Tools/identify_motor.py
+    if LOG_MOTOR_DATA:
+        with open('motor_log.csv', 'w') as log_file:
+            log_file.write('duty_l,speed_l,duty_r,speed_r\n')
+            while motor_log.get_many(motor_log_row) == 4:
+                log_file.write('{},{},{},{}\n'.format(*motor_log_row))
+
+    # Save state transition traces for decoding with Host-Tools/trace_decode.py
+    with open('trace.bin', 'wb') as trace_file:
+        cotask.task_list.dump_traces(trace_file)
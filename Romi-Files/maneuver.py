@@ -0,0 +1,282 @@
+import array
+import json
+import math
+import time
+
+# Operation codes of the steps in a maneuver table. Each step has an operation and three parameters:
+# OP_DUTY      = left duty, right duty, time in ms
+# OP_HOLD      = velocity in ft/s, yaw rate in rad/s, time in ms
+# OP_HOLD_LINE = velocity in ft/s, yaw rate in rad/s, longest time in ms; ends early when the line is seen
+# OP_TURN_TO   = heading in degrees counterclockwise from the home heading, largest yaw rate in rad/s
+# OP_TURN_BY   = angle in degrees counterclockwise from the heading at the start of the step, largest yaw rate
+# OP_DISTANCE  = distance in feet, negative to reverse, largest speed in ft/s, yaw rate in rad/s at that speed
+# OP_END       = ends the sequence
+OP_END = 0
+OP_DUTY = 1
+OP_HOLD = 2
+OP_HOLD_LINE = 3
+OP_TURN_TO = 4
+OP_TURN_BY = 5
+OP_DISTANCE = 6
+
+# Names of the operations as written in maneuver files
+OP_NAMES = {"end": OP_END, "duty": OP_DUTY, "hold": OP_HOLD, "hold_line": OP_HOLD_LINE, "turn_to": OP_TURN_TO,
+            "turn_by": OP_TURN_BY, "distance": OP_DISTANCE}
+
+PARAMS_PER_STEP = 3
+
+
+class Maneuver:
+    """
+    @brief Class to run sequences of motion steps, such as the detour around the round block
+
+    @detail Sequences are lists of steps like ["duty", -23, -20, 750], loaded once into a preallocated table
+            of operation codes and parameters. run() is called every inner loop run and does one step's
+            work, so a sequence takes the same small time each run however long it is, and courses can be
+            changed by editing the maneuver file rather than the code.
+
+            Turn and distance steps end on the IMU heading and the wheel encoders rather than on time, so they
+            don't change as the battery runs down. Each slows down over its end at a constant deceleration.
+            So that a stalled wheel can't stop the sequence, each also ends after timeout_scale times as
+            long as its angle or distance should take at its speed, plus timeout_margin_ms.
+
+    """
+
+    def __init__ (self, drive, hold, heading, distance, line, size=32):
+        """
+        @brief Init for the maneuver engine
+
+        @param drive = MotorPair driving the wheels
+
+        @param hold = function hold(v, yaw_rate) which runs one step of closed loop velocity and yaw rate control
+
+        @param heading = function which returns the heading in degrees, increasing counterclockwise like the yaw rate
+
+        @param distance = function which returns the distance driven in feet, from the wheel encoders
+
+        @param line = function which returns True if the line sensor sees the line
+
+        @param size = most steps the table can hold, including one end step per sequence
+
+        """
+        self.drive = drive
+        self.hold = hold
+        self.heading = heading
+        self.distance = distance
+        self.line = line
+
+        # Table of steps, filled by add()
+        self.size = size
+        self.ops = array.array('B', [OP_END] * size)
+        self.params = array.array('f', [0] * (PARAMS_PER_STEP * size))
+        self.used = 0
+        self.starts = {}  # Index of the first step of each sequence, by name
+
+        # Heading which turn_to steps are measured from, and how close a turn has to get
+        self.home_heading = 0
+        self.heading_tolerance = 0.5
+
+        # Deceleration at the end of distance steps in ft/s^2 and turns in rad/s^2, and the slowest speeds
+        # used near the end so that steps always finish
+        self.decel = 1.5
+        self.turn_decel = 10.0
+        self.min_speed = 0.15
+        self.min_yaw_rate = 0.4
+
+        # Turn and distance steps time out after timeout_scale times their expected time plus timeout_margin_ms
+        self.timeout_scale = 2.0
+        self.timeout_margin_ms = 1000
+        self.step_timeout = 0  # Timeout of the current step, ms
+
+        # State of the running sequence, with the heading and distance when the step started
+        self.running = False
+        self.step = 0
+        self.step_start = 0
+        self.step_heading = 0
+        self.step_distance = 0
+
+    def add (self, name, steps):
+        """
+        @brief Adds a sequence to the table
+
+        @param name = name used to start the sequence
+
+        @param steps = list of steps, each a list of an operation name and up to three parameters
+
+        """
+        if self.used + len(steps) + 1 > self.size:
+            raise ValueError("Maneuver table is full")
+        for step in steps:
+            if step[0] not in OP_NAMES:
+                raise ValueError("Unknown operation {} in maneuver {}".format(step[0], name))
+            op = OP_NAMES[step[0]]
+            if (op == OP_TURN_TO or op == OP_TURN_BY or op == OP_DISTANCE) and (len(step) < 3 or step[2] <= 0):
+                raise ValueError("{} step in maneuver {} needs a speed above 0".format(step[0], name))
+        self.starts[name] = self.used
+        for step in steps:
+            base = PARAMS_PER_STEP * self.used
+            self.ops[self.used] = OP_NAMES[step[0]]
+            for n in range(PARAMS_PER_STEP):
+                self.params[base + n] = step[n + 1] if n + 1 < len(step) else 0
+            self.used += 1
+        self.ops[self.used] = OP_END
+        self.used += 1
+
+    def load (self, filename, defaults):
+        """
+        @brief Adds the sequences in a maneuver file to the table
+
+        @detail The file is a JSON object of named lists of steps. Sequences in defaults which are missing
+                from the file, or all of them if there is no file, are added from defaults.
+
+        @param filename = name of the maneuver file on the board's filesystem
+
+        @param defaults = dictionary of sequences to use when the file doesn't give them
+
+        """
+        try:
+            with open(filename) as f:
+                sequences = json.load(f)
+        except (OSError, ValueError):
+            sequences = {}
+        for name in defaults:
+            if name not in sequences:
+                sequences[name] = defaults[name]
+        for name in sequences:
+            self.add(name, sequences[name])
+
+    def start (self, name):
+        """
+        @brief Starts running a sequence from its first step
+
+        @param name = name of the sequence
+
+        """
+        self.step = self.starts[name]
+        self.begin_step()
+
+    def next_step (self):
+        """
+        @brief Moves on to the next step of the running sequence
+        """
+        self.step += 1
+        self.begin_step()
+
+    def begin_step (self):
+        """
+        @brief Notes the time, and the heading and distance for steps which need them, as a step starts
+
+        @detail Turn and distance steps also work out their timeouts from how far they have to go.
+
+        """
+        op = self.ops[self.step]
+        base = PARAMS_PER_STEP * self.step
+        params = self.params
+        self.running = op != OP_END
+        self.step_start = time.ticks_ms()
+        if op == OP_TURN_TO or op == OP_TURN_BY:
+            self.step_heading = self.heading()
+            if op == OP_TURN_TO:
+                angle = abs((self.home_heading + params[base] - self.step_heading + 180) % 360 - 180)
+            else:
+                angle = abs(params[base])
+            self.set_timeout(angle * math.pi / 180, params[base + 1], self.turn_decel)
+        elif op == OP_DISTANCE:
+            self.step_distance = self.distance()
+            self.set_timeout(abs(params[base]), params[base + 1], self.decel)
+
+    def set_timeout (self, length, speed, decel):
+        """
+        @brief Works out the timeout of a turn or distance step
+
+        @param length = angle to turn in rad, or distance to drive in ft
+
+        @param speed = largest yaw rate in rad/s, or speed in ft/s
+
+        @param decel = deceleration at the end of the step
+
+        """
+        expected = length / speed + speed / (2 * decel)
+        self.step_timeout = self.timeout_scale * 1000 * expected + self.timeout_margin_ms
+
+    def turn (self, target, max_rate):
+        """
+        @brief One run of a closed loop turn on the spot to a heading, slowing down as it gets close
+
+        @param target = heading to turn to in degrees
+
+        @param max_rate = largest yaw rate in rad/s
+
+        """
+        # Heading error wrapped to -180 to 180 degrees
+        error = (target - self.heading() + 180) % 360 - 180
+        if abs(error) <= self.heading_tolerance:
+            self.drive.set_duties(0, 0)
+            self.next_step()
+            return
+        rate = math.sqrt(2 * self.turn_decel * abs(error) * math.pi / 180)
+        if rate > max_rate:
+            rate = max_rate
+        elif rate < self.min_yaw_rate:
+            rate = self.min_yaw_rate
+        self.hold(0, rate if error > 0 else -rate)
+
+    def run (self):
+        """
+        @brief Does one run's work of the current step
+
+        @detail Call once every inner loop run while a sequence is running.
+
+        @return True if the sequence is still running
+
+        """
+        if not self.running:
+            return False
+        op = self.ops[self.step]
+        base = PARAMS_PER_STEP * self.step
+        params = self.params
+        elapsed = time.ticks_diff(time.ticks_ms(), self.step_start)
+
+        if op == OP_DUTY:
+            self.drive.set_duties(params[base], params[base + 1])
+            if elapsed >= params[base + 2]:
+                self.next_step()
+
+        elif op == OP_HOLD:
+            self.hold(params[base], params[base + 1])
+            if elapsed >= params[base + 2]:
+                self.next_step()
+
+        elif op == OP_HOLD_LINE:
+            self.hold(params[base], params[base + 1])
+            if self.line() or elapsed >= params[base + 2]:
+                self.next_step()
+
+        elif (op == OP_TURN_TO or op == OP_TURN_BY or op == OP_DISTANCE) and elapsed >= self.step_timeout:
+            self.drive.set_duties(0, 0)
+            self.next_step()
+
+        elif op == OP_TURN_TO:
+            self.turn(self.home_heading + params[base], params[base + 1])
+
+        elif op == OP_TURN_BY:
+            self.turn(self.step_heading + params[base], params[base + 1])
+
+        elif op == OP_DISTANCE:
+            target = params[base]
+            speed = params[base + 1]
+            travelled = self.distance() - self.step_distance
+            remaining = target - travelled if target > 0 else travelled - target
+            if remaining <= 0:
+                self.drive.set_duties(0, 0)
+                self.next_step()
+            else:
+                # Slow down to stop at the end, keeping the radius of any arc
+                v = math.sqrt(2 * self.decel * remaining)
+                if v > speed:
+                    v = speed
+                elif v < self.min_speed:
+                    v = self.min_speed
+                self.hold(v if target > 0 else -v, params[base + 2] * v / speed)
+
+        return self.running
@@ -14,7 +14,7 @@ class Motor:
 
     """
 
-    def __init__ (self, PWM_tim, PWM_pin, DIR_pin, SLP_pin):
+    def __init__ (self, PWM_tim, PWM_pin, DIR_pin, SLP_pin, fast=False):
         """
         @brief Init for Romi motor
 
@@ -28,6 +28,8 @@ class Motor:
 
         @param DIR_pin = pin for PH of motor
 
+        @param fast = if True, set_duty is replaced by set_duty_fast
+
         """   
         # Pin declaration
         self.DIR = Pin(DIR_pin, mode=Pin.OUT_PP)
@@ -38,6 +40,26 @@ class Motor:
         self.CH1 = PWM_tim.channel(1, Timer.PWM, pin=PWM_pin)
         self.CH1.pulse_width_percent(0)
 
+        # Timer counts per percent of duty, and the direction and compare value last written,
+        # so that set_duty_fast only writes what has changed
+        self.counts_per_percent = (PWM_tim.period() + 1) / 100
+        self.counts_per_percent_q8 = int(self.counts_per_percent * 256)  # For prepare_duty_q8
+        self.DIR.low()
+        self.direction = 0
+        self.compare = 0
+        self.next_direction = 0
+        self.next_compare = 0
+
+        # Optional output stage, off until set_output_stage is called
+        self.slew = 0
+        self.deadband = 0
+        self.deadband_scale = 1
+        self.output = 0     # Duty last set, after clamping and slew but before the deadband
+        self.output_q8 = 0  # The same times 256, kept by prepare_duty_q8
+
+        if fast:
+            self.set_duty = self.set_duty_fast
+
     def set_duty (self, duty):
         """
         @brief Main function for class, turns on motor to set duty cycle
@@ -57,6 +79,133 @@ class Motor:
             self.CH1.pulse_width_percent(-duty)
         else:
             print("Error, -100 < duty cycle < 100")
+
+    def set_duty_fast (self, duty):
+        """
+        @brief Sets duty cycle like set_duty, but only writes to the hardware when something changes
+
+        @detail Duty cycles outside -100 to 100 are clamped instead of printing an error, since printing
+                blocks on the UART which is also the REPL. The duty is turned into a raw timer compare
+                count, and the DIR pin and compare register are only written when they differ from the
+                values last written. The DIR pin is left alone at zero duty, as set_duty does.
+
+        @param duty = duty cycle for motor, -100 to 100
+
+        """
+        self.prepare_duty(duty)
+        self.write_direction()
+        self.write_compare()
+
+    def prepare_duty (self, duty):
+        """
+        @brief Works out the direction and compare count for a duty cycle without writing them
+
+        @detail The results are kept in next_direction and next_compare for write_direction and
+                write_compare. Splitting the work lets MotorPair do the arithmetic for both motors
+                before writing either of them.
+
+        @param duty = duty cycle for motor, clamped to -100 to 100
+
+        """
+        if duty > 100:
+            duty = 100
+        elif duty < -100:
+            duty = -100
+
+        # Limit how fast the duty may change, then remember the limited duty
+        if self.slew:
+            if duty > self.output + self.slew:
+                duty = self.output + self.slew
+            elif duty < self.output - self.slew:
+                duty = self.output - self.slew
+        self.output = duty
+
+        # Stretch the duty over the range in which the motor actually turns
+        if self.deadband:
+            if duty > 0:
+                duty = self.deadband + duty * self.deadband_scale
+            elif duty < 0:
+                duty = duty * self.deadband_scale - self.deadband
+
+        if duty < 0:
+            self.next_compare = int(-duty * self.counts_per_percent)
+            self.next_direction = 1
+        else:
+            self.next_compare = int(duty * self.counts_per_percent)
+            self.next_direction = 0
+
+    def prepare_duty_q8 (self, duty):
+        """
+        @brief Works out the direction and compare count like prepare_duty, for a duty in Q8 fixed point
+
+        @detail Only integers are used, so nothing is allocated on the heap, as long as there is no
+                output stage and the timer period is below 16384 counts, which keeps duty times
+                counts_per_percent_q8 under MicroPython's small int limit of 2**30. Otherwise the duty
+                is converted and passed to prepare_duty.
+
+        @param duty = duty cycle for motor times 256, clamped to -25600 to 25600
+
+        """
+        if self.slew or self.deadband or self.counts_per_percent_q8 > 41943:
+            self.prepare_duty(duty / 256)
+            self.output_q8 = int(self.output * 256)
+            return
+
+        if duty > 25600:
+            duty = 25600
+        elif duty < -25600:
+            duty = -25600
+        self.output = duty >> 8
+        self.output_q8 = duty
+
+        if duty < 0:
+            self.next_compare = (-duty * self.counts_per_percent_q8) >> 16
+            self.next_direction = 1
+        else:
+            self.next_compare = (duty * self.counts_per_percent_q8) >> 16
+            self.next_direction = 0
+
+    def set_output_stage (self, slew=0, deadband=0):
+        """
+        @brief Sets up slew rate limiting and deadband compensation for prepare_duty
+
+        @detail The output stage is used by set_duty_fast and MotorPair, not by set_duty. Each call
+                may change the duty by at most slew percent from the duty of the call before, so a
+                command like +23 to -20 is spread over several control ticks instead of jumping at
+                once. A nonzero duty d is then mapped to deadband + d * (100 - deadband) / 100 with
+                the sign of d, so that small commands aren't lost in the static friction of the
+                motor, while zero still means stopped and 100 still means full duty. Both are a few
+                multiplications and comparisons per call and allocate nothing.
+
+        @param slew = largest change in duty per call in percent, or 0 for no limit
+
+        @param deadband = duty in percent below which the motor doesn't turn, or 0 for none
+
+        """
+        self.slew = slew
+        self.deadband = deadband
+        self.deadband_scale = (100 - deadband) / 100
+
+    def write_direction (self):
+        """
+        @brief Writes the prepared direction to the DIR pin if it changed and the duty isn't zero
+
+        """
+        if self.next_compare != 0 and self.next_direction != self.direction:
+            if self.next_direction:
+                self.DIR.high()
+            else:
+                self.DIR.low()
+            self.direction = self.next_direction
+
+    def write_compare (self):
+        """
+        @brief Writes the prepared compare count to the timer if it changed
+
+        """
+        if self.next_compare != self.compare:
+            self.CH1.pulse_width(self.next_compare)
+            self.compare = self.next_compare
     
     def enable (self):
         """
@@ -71,3 +220,98 @@ class Motor:
 
         """    
         self.SLP.low()
+
+
+class MotorPair:
+    """
+    @brief Class to drive the left and right motors together
+
+    @detail Both motors' new settings are worked out before either is written, then the direction pins
+            and the PWM compare registers are written back to back, so the wheels get new commands at
+            nearly the same instant.
+
+    """
+
+    def __init__ (self, left, right):
+        """
+        @brief Init for a pair of motors
+
+        @param left = Motor object for the left wheel
+
+        @param right = Motor object for the right wheel
+
+        """
+        self.left = left
+        self.right = right
+
+    def set_duties (self, left_duty, right_duty):
+        """
+        @brief Sets the duty cycles of both motors with minimal skew between them
+
+        @detail Duty cycles are clamped to -100 to 100, and only settings which changed are written.
+
+        @param left_duty = duty cycle for left motor
+
+        @param right_duty = duty cycle for right motor
+
+        """
+        self.left.prepare_duty(left_duty)
+        self.right.prepare_duty(right_duty)
+        self.left.write_direction()
+        self.right.write_direction()
+        self.left.write_compare()
+        self.right.write_compare()
+
+    def set_duties_q8 (self, left_duty, right_duty):
+        """
+        @brief Sets the duty cycles of both motors like set_duties, from duties in Q8 fixed point
+
+        @param left_duty = duty cycle for left motor times 256
+
+        @param right_duty = duty cycle for right motor times 256
+
+        """
+        self.left.prepare_duty_q8(left_duty)
+        self.right.prepare_duty_q8(right_duty)
+        self.left.write_direction()
+        self.right.write_direction()
+        self.left.write_compare()
+        self.right.write_compare()
+
+    def stop (self, disable=False):
+        """
+        @brief Stops both motors at once
+
+        @detail Zero duty is written to both timers whatever was written before, so this is safe to
+                call after an error has left the cached settings in doubt.
+
+        @param disable = if True, also put both motor drivers to sleep
+
+        """
+        self.left.CH1.pulse_width(0)
+        self.right.CH1.pulse_width(0)
+        self.left.compare = 0
+        self.right.compare = 0
+        self.left.output = 0
+        self.right.output = 0
+        self.left.output_q8 = 0
+        self.right.output_q8 = 0
+        if disable:
+            self.left.disable()
+            self.right.disable()
+
+    def enable (self):
+        """
+        @brief Enables both motors
+
+        """
+        self.left.enable()
+        self.right.enable()
+
+    def disable (self):
+        """
+        @brief Disables both motors
+
+        """
+        self.left.disable()
+        self.right.disable()
@@ -0,0 +1,124 @@
+class PeriodGovernor:
+    """
+    @brief Class to change a task's period with the robot's speed, within a CPU budget
+
+    @detail The period is chosen so the robot drives ft_per_scan between runs of the task. At low speed
+            the line hardly moves between scans, so the task runs less often and leaves time to the
+            others; at high speed it runs more often, down to min_ms. Whatever the speed, the period is
+            kept long enough that all profiled tasks together use no more than budget of the CPU,
+            working out each task's share as its average run time from the profile over its period.
+            The period is only changed when it would move by step_ms or more, so noise in the speed
+            doesn't change it on every update.
+
+            The governed task reads dt for its own period in seconds and gain_scale, which is 1 at
+            nominal_ms and less at longer periods. Integral and derivative terms already use dt, so
+            gain_scale is for proportional gains, so the correction made on each run doesn't grow as
+            the runs get further apart.
+
+    """
+
+    def __init__ (self, nominal_ms=30, min_ms=30, max_ms=30, ft_per_scan=0.03, budget=0.8, step_ms=2):
+        """
+        @brief Init for the governor, which doesn't change anything until govern() is called
+
+        @detail With the defaults, min_ms = max_ms, the period stays at 30 ms.
+
+        @param nominal_ms = period the task starts at and its gains are tuned for, ms
+
+        @param min_ms = shortest period, ms
+
+        @param max_ms = longest period, ms
+
+        @param ft_per_scan = distance to drive between runs, ft
+
+        @param budget = largest share of the CPU for all profiled tasks together, 0 to 1
+
+        @param step_ms = smallest change of period to make, ms
+
+        """
+        self.nominal_ms = nominal_ms
+        self.min_ms = min_ms
+        self.max_ms = max_ms
+        self.ft_per_scan = ft_per_scan
+        self.budget = budget
+        self.step_ms = step_ms
+
+        self.task = None
+        self.task_list = None
+
+        self.period_ms = nominal_ms
+        self.dt = nominal_ms / 1000  # Period of the governed task, s
+        self.gain_scale = 1.0
+        self.changes = 0             # Number of period changes, so the task can tell when to rescale gains
+        self.limited = 0             # Updates in which the budget lengthened the period
+
+    def govern (self, task, task_list):
+        """
+        @brief Starts governing a task
+
+        @param task = cotask.Task whose period is changed
+
+        @param task_list = cotask.TaskList holding it and the tasks it shares the CPU with
+
+        """
+        self.task = task
+        self.task_list = task_list
+
+    def utilization (self):
+        """
+        @brief Works out the share of the CPU used by the profiled tasks other than the governed one
+
+        @return A tuple of that share, 0 to 1, and the average run time of the governed task in us, or
+                None if it hasn't been profiled yet
+
+        """
+        other = 0.0
+        own = None
+        for pri in self.task_list.pri_list:
+            for task in pri[2:]:
+                mean = task.get_mean_duration()
+                if mean is None or task.period is None:
+                    continue
+                if task is self.task:
+                    own = mean
+                else:
+                    other += mean / task.period
+        return other, own
+
+    def update (self, v):
+        """
+        @brief Works out the period for the measured speed and sets it if it has changed enough
+
+        @param v = measured forward speed, ft/s
+
+        """
+        if self.task is None:
+            return
+
+        speed = abs(v)
+        if speed * self.max_ms > 1000 * self.ft_per_scan:
+            period = 1000 * self.ft_per_scan / speed
+        else:
+            period = self.max_ms
+        if period < self.min_ms:
+            period = self.min_ms
+
+        # Keep within the CPU budget
+        other, own = self.utilization()
+        if own is not None:
+            spare = self.budget - other
+            shortest = own / (1000 * spare) if spare > 0 else self.max_ms
+            if period < shortest:
+                period = shortest if shortest < self.max_ms else self.max_ms
+                self.limited += 1
+
+        if abs(period - self.period_ms) >= self.step_ms:
+            self.period_ms = period
+            self.task.set_period(period)
+            self.dt = period / 1000
+            self.gain_scale = self.nominal_ms / period if period > self.nominal_ms else 1.0
+            self.changes += 1
+
+    def __repr__ (self):
+        return ('PeriodGovernor: {:.1f} ms, {} changes, {} limited by the CPU budget'
+                .format(self.period_ms, self.changes, self.limited))
@@ -0,0 +1,92 @@
+class SensorFusion:
+    """
+    @brief Class to keep the robot's latest state from sensors which are read at different rates
+
+    @detail Each sensor's reading is given to its own method whenever that sensor is read, and publish()
+            puts the whole state into a StructShare, so control tasks get a consistent state without
+            reading any sensors themselves.
+
+            The yaw rate is a complementary filter of the gyro and the wheels. Each gyro reading is low
+            pass filtered with yaw_alpha. Between gyro readings, the change in the yaw rate from the
+            wheel speeds since the last gyro reading is added, so the estimate follows quick turns at
+            the rate of the encoders, while the gyro keeps wheel slip from building up.
+
+    """
+
+    # Type codes of the published fields: v, yaw rate, centroid, line count, line bits, distance
+    FIELDS = 'fffBBf'
+
+    def __init__ (self, state, yaw_alpha=0.0):
+        """
+        @brief Init for the sensor fusion
+
+        @param state = StructShare made with the SensorFusion.FIELDS type codes, to publish to
+
+        @param yaw_alpha = weight of the old yaw rate in the gyro filter, 0 for no filtering, below 1
+
+        """
+        self.state = state
+        self.yaw_alpha = yaw_alpha
+
+        self.v = 0.0                # Forward velocity from the wheels, ft/s
+        self.distance = 0.0         # Distance driven from the wheels, ft
+        self.yaw_rate = 0.0         # Fused yaw rate, rad/s, positive turning left
+        self.centroid = 0.0         # Line position on the sensor, 0 to 7, or 0 if no sensor sees it
+        self.line_count = 0         # Number of sensors seeing the line
+        self.line_bits = 0          # Sensors seeing the line, as bits with sensor 0 in bit 0
+
+        self.gyro_yaw_rate = 0.0    # Filtered gyro yaw rate, rad/s
+        self.wheel_yaw_rate = 0.0   # Latest yaw rate from the wheel speeds, rad/s
+        self.wheel_yaw_at_gyro = 0.0  # Wheel yaw rate when the gyro was last read, rad/s
+
+    def wheels (self, v, yaw_rate, distance):
+        """
+        @brief Takes a reading of the wheel encoders
+
+        @param v = forward velocity from the wheel speeds, ft/s
+
+        @param yaw_rate = yaw rate from the wheel speeds, rad/s
+
+        @param distance = distance driven from the wheel positions, ft
+
+        """
+        self.v = v
+        self.distance = distance
+        self.wheel_yaw_rate = yaw_rate
+        self.yaw_rate = self.gyro_yaw_rate + yaw_rate - self.wheel_yaw_at_gyro
+
+    def gyro (self, yaw_rate):
+        """
+        @brief Takes a reading of the gyro
+
+        @param yaw_rate = measured yaw rate, rad/s
+
+        """
+        self.gyro_yaw_rate = self.yaw_alpha * self.gyro_yaw_rate + (1 - self.yaw_alpha) * yaw_rate
+        self.wheel_yaw_at_gyro = self.wheel_yaw_rate
+        self.yaw_rate = self.gyro_yaw_rate
+
+    def line (self, readings, centroid):
+        """
+        @brief Takes a reading of the line sensor
+
+        @param readings = thresholded readings, 1 where a sensor sees the line and 0 where it doesn't
+
+        @param centroid = line position found from the readings by QTRX.calculate_centroid
+
+        """
+        count = 0
+        bits = 0
+        for i, reading in enumerate(readings):
+            if reading:
+                count += 1
+                bits |= 1 << i
+        self.line_count = count
+        self.line_bits = bits
+        self.centroid = centroid
+
+    def publish (self):
+        """
+        @brief Puts the latest state into the share
+        """
+        self.state.put(self.v, self.yaw_rate, self.centroid, self.line_count, self.line_bits, self.distance)
@@ -0,0 +1,208 @@
+import array
+import micropython
+from pyb import Timer
+import time
+
+
+class SpeedLoop:
+    """
+    @brief Class to run the wheel speed loop from a hardware timer, away from the task scheduler
+
+    @detail The timer interrupt reads both encoder counters and the time into attributes which already hold
+            integers, so each sample is taken at the timer's rate whatever the tasks are doing. A hard
+            interrupt can't allocate memory, and every float does, so the feedforward and PID run in
+            step(), which the interrupt hands to micropython.schedule. Scheduled functions run as soon as
+            the interrupt returns to Python code, ahead of any task. The bound method passed to schedule
+            is made once here, so the interrupt allocates nothing.
+
+            If step() hasn't run by the next interrupt, that sample is skipped and counted in misses.
+            While paused, such as while a maneuver drives the motors itself, the timer keeps running but
+            nothing is sampled or set.
+
+    """
+
+    def __init__ (self, timer, freq, encoders, controllers, feedforwards, drive, speeds, timeout_ms=200,
+                  log=None):
+        """
+        @brief Init for the speed loop, which doesn't run until start() is called
+
+        @param timer = number of a free hardware timer, such as 6
+
+        @param freq = loop rate, Hz
+
+        @param encoders = (left, right) Encoder objects
+
+        @param controllers = (left, right) PID controllers, from wheel speed error to duty
+
+        @param feedforwards = (left, right) motor feedforwards, from wheel speed to duty
+
+        @param drive = MotorPair to set the duties of
+
+        @param speeds = StructShare holding the (left, right) wheel speed setpoints, rad/s, made with
+                        thread_protect=True; step() may run in the middle of a write, and a sequence counter
+                        read there would wait forever for the write to finish
+
+        @param timeout_ms = setpoints older than this are taken as 0, so the wheels stop if the outer loop does;
+                            after start() or resume() the outer loop is given this long to publish again
+
+        @param log = Queue of floats to log (left duty, left speed, right duty, right speed) to, or None
+
+        """
+        self.timer_num = timer
+        self.freq = freq
+        self.dt = 1 / freq
+        self.period_us = 1000000 // freq
+        self.encoder_left, self.encoder_right = encoders
+        self.controller_left, self.controller_right = controllers
+        self.feedforward_left, self.feedforward_right = feedforwards
+        self.drive = drive
+        self.speeds = speeds
+        self.timeout_ms = timeout_ms
+        self.log = log
+        self.log_row = array.array('f', [0, 0, 0, 0])
+
+        self.timer = None
+        self.active = False
+
+        # Written by the interrupt, read by step()
+        self.pending = False
+        self.count_left = 0
+        self.count_right = 0
+        self.sample_time = 0
+
+        self.speeds_version = -1
+        self.resumed_ms = 0  # When start() or resume() last ran
+        self.omega_left_set = 0.0
+        self.omega_right_set = 0.0
+
+        # Statistics
+        self.runs = 0
+        self.misses = 0
+        self.max_latency_us = 0  # Longest time from the interrupt to step() starting
+        self.max_run_us = 0      # Longest step()
+
+        # Bound methods are made when read, so make them once here rather than in the interrupt
+        self._isr_ref = self._isr
+        self._step_ref = self.step
+
+    def start (self):
+        """
+        @brief Starts the timer and the loop
+        """
+        self.encoder_left.update()
+        self.encoder_right.update()
+        self.sample_time = time.ticks_us()
+        self.resumed_ms = time.ticks_ms()
+        self.pending = False
+        self.active = True
+        self.timer = Timer(self.timer_num, freq=self.freq, callback=self._isr_ref)
+
+    def stop (self):
+        """
+        @brief Stops the timer; the motors are left as they were
+        """
+        self.active = False
+        if self.timer is not None:
+            self.timer.deinit()
+            self.timer = None
+
+    def pause (self):
+        """
+        @brief Stops sampling and setting the motors, so something else may drive them
+        """
+        self.active = False
+
+    def resume (self):
+        """
+        @brief Samples and sets the motors again after pause()
+        """
+        if not self.active:
+            # Take a sample now so the first speed after the pause isn't over the whole pause
+            self.encoder_left.update()
+            self.encoder_right.update()
+            self.resumed_ms = time.ticks_ms()
+            self.pending = False
+            self.active = True
+
+    def slack_us (self):
+        """
+        @brief Works out how long until the loop next needs the CPU, for cotask.TaskList.add_deadline
+
+        @return Time in us until the next interrupt, 0 if a step is waiting to run, or None while paused
+
+        """
+        if not self.active:
+            return None
+        if self.pending:
+            return 0
+        wait = self.period_us - time.ticks_diff(time.ticks_us(), self.sample_time)
+        return wait if wait > 0 else 0
+
+    def _isr (self, tim):
+        """
+        @brief Timer interrupt, which must not allocate
+        """
+        if not self.active:
+            return
+        if self.pending:
+            self.misses += 1
+            return
+        self.count_left = self.encoder_left.tim.counter()
+        self.count_right = self.encoder_right.tim.counter()
+        self.sample_time = time.ticks_us()
+        self.pending = True
+        micropython.schedule(self._step_ref, 0)
+
+    def step (self, arg):
+        """
+        @brief One run of the wheel speed loop, on the samples taken by the last interrupt
+        """
+        start = time.ticks_us()
+        sample_time = self.sample_time
+        count_left = self.count_left
+        count_right = self.count_right
+        self.pending = False
+        if not self.active:
+            return
+
+        self.encoder_left.update(count_left, sample_time)
+        self.encoder_right.update(count_right, sample_time)
+        omega_left = self.encoder_left.get_speed(update=False)
+        omega_right = self.encoder_right.get_speed(update=False)
+
+        # Retrieve target speeds only when the outer loop has published new ones
+        speeds = self.speeds
+        if speeds.changed_since(self.speeds_version):
+            self.speeds_version = speeds.version()
+            self.omega_left_set, self.omega_right_set = speeds.get()
+        if (speeds.age_ms() > self.timeout_ms
+                and time.ticks_diff(time.ticks_ms(), self.resumed_ms) > self.timeout_ms):
+            self.omega_left_set = 0.0
+            self.omega_right_set = 0.0
+
+        dt = self.dt
+        left_pwm = (self.feedforward_left.duty(self.omega_left_set)
+                    + self.controller_left.update(self.omega_left_set, omega_left, dt))
+        right_pwm = (self.feedforward_right.duty(self.omega_right_set)
+                     + self.controller_right.update(self.omega_right_set, omega_right, dt))
+        self.drive.set_duties(left_pwm, right_pwm)
+
+        if self.log is not None:
+            row = self.log_row
+            row[0] = self.drive.left.output  # Duties as set, after clamping and slew
+            row[1] = omega_left
+            row[2] = self.drive.right.output
+            row[3] = omega_right
+            self.log.put_many(row)
+
+        self.runs += 1
+        latency = time.ticks_diff(start, sample_time)
+        if latency > self.max_latency_us:
+            self.max_latency_us = latency
+        run = time.ticks_diff(time.ticks_us(), start)
+        if run > self.max_run_us:
+            self.max_run_us = run
+
+    def __repr__ (self):
+        return ('SpeedLoop: {} Hz on timer {}, {} runs, {} missed, latency max {} us, run max {} us'
+                .format(self.freq, self.timer_num, self.runs, self.misses, self.max_latency_us, self.max_run_us))
@@ -0,0 +1,83 @@
+class SpeedPlanner:
+    """
+    @brief Class to choose the forward speed setpoint while following the line
+
+    @detail The setpoint is raised on straights and lowered going into curves. The robot is taken to be in
+            a curve when the line is off center, when the line is moving across the sensor, or when the
+            robot is turning. The line's rate across the sensor shows a curve coming before the robot
+            turns into it. The setpoint changes by at most accel or decel per second, so the wheels don't
+            slip, and each update takes the same few operations.
+
+    """
+
+    def __init__ (self, v_min=0.4, v_max=0.4, accel=1.0, decel=3.0, k_error=0.1, k_rate=0.01, k_yaw=0.1):
+        """
+        @brief Init for the speed planner
+
+        @detail With the defaults, v_min = v_max, the setpoint is a constant 0.4 ft/s.
+
+        @param v_min = setpoint in the sharpest curves and when the line is lost, ft/s
+
+        @param v_max = setpoint on straights, ft/s
+
+        @param accel = fastest rise of the setpoint, ft/s^2
+
+        @param decel = fastest fall of the setpoint, ft/s^2
+
+        @param k_error = slow down in ft/s per sensor pitch of line position error
+
+        @param k_rate = slow down in ft/s per sensor pitch per second of line movement across the sensor
+
+        @param k_yaw = slow down in ft/s per rad/s of yaw rate
+
+        """
+        self.v_min = v_min
+        self.v_max = v_max
+        self.accel = accel
+        self.decel = decel
+        self.k_error = k_error
+        self.k_rate = k_rate
+        self.k_yaw = k_yaw
+
+        self.prev_error = 0
+        self.v = v_min  # Setpoint in ft/s
+
+    def update (self, line_error, yaw_rate, dt):
+        """
+        @brief Works out the next speed setpoint
+
+        @param line_error = line position from the center of the sensor, in sensor pitches (the spacing of
+                            neighbouring sensors), -3.5 to 3.5 across the 8 sensors
+
+        @param yaw_rate = measured yaw rate, rad/s
+
+        @param dt = time since the last update, s
+
+        @return Speed setpoint in ft/s
+
+        """
+        rate = (line_error - self.prev_error) / dt
+        self.prev_error = line_error
+
+        target = (self.v_max - self.k_error * abs(line_error) - self.k_rate * abs(rate)
+                  - self.k_yaw * abs(yaw_rate))
+        if target < self.v_min:
+            target = self.v_min
+
+        # Limit the change of setpoint
+        if target > self.v + self.accel * dt:
+            target = self.v + self.accel * dt
+        elif target < self.v - self.decel * dt:
+            target = self.v - self.decel * dt
+        self.v = target
+        return target
+
+    def reset (self, v=None):
+        """
+        @brief Starts the setpoint again, such as after a maneuver
+
+        @param v = setpoint to start from, default v_min
+
+        """
+        self.v = self.v_min if v is None else v
+        self.prev_error = 0
@@ -24,6 +24,8 @@
 import array
 import gc
 import pyb
+import struct
+import utime
 import micropython
 
 
@@ -48,6 +50,40 @@ def show_all ():
     return '\n'.join (gen)
 
 
+## Find the total memory used by the buffers of all queues and shares.
+#  @return The number of bytes in all the buffers
+def total_bytes ():
+    return sum (item.nbytes () for item in share_list)
+
+
+## Create a table showing the memory used by and traffic through each queue
+#  and share in the system, with the total memory at the bottom.
+#
+#  For each item the table shows the size of its buffer in bytes, the most
+#  items a queue has held, the number of items which were dropped because a
+#  queue was full or overwritten because it was full, and the rates at which
+#  items were put in and taken out since the item's statistics were reset.
+#  @return A string holding the table
+def memory_summary ():
+    ret_str = 'NAME          TYPE         BYTES   HIGH  DROPS  OVERWR' \
+        '   PUT/S   GET/S\n'
+    for item in share_list:
+        seconds = item.stats_age_ms () / 1000.0
+        if seconds <= 0:
+            seconds = 1.0e-3
+        if isinstance (item, (Queue, SPSCQueue)):
+            high = '{:7d}'.format (item._max_full)
+        else:
+            high = '      -'
+        ret_str += '{:<12s}  {:<11s}{:6d}{:s}{:7d}{:8d}{:8.1f}{:8.1f}\n'.format (
+            item._name, type (item).__name__, item.nbytes (), high,
+            item._drops, item._overwrites,
+            (item._version - item._stats_version) / seconds,
+            item._gets / seconds)
+    ret_str += 'Total buffer memory {:d} bytes'.format (total_bytes ())
+    return ret_str
+
+
 ## Base class for queues and shares which exchange data between tasks.
 # 
 #  One should never create an object from this class; it doesn't do anything
@@ -62,10 +98,77 @@ class BaseShare:
         self._type_code = type_code
         self._thread_protect = thread_protect
 
+        # The number of times a share has been written and the time in
+        # milliseconds when it was last written. Queues count each item put
+        # in their version but don't stamp the time
+        self._version = 0
+        self._stamp = utime.ticks_ms ()
+
+        # Statistics used to size queues and find out how much they're used
+        self.reset_stats ()
+
         # Add this queue to the global share and queue list
         share_list.append (self)
 
 
+    ## Find the number of bytes of memory used by the item's data buffer.
+    #  @return The size of the buffer in bytes
+    def nbytes (self):
+        return len (self._buffer) * struct.calcsize (self._type_code)
+
+
+    ## Reset the counts of items gotten, dropped and overwritten, and start
+    #  timing the put and get rates again.
+    def reset_stats (self):
+        self._gets = 0
+        self._drops = 0
+        self._overwrites = 0
+        self._stats_version = self._version
+        self._stats_start = utime.ticks_ms ()
+
+
+    ## Find how long it has been since the statistics were reset.
+    #  @return The time since statistics were reset in milliseconds
+    def stats_age_ms (self):
+        return utime.ticks_diff (utime.ticks_ms (), self._stats_start)
+
+
+    ## Get the version number of the data in a share.
+    #
+    #  The version starts at zero and goes up by one each time the share is
+    #  written, so a task can save it and later check whether new data has
+    #  been put in since. Read the version before reading the data; then if
+    #  a write comes between the two, the next check will show a change.
+    #  @code
+    #     if my_share.changed_since (last_version):
+    #         last_version = my_share.version ()
+    #         do_something_with (my_share.get ())
+    #  @endcode
+    #  @return The version number of the share's data
+    @micropython.native
+    def version (self):
+        return self._version
+
+
+    ## Check whether a share has been written since a given version.
+    #  @param version A version number previously returned by @c version()
+    #  @return @c True if the share has been written since that version
+    @micropython.native
+    def changed_since (self, version):
+        return self._version != version
+
+
+    ## Find how long ago a share was last written.
+    #
+    #  This can be used to detect a task which has stopped putting data into
+    #  a share. If the share has never been written, the time is measured
+    #  from when the share was created.
+    #  @return The time since the last write in milliseconds
+    @micropython.native
+    def age_ms (self):
+        return utime.ticks_diff (utime.ticks_ms (), self._stamp)
+
+
 ## A queue which is used to transfer data from one task to another.
 #
 #  If parameter 'thread_protect' is @c True when a queue is created, transfers
@@ -138,6 +241,9 @@ class Queue (BaseShare):
             self._buffer = None
             raise
 
+        # A view of the buffer through which runs of items are copied
+        self._view = memoryview (self._buffer)
+
         # Initialize pointers to be used for reading and writing data
         self.clear ()
 
@@ -169,7 +275,8 @@ class Queue (BaseShare):
         # If we're in an ISR and the queue is full and we're not allowed to
         # overwrite data, we have to give up and exit
         if self.full ():
-            if in_ISR:
+            if in_ISR and not self._overwrite:
+                self._drops += 1
                 return
 
             # Wait (if needed) until there's room in the buffer for the data
@@ -186,11 +293,14 @@ class Queue (BaseShare):
         self._wr_idx += 1
         if self._wr_idx >= self._size:
             self._wr_idx = 0
-        self._num_items += 1
-        if self._num_items >= self._size:        # Can't be fuller than full
-            self._num_items = self._size
+        if self._num_items >= self._size:        # Can't be fuller than full;
+            self._rd_idx = self._wr_idx          # the oldest item was written
+            self._overwrites += 1                # over, so skip reading it
+        else:
+            self._num_items += 1
         if self._num_items > self._max_full:     # Record maximum fillage
             self._max_full = self._num_items
+        self._version += 1
 
         # Re-enable interrupts
         if self._thread_protect and not in_ISR:
@@ -234,6 +344,7 @@ class Queue (BaseShare):
         self._num_items -= 1
         if self._num_items < 0:
             self._num_items = 0
+        self._gets += 1
 
         # Re-enable interrupts
         if self._thread_protect and not in_ISR:
@@ -242,6 +353,136 @@ class Queue (BaseShare):
         return (to_return)
 
 
+    ## Put a run of items into the queue with at most two copies.
+    #
+    #  The items are copied straight from the caller's array into the
+    #  queue's buffer, in two pieces if they wrap around its end, and then
+    #  counted all at once. This is much faster than calling @c put() for each
+    #  item and allocates no memory for the items. Unlike @c put(), this
+    #  method never waits for room; if there isn't room for all the items,
+    #  only as many as fit are put in, or if the queue was created with
+    #  @c overwrite set to @c True, the oldest items are overwritten.
+    #  The small memoryview slices used for the copies are allocated on each
+    #  call, though, so this method must not be called from an interrupt
+    #  service routine; use @c put() there.
+    #  @code
+    #     samples = array.array ('h', range (16))
+    #     num_put = my_queue.put_many (samples)
+    #  @endcode
+    #  @param items An @c array.array or @c memoryview holding items of the
+    #         queue's type
+    #  @return The number of items put into the queue
+    @micropython.native
+    def put_many (self, items):
+        num = len (items)
+        if num == 0:
+            return 0
+        source = memoryview (items)
+        start = 0
+
+        # Prevent data corruption by blocking interrupts during data transfer
+        if self._thread_protect:
+            irq_state = pyb.disable_irq ()
+
+        free = self._size - self._num_items
+        if num > free:
+            if self._overwrite:
+                # Only the newest items which fit are kept, and the oldest
+                # items in the queue make room for them
+                if num > self._size:
+                    start = num - self._size
+                    num = self._size
+                discard = num - free
+                self._rd_idx += discard
+                if self._rd_idx >= self._size:
+                    self._rd_idx -= self._size
+                self._num_items -= discard
+                self._overwrites += discard + start
+            else:
+                self._drops += num - free
+                num = free
+
+        # Copy up to the end of the buffer, then any rest to its beginning
+        wr_idx = self._wr_idx
+        first = self._size - wr_idx
+        if first > num:
+            first = num
+        self._view[wr_idx:wr_idx + first] = source[start:start + first]
+        if num > first:
+            self._view[0:num - first] = source[start + first:start + num]
+
+        wr_idx += num
+        if wr_idx >= self._size:
+            wr_idx -= self._size
+        self._wr_idx = wr_idx
+        self._num_items += num
+        if self._num_items > self._max_full:     # Record maximum fillage
+            self._max_full = self._num_items
+        self._version += num
+
+        # Re-enable interrupts
+        if self._thread_protect:
+            pyb.enable_irq (irq_state)
+
+        return num
+
+
+    ## Get a run of items from the queue with at most two copies.
+    #
+    #  Items are copied straight from the queue's buffer into the caller's
+    #  array, oldest first, and then removed from the queue all at once. Unlike
+    #  @c get(), this method never waits; it gets as many items as are in the
+    #  queue, up to the length of the array. Draining a queue this way is
+    #  much faster than calling @c get() for each item. As with
+    #  @c put_many(), the copies allocate memoryview slices, so this method
+    #  must not be called from an interrupt service routine:
+    #  @code
+    #     samples = array.array ('h', range (16))    # Allocated once
+    #     while True:
+    #         num = my_queue.get_many (samples)
+    #         log_samples (samples, num)
+    #         yield 0
+    #  @endcode
+    #  @param into An @c array.array or @c memoryview of the queue's type
+    #         into which items are copied
+    #  @return The number of items copied into @c into
+    @micropython.native
+    def get_many (self, into):
+        num = len (into)
+        if num == 0 or self._num_items <= 0:
+            return 0
+        dest = memoryview (into)
+
+        # Prevent data corruption by blocking interrupts during data transfer
+        if self._thread_protect:
+            irq_state = pyb.disable_irq ()
+
+        if num > self._num_items:
+            num = self._num_items
+
+        # Copy up to the end of the buffer, then any rest from its beginning
+        rd_idx = self._rd_idx
+        first = self._size - rd_idx
+        if first > num:
+            first = num
+        dest[0:first] = self._view[rd_idx:rd_idx + first]
+        if num > first:
+            dest[first:num] = self._view[0:num - first]
+
+        rd_idx += num
+        if rd_idx >= self._size:
+            rd_idx -= self._size
+        self._rd_idx = rd_idx
+        self._num_items -= num
+        self._gets += num
+
+        # Re-enable interrupts
+        if self._thread_protect:
+            pyb.enable_irq (irq_state)
+
+        return num
+
+
     ## Check if there are any items in the queue.
     # 
     #  Returns @c True if there are any items in the queue and @c False
@@ -295,8 +536,176 @@ class Queue (BaseShare):
     #  It shows the queue's name and type as well as the maximum number of
     #  items and queue size. 
     def __repr__ (self):
-        return ('{:<12s} Queue<{:s}> Max Full {:d}/{:d}'.format (self._name,
-                type_code_strings[self._type_code], self._max_full, self._size))
+        return ('{:<12s} Queue<{:s}> Max Full {:d}/{:d} {:d} bytes'.format (
+                self._name, type_code_strings[self._type_code],
+                self._max_full, self._size, self.nbytes ()))
+
+
+# ============================================================================
+
+## A queue which safely carries data from exactly one producer to exactly one
+#  consumer without disabling interrupts.
+#
+#  The producer only ever changes the write index and the consumer only ever
+#  changes the read index, and each index is changed only after the data it
+#  covers has been written or read. Because changing an index is a single
+#  store, an interrupt can't see a half finished update, so one side may be
+#  an interrupt service routine and the other a task. One slot of the buffer
+#  is always left empty so that a full queue can be told from an empty one.
+#
+#  Unlike @c Queue.put() and @c Queue.get(), @c try_put() and @c try_get()
+#  never wait. A task which waits for the other side of a queue can never be
+#  satisfied by a cooperative scheduler, since the other task can't run until
+#  the waiting one yields. These methods instead report a full or empty queue
+#  so that the caller can yield and try again later.
+#
+#  @code
+#  import task_share
+#
+#  # This queue holds up to 50 signed 16-bit integers
+#  my_queue = task_share.SPSCQueue ('h', 50, name="Ticks")
+#
+#  # In an interrupt service routine, the single producer
+#  if not my_queue.try_put (some_data):
+#      overflowed = True
+#
+#  # In a task, the single consumer
+#  something = my_queue.try_get ()
+#  if something is not None:
+#      do_something_with (something)
+#  @endcode
+class SPSCQueue (BaseShare):
+
+    ## A counter used to give serial numbers to queues for diagnostic use.
+    ser_num = 0
+
+    ## Initialize a single producer, single consumer queue.
+    #
+    #  This method allocates memory for the contents of the queue. The type
+    #  codes are the same as those for @c Queue.
+    #  @param type_code The type of data items which the queue can hold
+    #  @param size The maximum number of items which the queue can hold
+    #  @param name A short name for the queue, default @c SPSCQueueN where
+    #         @c N is a serial number for the queue
+    def __init__ (self, type_code, size, name = None):
+        # This queue never needs interrupts disabled
+        super ().__init__ (type_code, False, name)
+
+        self._size = size + 1
+        self._name = str (name) if name != None \
+            else 'SPSCQueue' + str (SPSCQueue.ser_num)
+        SPSCQueue.ser_num += 1
+
+        # Allocate memory for the data, plus the slot which is kept empty
+        self._buffer = array.array (type_code, range (size + 1))
+
+        self.clear ()
+        gc.collect ()
+
+
+    ## Put an item into the queue if there's room for it.
+    #
+    #  This method must only be called by the queue's single producer. It
+    #  doesn't wait, allocate memory or disable interrupts.
+    #  @param item The item to be placed into the queue
+    #  @return @c True if the item was put in, @c False if the queue was full
+    @micropython.native
+    def try_put (self, item):
+        wr_idx = self._wr_idx
+        next_idx = wr_idx + 1
+        if next_idx >= self._size:
+            next_idx = 0
+        if next_idx == self._rd_idx:
+            self._drops += 1
+            return False
+
+        # Write the data before the index which makes it visible to the
+        # consumer
+        self._buffer[wr_idx] = item
+        self._wr_idx = next_idx
+        self._version += 1
+
+        # Record maximum fillage; only the producer writes this
+        num = next_idx - self._rd_idx
+        if num < 0:
+            num += self._size
+        if num > self._max_full:
+            self._max_full = num
+        return True
+
+
+    ## Get the oldest item from the queue if there is one.
+    #
+    #  This method must only be called by the queue's single consumer. It
+    #  doesn't wait, allocate memory or disable interrupts.
+    #  @param default The value to return if the queue is empty
+    #  @return The oldest item in the queue, or @c default if it's empty
+    @micropython.native
+    def try_get (self, default = None):
+        rd_idx = self._rd_idx
+        if rd_idx == self._wr_idx:
+            return default
+
+        # Read the data before the index which frees its slot for the
+        # producer
+        item = self._buffer[rd_idx]
+        rd_idx += 1
+        if rd_idx >= self._size:
+            rd_idx = 0
+        self._rd_idx = rd_idx
+        self._gets += 1
+        return item
+
+
+    ## Check if there are any items in the queue.
+    #  @return @c True if items are in the queue, @c False if not
+    @micropython.native
+    def any (self):
+        return (self._rd_idx != self._wr_idx)
+
+
+    ## Check if the queue is empty.
+    #  @return @c True if queue is empty, @c False if it's not empty
+    @micropython.native
+    def empty (self):
+        return (self._rd_idx == self._wr_idx)
+
+
+    ## Check if the queue is full.
+    #  @return @c True if the queue is full
+    @micropython.native
+    def full (self):
+        next_idx = self._wr_idx + 1
+        if next_idx >= self._size:
+            next_idx = 0
+        return (next_idx == self._rd_idx)
+
+
+    ## Check how many items are in the queue.
+    #  The count may be out of date by the time it's used if the other side
+    #  of the queue is an interrupt service routine.
+    #  @return The number of items in the queue
+    @micropython.native
+    def num_in (self):
+        num = self._wr_idx - self._rd_idx
+        if num < 0:
+            num += self._size
+        return num
+
+
+    ## Remove all contents from the queue.
+    #  This must not be called while either side may be using the queue.
+    def clear (self):
+        self._rd_idx = 0
+        self._wr_idx = 0
+        self._max_full = 0
+
+
+    ## This method puts diagnostic information about the queue into a string.
+    def __repr__ (self):
+        return ('{:<12s} SPSCQueue<{:s}> Max Full {:d}/{:d} {:d} bytes'.format (
+                self._name, type_code_strings[self._type_code],
+                self._max_full, self._size - 1, self.nbytes ()))
 
 
 # ============================================================================
@@ -375,6 +784,8 @@ class Share (BaseShare):
             irq_state = pyb.disable_irq ()
 
         self._buffer[0] = data
+        self._version += 1
+        self._stamp = utime.ticks_ms ()
 
         # Re-enable interrupts
         if self._thread_protect and not in_ISR:
@@ -394,6 +805,7 @@ class Share (BaseShare):
             irq_state = pyb.disable_irq ()
 
         to_return = self._buffer[0]
+        self._gets += 1
 
         # Re-enable interrupts
         if self._thread_protect and not in_ISR:
@@ -406,7 +818,144 @@ class Share (BaseShare):
     #
     #  Shares are pretty simple, so we just put the name and type. 
     def __repr__ (self):
-        return ("{:<12s} Share<{:s}>".format (self._name,
-                type_code_strings[self._type_code]))
+        return ("{:<12s} Share<{:s}> {:d} bytes".format (self._name,
+                type_code_strings[self._type_code], self.nbytes ()))
 
 
+# ============================================================================
+
+## A share which holds a record of several fields which are always written
+#  and read together.
+#
+#  Values which belong together, such as the speeds of both wheels, can be
+#  torn if they're kept in separate shares: a reader may get one new value and
+#  one old one. A struct share keeps all the fields in one buffer, packed as
+#  by the @c struct module, and writes or reads the whole record at once.
+#
+#  Both @c put() and @c get() allocate, as @c put(*values) builds a tuple of
+#  the values and @c get() returns one, so neither may be called from a hard
+#  interrupt service routine, which can't allocate memory. A callback run by
+#  @c micropython.schedule() may call them; that is how an interrupt should
+#  hand its data to code which uses a struct share.
+#
+#  If @c thread_protect is @c True, interrupts are disabled while the record
+#  is written or read, which is needed if a scheduled callback may run while
+#  a task is part way through a write or read. Otherwise a sequence counter
+#  protects the record: the writer makes the counter odd while it writes and
+#  even when done, and a reader tries again if the counter was odd or
+#  changed while it read. This costs less than disabling interrupts and is
+#  safe when both sides are tasks or when the writer is a scheduled
+#  callback, but a scheduled callback must not read a share protected this
+#  way, as a task's write it interrupted can't finish until it returns.
+#
+#  @code
+#  import task_share
+#
+#  # This share holds two floats and an unsigned 32-bit integer
+#  speeds = task_share.StructShare ('ffL', name="Speeds")
+#
+#  # In one task, put a whole record into the share
+#  speeds.put (omega_l, omega_r, utime.ticks_ms ())
+#
+#  # In another task, read the whole record
+#  omega_l, omega_r, stamp = speeds.get ()
+#  @endcode
+class StructShare (BaseShare):
+
+    ## A counter used to give serial numbers to shares for diagnostic use.
+    ser_num = 0
+
+    ## Create a share which holds a record of several fields.
+    #
+    #  The buffer for the record is allocated once, here. 
+    #  @param fields The type codes of the fields, one letter per field, as
+    #         listed for @c Share, for example @c 'ffL'
+    #  @param thread_protect @c True to disable interrupts while the record
+    #         is accessed, @c False to use a sequence counter instead
+    #  @param name A short name for the share, default @c StructShareN where
+    #         @c N is a serial number for the share
+    def __init__ (self, fields, thread_protect = True, name = None):
+        for code in fields:
+            if code not in type_code_strings:
+                raise ValueError ('Unknown type code ' + code)
+
+        # First call the parent class initializer
+        super ().__init__ (fields, thread_protect, name)
+
+        self._format = '<' + fields
+        self._buffer = bytearray (struct.calcsize (self._format))
+        self._seq = 0
+
+        self._name = str (name) if name != None \
+            else 'StructShare' + str (StructShare.ser_num)
+        StructShare.ser_num += 1
+
+
+    ## Write a whole record into the share.
+    #
+    #  The values are passed as a tuple, which is allocated, so this must not
+    #  be called from a hard interrupt service routine.
+    #  @param values One value for each field, in order
+    #  @param in_ISR Set this to @c True to leave interrupts as they are,
+    #         such as when the caller has already disabled them
+    @micropython.native
+    def put (self, *values, in_ISR = False):
+        if self._thread_protect:
+            if not in_ISR:
+                irq_state = pyb.disable_irq ()
+            struct.pack_into (self._format, self._buffer, 0, *values)
+            self._seq += 2
+            self._version += 1
+            self._stamp = utime.ticks_ms ()
+            if not in_ISR:
+                pyb.enable_irq (irq_state)
+        else:
+            # An odd count tells readers that a write is under way
+            self._seq += 1
+            struct.pack_into (self._format, self._buffer, 0, *values)
+            self._version += 1
+            self._stamp = utime.ticks_ms ()
+            self._seq += 1
+
+
+    ## Read a whole record from the share.
+    #
+    #  The tuple returned is allocated, so this must not be called from a
+    #  hard interrupt service routine.
+    #  @param in_ISR Set this to @c True to leave interrupts as they are,
+    #         such as when the caller has already disabled them
+    #  @return A tuple holding the value of each field, in order
+    @micropython.native
+    def get (self, in_ISR = False):
+        if self._thread_protect:
+            if not in_ISR:
+                irq_state = pyb.disable_irq ()
+            to_return = struct.unpack_from (self._format, self._buffer, 0)
+            self._gets += 1
+            if not in_ISR:
+                pyb.enable_irq (irq_state)
+            return to_return
+
+        # Read again if a write was under way or happened during the read
+        while True:
+            seq = self._seq
+            if not seq & 1:
+                to_return = struct.unpack_from (self._format, self._buffer, 0)
+                if self._seq == seq:
+                    self._gets += 1
+                    return to_return
+
+
+    ## Find the number of bytes of memory used by the share's record.
+    #  @return The size of the record buffer in bytes
+    def nbytes (self):
+        return len (self._buffer)
+
+
+    ## Puts diagnostic information about the share into a string.
+    #
+    #  The name is followed by the type of each field.
+    def __repr__ (self):
+        return ("{:<12s} StructShare<{:s}> {:d} bytes".format (self._name,
+                ','.join (type_code_strings[code]
+                          for code in self._type_code), self.nbytes ()))